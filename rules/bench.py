@@ -0,0 +1,101 @@
+"""
+Copyright(C) 2016, Stamus Networks
+Written by Eric Leblond <eleblond@stamus-networks.com>
+
+This file is part of Scirius.
+
+Scirius is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Scirius is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Scirius.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from django.db import connection
+
+from collections import deque
+from time import time, sleep
+import threading
+import psutil
+import os
+
+SYNTHETIC_RULE = 'alert tcp $HOME_NET any -> $EXTERNAL_NET any (msg:"SCIRIUS BENCH rule %d"; flow:established,to_server; content:"bench-%d"; %sclasstype:misc-activity; sid:%d; rev:%d;)\n'
+
+def synthetic_rule(sid, rev = 1, flowbits_every = 20):
+    # chain a set and an isset on the same flowbit every flowbits_every rules
+    flowbit = ''
+    if flowbits_every and sid % flowbits_every == 0:
+        flowbit = 'flowbits:set,bench.%d; ' % (sid)
+    elif flowbits_every and sid % flowbits_every == 1 and sid > 1:
+        flowbit = 'flowbits:isset,bench.%d; ' % (sid - 1)
+    return SYNTHETIC_RULE % (sid, sid, flowbit, sid, rev)
+
+def write_synthetic_rules(directory, rules_count, files_count, first_sid = 1, rev = 1, flowbits_every = 20):
+    # return the list of written files relative to directory
+    rules_dir = os.path.join(directory, 'rules')
+    if not os.path.isdir(rules_dir):
+        os.makedirs(rules_dir)
+    per_file = rules_count / files_count + 1
+    filenames = []
+    sid = first_sid
+    for index in xrange(files_count):
+        filename = os.path.join('rules', 'bench-%d.rules' % (index))
+        with open(os.path.join(directory, filename), 'w') as rfile:
+            for _ in xrange(per_file):
+                if sid >= first_sid + rules_count:
+                    break
+                rfile.write(synthetic_rule(sid, rev = rev, flowbits_every = flowbits_every))
+                sid += 1
+        filenames.append(filename)
+    return filenames
+
+class Measure(object):
+    """
+    Context manager recording wall time, number of SQL queries
+    and peak resident memory of the enclosed code.
+    """
+    RSS_SAMPLING = 0.01
+
+    def __enter__(self):
+        self.process = psutil.Process(os.getpid())
+        self.rss_start = self.process.memory_info().rss
+        self.rss_peak = self.rss_start
+        self.running = True
+        self.sampler = threading.Thread(target = self._sample_rss)
+        self.sampler.daemon = True
+        self.sampler.start()
+        # default queries log is bounded, use an unbounded one
+        self.queries_log = connection.queries_log
+        self.force_debug_cursor = connection.force_debug_cursor
+        connection.queries_log = deque()
+        connection.force_debug_cursor = True
+        self.start = time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time() - self.start
+        self.queries = len(connection.queries_log)
+        connection.queries_log = self.queries_log
+        connection.force_debug_cursor = self.force_debug_cursor
+        self.running = False
+        self.sampler.join()
+        self.rss_peak = max(self.rss_peak, self.process.memory_info().rss)
+        return False
+
+    def _sample_rss(self):
+        while self.running:
+            self.rss_peak = max(self.rss_peak, self.process.memory_info().rss)
+            sleep(self.RSS_SAMPLING)
+
+    def rss_delta(self):
+        return self.rss_peak - self.rss_start
+
+    def __str__(self):
+        return "%.3fs, %d queries, peak RSS +%.1f MB" % (self.duration, self.queries, self.rss_delta() / (1024.0 * 1024))
@@ -0,0 +1,166 @@
+"""
+Copyright(C) 2016, Stamus Networks
+Written by Eric Leblond <eleblond@stamus-networks.com>
+
+This file is part of Scirius.
+
+Scirius is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Scirius is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Scirius.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from django.conf import settings
+
+import git
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from rules.models import Rule, Transformation, Threshold, write_file_atomic
+
+RULES_FILE = 'scirius.rules'
+FILES_DIR = 'files'
+META_FILE = 'build.json'
+
+def source_version(sourceat):
+    # rules and files of a source only change with its git commit
+    source_git_dir = os.path.join(settings.GIT_SOURCES_BASE_DIRECTORY, str(sourceat.source_id))
+    try:
+        return git.Repo(source_git_dir).commit(sourceat.version).hexsha
+    except Exception:
+        return "%s@%s" % (sourceat.version, sourceat.source.updated_date)
+
+def ruleset_fingerprint(ruleset):
+    """
+    Digest of everything the generated files of a ruleset depend on:
+    sources versions, categories, suppressed and disabled rules,
+    transformations and thresholds.
+    """
+    categories = sorted(ruleset.categories.values_list('pk', flat = True))
+    thresholds = Threshold.objects.filter(ruleset = ruleset).values_list('threshold_type', 'type', 'gid', 'rule_id',
+                                                                         'track_by', 'net', 'count', 'seconds')
+    state = {
+        'sources': sorted([ (sourceat.source_id, source_version(sourceat)) for sourceat in ruleset.sources.select_related('source') ]),
+        'categories': categories,
+        'suppressed': sorted(ruleset.suppressed_rules.values_list('pk', flat = True)),
+        'disabled': sorted(Rule.objects.filter(category__in = categories, state = False).values_list('pk', flat = True)),
+        'transformations': sorted(Transformation.objects.filter(ruleset = ruleset).values_list('rule_id', 'datatype')),
+        'thresholds': sorted(thresholds),
+    }
+    return hashlib.sha1(json.dumps(state, sort_keys = True)).hexdigest()
+
+class RulesetBuild(object):
+    """
+    Generated rules file, without header, and related files of a ruleset
+    stored in a directory of the build cache.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.rules_count = self.meta['rules_count']
+
+    def iter_buffer(self, header, chunk_size = 64 * 1024):
+        yield header.encode('utf-8')
+        with open(os.path.join(self.path, RULES_FILE)) as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def to_buffer(self, header):
+        return "".join(self.iter_buffer(header))
+
+    def write_rules(self, filename, header):
+        write_file_atomic(filename, self.iter_buffer(header))
+        return self.rules_count
+
+    def export_files(self, directory):
+        files_dir = os.path.join(self.path, FILES_DIR)
+        for root, _, files in os.walk(files_dir):
+            target = os.path.normpath(os.path.join(directory, os.path.relpath(root, files_dir)))
+            if not os.path.isdir(target):
+                os.makedirs(target)
+            for f in files:
+                shutil.copyfile(os.path.join(root, f), os.path.join(target, f))
+
+    def related_files(self, max_size = 50 * 1024):
+        # beginning of the related files, as given to the rules test
+        related_files = {}
+        for root, _, files in os.walk(os.path.join(self.path, FILES_DIR)):
+            for f in files:
+                with open(os.path.join(root, f), 'r') as cf:
+                    related_files[f] = cf.read(max_size)
+        return related_files
+
+def build(ruleset, directory, path):
+    # build in a temporary directory renamed at the end, so other
+    # processes never use an incomplete build
+    tmpdir = tempfile.mkdtemp(dir = directory, prefix = '.build-')
+    try:
+        rules_count = ruleset.write_rules(os.path.join(tmpdir, RULES_FILE), header = '')
+        files_dir = os.path.join(tmpdir, FILES_DIR)
+        os.mkdir(files_dir)
+        ruleset.export_files(files_dir)
+        with open(os.path.join(tmpdir, META_FILE), 'w') as f:
+            json.dump({ 'ruleset': ruleset.pk, 'rules_count': rules_count }, f)
+        try:
+            os.rename(tmpdir, path)
+        except OSError:
+            # same build done concurrently by another process
+            if not os.path.isdir(path):
+                raise
+            shutil.rmtree(tmpdir)
+    except:
+        shutil.rmtree(tmpdir, ignore_errors = True)
+        raise
+
+def evict(directory, max_entries, keep):
+    # remove least recently used builds, their directory modification
+    # time is updated at each use
+    entries = []
+    for name in os.listdir(directory):
+        if name.startswith('.'):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            entries.append((os.path.getmtime(path), path))
+        except OSError:
+            pass
+    entries.sort()
+    for (_, path) in entries[:max(len(entries) - max_entries, 0)]:
+        if path != keep:
+            shutil.rmtree(path, ignore_errors = True)
+
+def get_build(ruleset):
+    """
+    Return the build of the ruleset from the cache, generating it if
+    the ruleset or its sources changed since the last build.
+    """
+    directory = settings.RULESET_CACHE_DIRECTORY
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, ruleset_fingerprint(ruleset))
+    if os.path.isdir(path):
+        try:
+            os.utime(path, None)
+            return RulesetBuild(path)
+        except (OSError, IOError):
+            # evicted by another process in between
+            shutil.rmtree(path, ignore_errors = True)
+    build(ruleset, directory, path)
+    evict(directory, settings.RULESET_CACHE_SIZE, path)
+    return RulesetBuild(path)
@@ -0,0 +1,154 @@
+"""
+Copyright(C) 2016, Stamus Networks
+Written by Eric Leblond <eleblond@stamus-networks.com>
+
+This file is part of Scirius.
+
+Scirius is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Scirius is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Scirius.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from django.conf import settings
+
+from collections import OrderedDict
+from time import time
+import threading
+
+# default time to live in seconds of cached results per query type,
+# can be changed with ELASTICSEARCH_CACHE_TTL setting, 0 disables cache
+DEFAULT_TTL = {
+    'rules': 60,
+    'field_stats': 60,
+    'sid_by_hosts': 60,
+    'timeline': 60,
+    'metrics_timeline': 30,
+    'rules_per_category': 60,
+    'alerts_count': 30,
+    'latest_stats': 10,
+    'indices': 300,
+}
+
+def cacheable(value):
+    # failed queries return None or an error message
+    return value != None and not isinstance(value, basestring)
+
+class ResultCache(object):
+    """
+    Size bounded cache of query results with a time to live per entry.
+
+    Concurrent requests for the same missing key are merged: the first
+    one computes the value and the others wait for its result.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        # key -> (expiration time, value), in least recently used order
+        self.entries = OrderedDict()
+        # key -> threading.Event of the thread computing the value
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+
+    def lookup(self, key, now):
+        # must be called with lock held
+        entry = self.entries.pop(key, None)
+        if entry == None or entry[0] <= now:
+            return None
+        self.entries[key] = entry
+        return entry
+
+    def get(self, key, ttl, compute, wait = 60):
+        if ttl <= 0:
+            return compute()
+        with self.lock:
+            entry = self.lookup(key, time())
+            if entry:
+                self.hits += 1
+                return entry[1]
+            event = self.inflight.get(key)
+            if event == None:
+                event = threading.Event()
+                self.inflight[key] = event
+                owner = True
+                self.misses += 1
+            else:
+                owner = False
+        if not owner:
+            event.wait(wait)
+            with self.lock:
+                entry = self.lookup(key, time())
+                if entry:
+                    self.shared += 1
+                    return entry[1]
+                self.misses += 1
+            return compute()
+        try:
+            value = compute()
+            self.put(key, ttl, value)
+        finally:
+            with self.lock:
+                del(self.inflight[key])
+            event.set()
+        return value
+
+    def peek(self, key):
+        # return cached value without computing it, None if missing
+        with self.lock:
+            entry = self.lookup(key, time())
+            if entry:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        return None
+
+    def put(self, key, ttl, value):
+        if not cacheable(value):
+            return
+        with self.lock:
+            self.entries[key] = (time() + ttl, value)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last = False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return { 'hits': self.hits, 'shared': self.shared, 'misses': self.misses,
+                     'entries': len(self.entries), 'max_size': self.max_size }
+
+es_cache = ResultCache(settings.ELASTICSEARCH_CACHE_SIZE)
+
+def get_ttl(query):
+    if settings.ELASTICSEARCH_CACHE_TTL.has_key(query):
+        return settings.ELASTICSEARCH_CACHE_TTL[query]
+    return DEFAULT_TTL.get(query, 0)
+
+def cached(query, key, compute):
+    return es_cache.get((query,) + tuple(key), get_ttl(query), compute)
+
+def freeze(value):
+    if isinstance(value, list):
+        return tuple(value)
+    return value
+
+def round_date(from_date):
+    # from_date is in milliseconds, rounding lets users asking for the same
+    # period in the same rounding window share the result
+    rounding = settings.ELASTICSEARCH_CACHE_ROUNDING * 1000
+    if not from_date or rounding <= 0:
+        return from_date
+    return int(from_date) / rounding * rounding
@@ -26,9 +26,10 @@ import tempfile
 from cStringIO import StringIO
 from shutil import rmtree
 from time import strftime, sleep
+import threading
 
 from django.conf import settings
-from elasticsearch import Elasticsearch, ConnectionError
+from elasticsearch import Elasticsearch, ConnectionError, ConnectionTimeout
 
 # Avoid logging every request
 es_logger = logging.getLogger('elasticsearch')
@@ -69,10 +70,49 @@ KIBANA_MAPPINGS = { "dashboard":
     }
 }
 
+es_client = None
+# client of ESData, its requests don't go through es_request so the
+# client retries them on connection errors
+es_retry_client = None
+es_client_lock = threading.Lock()
+
+def new_es_client(max_retries):
+    es_addr = 'http://%s/' % settings.ELASTICSEARCH_ADDRESS
+    return Elasticsearch([es_addr], timeout = settings.ELASTICSEARCH_TIMEOUT,
+                         maxsize = settings.ELASTICSEARCH_POOL_SIZE, max_retries = max_retries)
+
+def get_es_client(retries = False):
+    # client is shared by all threads of the process so connections
+    # to Elasticsearch are kept alive in its pool between requests
+    global es_client, es_retry_client
+    with es_client_lock:
+        if retries:
+            if es_retry_client == None:
+                es_retry_client = new_es_client(settings.ELASTICSEARCH_RETRIES)
+            return es_retry_client
+        if es_client == None:
+            es_client = new_es_client(0)
+    return es_client
+
+def es_request(method, url, body = None, params = None):
+    # retry on connection errors and timeouts, waiting longer each time
+    delay = settings.ELASTICSEARCH_RETRY_BACKOFF
+    for attempt in xrange(settings.ELASTICSEARCH_RETRIES + 1):
+        try:
+            result = get_es_client().transport.perform_request(method, url, params = params, body = body)
+            # clients before 5.0 return a (status, data) tuple
+            if isinstance(result, tuple):
+                return result[1]
+            return result
+        except (ConnectionError, ConnectionTimeout):
+            if attempt == settings.ELASTICSEARCH_RETRIES:
+                raise
+            sleep(delay)
+            delay *= 2
+
 class ESData(object):
     def __init__(self):
-        es_addr = 'http://%s/' % settings.ELASTICSEARCH_ADDRESS
-        self.client = Elasticsearch([es_addr])
+        self.client = get_es_client(retries = True)
 
     def _kibana_remove(self, _type, body):
         i = 0
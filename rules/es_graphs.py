@@ -18,659 +18,114 @@ You should have received a copy of the GNU General Public License
 along with Scirius.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from django.template import Context, Template
 from django.conf import settings
 from datetime import datetime, timedelta
 
-import urllib2
-import requests
+from time import time, mktime, sleep
 import json
-from time import time, mktime
-import re
-
-URL = "http://%s/%s/_search?ignore_unavailable=true"
-
-TOP_QUERY = """
-{
-  "facets": {
-    "table": {
-      "terms": {
-        "field": "{{ field }}",
-        "size": {{ count }},
-        "exclude": []
-      },
-      "facet_filter": {
-        "fquery": {
-          "query": {
-            "filtered": {
-              "query": {
-                "bool": {
-                  "should": [
-                    {
-                      "query_string": {
-                        "query": "event_type:alert AND host.raw:{{ appliance_hostname }} {{ query_filter|safe }}"
-                      }
-                    }
-                  ]
-                }
-              },
-              "filter": {
-                "bool": {
-                  "must": [
-                    {
-                      "range": {
-                        "@timestamp": {
-                          "from": {{ from_date }},
-                          "to": "now"
-                        }
-                      }
-                    }
-                  ]
-                }
-              }
-            }
-          }
-        }
-      }
-    }
-  },
-  "size": 0
-}
-"""
-
-if settings.ELASTICSEARCH_2X:
-    TOP_QUERY = """
-{
-  "size": 0,
-  "aggs": {
-    "table": {
-      "terms": {
-        "field": "{{ field }}",
-        "size": {{ count }},
-        "order": {
-          "_count": "desc"
-        }
-      }
-    }
-  },
-  "query": {
-    "filtered": {
-      "query": {
-        "query_string": {
-          "query": "event_type:alert AND host.raw:{{ appliance_hostname }} {{ query_filter|safe }}",
-          "analyze_wildcard": false
-        }
-      },
-      "filter": {
-        "bool": {
-          "must": [
-            {
-              "range": {
-                 "@timestamp": {
-                    "from": {{ from_date }},
-                    "to": "now"
-                 }
-              }
-            }
-          ]
-        }
-      }
-    }
-  }
-}
-    """
-
-SID_BY_HOST_QUERY = """
-{
-  "facets": {
-    "terms": {
-      "terms": {
-        "field": "host.raw",
-        "size": {{ alerts_number }},
-        "order": "count",
-        "exclude": []
-      },
-      "facet_filter": {
-        "fquery": {
-          "query": {
-            "filtered": {
-              "query": {
-                "bool": {
-                  "should": [
-                    {
-                      "query_string": {
-                        "query": "event_type:alert AND alert.signature_id:{{ rule_sid }}"
-                      }
-                    }
-                  ]
-                }
-              },
-              "filter": {
-                "bool": {
-                  "must": [
-                    {
-                      "range": {
-                        "@timestamp": {
-                          "from": {{ from_date }},
-                          "to": "now"
-                        }
-                      }
-                    }
-                  ]
-                }
-              }
-            }
-          }
-        }
-      }
-    }
-  },
-  "size": 0
-}'
-"""
-
-if settings.ELASTICSEARCH_2X:
-    SID_BY_HOST_QUERY = """
-{
-  "size": 0,
-  "aggs": {
-    "host": {
-      "terms": {
-        "field": "host.raw",
-        "size": {{ alerts_number }},
-        "order": {
-          "_count": "desc"
-        }
-      }
-    }
-  },
-  "query": {
-    "filtered": {
-      "query": {
-        "query_string": {
-          "query": "event_type:alert AND alert.signature_id:{{ rule_sid }}",
-          "analyze_wildcard": false
-        }
-      },
-      "filter": {
-        "bool": {
-          "must": [
-            {
-              "range": {
-                 "@timestamp": {
-                    "from": {{ from_date }},
-                    "to": "now"
-                 }
-              }
-            }
-          ]
-        }
-      }
-    }
-  }
-}
-    """
-
-TIMELINE_QUERY = """
-{
-  "facets": {
-{% for host in hosts %}
-    "{{ host }}": {
-      "date_histogram": {
-        "field": "@timestamp",
-        "interval": "{{ interval }}"
-      },
-      "global": true,
-      "facet_filter": {
-        "fquery": {
-          "query": {
-            "filtered": {
-              "query": {
-                "query_string": {
-                  "query": "event_type:alert AND host.raw:{{ host }} {{ query_filter|safe }}"
-                }
-              },
-              "filter": {
-                "bool": {
-                  "must": [
-                    {
-                      "range": {
-                        "@timestamp": {
-                          "from": {{ from_date }},
-                          "to": "now"
-                        }
-                      }
-                    }
-                  ]
-                }
-              }
-            }
-          }
-        }
-      }
-    }{% if not forloop.last %},{% endif %}{% endfor %}
-  },
-  "size": 0
-}
-"""
-
-if settings.ELASTICSEARCH_2X:
-    TIMELINE_QUERY = """
-{
-  "size": 0,
-  "aggs": {
-    "date": {
-      "date_histogram": {
-        "field": "@timestamp",
-        "interval": "{{ interval }}",
-        "time_zone": "Europe/Berlin",
-        "min_doc_count": 0
-      },
-      "aggs": {
-        "host": {
-          "terms": {
-            "field": "host.raw",
-            "size": 5,
-            "order": {
-              "_count": "desc"
-            }
-          }
-        }
-      }
-    }
-  },
-  "query": {
-    "filtered": {
-      "query": {
-        "query_string": {
-          "query": "event_type:alert {{ query_filter|safe }}",
-          "analyze_wildcard": false
-        }
-      },
-      "filter": {
-        "bool": {
-          "must": [
-            {
-              "range": {
-                "@timestamp": {
-                  "gte": {{ from_date }},
-                  "lte": "now",
-                  "format": "epoch_millis"
-                }
-              }
-            }
-          ],
-          "must_not": []
-        }
-      }
-    }
-  }
-}
-    """
-
-STATS_QUERY = """
-{
-  "facets": {
-{% if hosts %}
-{% for host in hosts %}
-    "{{ host }}": {
-      "date_histogram": {
-        "key_field": "@timestamp",
-        "value_field": "{{ value }}",
-        "interval": "{{ interval }}",
-        "min_doc_count": 0
-      },
-      "global": true,
-      "facet_filter": {
-        "fquery": {
-          "query": {
-            "filtered": {
-              "query": {
-                "query_string": {
-                  "query": "host.raw:{{ host }}"
-                }
-              },
-              "filter": {
-                "bool": {
-                  "must": [
-                    {
-                      "range": {
-                        "@timestamp": {
-                          "from": {{ from_date }},
-                          "to": "now"
-                        }
-                      }
-                    }
-                  ]
-                }
-              }
-            }
-          }
-        }
-      }
-    }{% if not forloop.last %},{% endif %}{% endfor %}
-  {% else %}
-    "global": {
-      "date_histogram": {
-        "key_field": "@timestamp",
-        "value_field": "{{ value }}",
-        "interval": "{{ interval }}"
-      },
-      "global": true,
-      "facet_filter": {
-        "fquery": {
-          "query": {
-            "filtered": {
-              "query": {
-                "query_string": {
-                  "query": "*"
-                }
-              },
-              "filter": {
-                "bool": {
-                  "must": [
-                    {
-                      "range": {
-                        "@timestamp": {
-                          "from": {{ from_date }},
-                          "to": "now"
-                        }
-                      }
-                    }
-                  ]
-                }
-              }
-            }
-          }
-        }
-      }
-    }
-  {% endif %}
-  },
-  "size": 0
-}
-"""
 
-if settings.ELASTICSEARCH_2X:
-    STATS_QUERY = """
-{
-  "size": 0,
-  "aggs": {
-    "date": {
-      "date_histogram": {
-        "field": "@timestamp",
-        "interval": "{{ interval }}",
-        "time_zone": "Europe/Berlin",
-        "min_doc_count": 0
-      },
-      "aggs": {
-        "stat": {
-          "avg": {
-            "field": "{{ value }}"
-          }
-        }
-      }
-    }
-  },
-  "query": {
-    "filtered": {
-      "query": {
-        "query_string": {
-      {% if hosts %}
-          {% for host in hosts %}
-          "query": "host.raw:{{ host }}",
-          {% endfor %}
-      {% else %}
-          "query": "tags:metric",
-      {% endif %}
-          "analyze_wildcard": false
-        }
-      },
-      "filter": {
-        "bool": {
-          "must": [
-            {
-              "range": {
-                  "@timestamp": {
-                    "from": {{ from_date }},
-                    "to": "now"
-                  }
-              }
-            }
-          ]
-        }
-      }
-    }
-  }
-}
-    """
+URL = "/%s/_search?ignore_unavailable=true"
+MSEARCH_URL = "/_msearch"
 
-RULES_PER_CATEGORY = """
-{
-  "size": 0,
-  "aggs": {
-    "category": {
-      "terms": {
-        "field": "alert.category.raw",
-        "size": 50,
-        "order": {
-          "_count": "desc"
-        }
-      },
-      "aggs": {
-        "rule": {
-          "terms": {
-            "field": "alert.signature_id",
-            "size": 50,
-            "order": {
-              "_count": "desc"
-            }
-          }, 
-          "aggs": {
-            "rule_info": {
-              "terms": {
-                "field": "alert.signature.raw",
-                "size": 1,
-                "order": {
-                  "_count": "desc"
-                }
-              }
-            }
-          }
-        }
-      }
-    }
-  },
-  "query": {
-    "filtered": {
-      "query": {
-        "query_string": {
-          "query": "event_type:alert AND host.raw:{{ hosts }} {{ query_filter|safe }}",
-          "analyze_wildcard": true
-        }
-      },
-      "filter": {
-        "bool": {
-          "must": [
-            {
-              "range": {
-                "@timestamp": {
-                  "gte": {{ from_date }}
-                }
-              }
-            }
-          ],
-          "must_not": []
-        }
-      }
-    }
-  }
-}
-"""
+DASHBOARDS_QUERY_URL = "/%s/dashboard/_search?size=" % (settings.KIBANA_INDEX)
 
-ALERTS_COUNT_PER_HOST = """
-{
-  "size": 0,
-  "query": {
-    "filtered": {
-      "query": {
-        "query_string": {
-          "query": "event_type:alert AND host.raw:{{ hosts }} {{ query_filter|safe }}",
-          "analyze_wildcard": true
-        }
-      },
-      "filter": {
-        "bool": {
-          "must": [
-            {
-              "range": {
-                "@timestamp": {
-                  "gte": {{ from_date }}
-                }
-              }
-            }
-          ],
-          "must_not": []
-        }
-      }
-    }
-  },
-  "aggs": {}
-}
-"""
+HEALTH_URL = "/_cluster/health"
+STATS_URL = "/_cluster/stats"
 
-ALERTS_TREND_PER_HOST = """
-{
-  "size": 0,
-  "aggs": {
-    "trend": {
-      "date_range": {
-        "field": "@timestamp",
-        "ranges": [
-          {
-            "from": {{ start_date }},
-            "to": {{ from_date }}
-          },
-          {
-            "from": {{ from_date }}
-          }
-        ]
-      }
-    }
-  },
-  "query": {
-    "filtered": {
-      "query": {
-        "query_string": {
-          "query": "event_type:alert AND host.raw:{{ hosts }} {{ query_filter|safe }}",
-          "analyze_wildcard": true
-        }
-      },
-      "filter": {
-        "bool": {
-          "must": [
-            {
-              "range": {
-                "@timestamp": {
-                  "gte": {{ start_date }}
-                }
-              }
-            }
-          ],
-          "must_not": []
-        }
-      }
-    }
-  }
-}
-"""
+INDICES_STATS_URL = "/_stats/docs"
+CAT_INDICES_URL = "/_cat/indices/%s*?h=index"
+MAX_INDEXES_LENGTH = 3000
 
-LATEST_STATS_ENTRY = """
-{
-  "size": 1,
-  "sort": [
-    {
-      "@timestamp": {
-        "order": "desc",
-        "unmapped_type": "boolean"
-      }
-    }
-  ],
-  "query": {
-    "filtered": {
-      "query": {
-        "query_string": {
-          "query": "event_type:stats AND host.raw:{{ hosts }} {{ query_filter|safe }}",
-          "analyze_wildcard": true
-        }
-      },
-      "filter": {
-        "bool": {
-          "must": [
-            {
-              "range": {
-                "@timestamp": {
-                  "gte": {{ from_date }}
-                }
-              }
-            }
-          ],
-          "must_not": []
-        }
-      }
-    }
-  },
-  "fields": [
-    "_source"
-  ],
-    "fielddata_fields": [
-    "@timestamp",
-    "flow.start",
-    "timestamp",
-    "flow.end"
-  ]
-}
-"""
+SCROLL_URL = "/_search/scroll"
+SCROLL_TIMEOUT = "5m"
+BULK_URL = "/_bulk"
 
-DASHBOARDS_QUERY_URL = "http://%s/%s/dashboard/_search?size=" % (settings.ELASTICSEARCH_ADDRESS, settings.KIBANA_INDEX)
+from elasticsearch import TransportError, ConnectionError
 
-HEALTH_URL = "http://%s/_cluster/health" % settings.ELASTICSEARCH_ADDRESS
-STATS_URL = "http://%s/_cluster/stats" % settings.ELASTICSEARCH_ADDRESS
-
-INDICES_STATS_URL = "http://%s/_stats/docs" % settings.ELASTICSEARCH_ADDRESS
-
-DELETE_ALERTS_URL = "http://%s/%s/_query?q=alert.signature_id:%d"
-
-from rules.models import Rule
+from rules.es_data import es_request
+from rules.es_query import *
+from rules.es_cache import es_cache, cached, get_ttl, freeze, round_date
+from rules.models import sid_map
+from rules import rollup
 from rules.tables import ExtendedRuleTable, RuleStatsTable
 import django_tables2 as tables
 
+def get_es_indices(base_index):
+    # set of existing indices names starting with base_index, None if
+    # the list is not available
+    def fetch():
+        try:
+            data = es_request('GET', CAT_INDICES_URL % (base_index))
+        except (TransportError, ConnectionError):
+            return None
+        return set(data.split())
+    return es_cache.get(('indices', base_index), get_ttl('indices'), fetch)
+
+def next_month(date):
+    if date.month == 12:
+        return date.replace(year = date.year + 1, month = 1)
+    return date.replace(month = date.month + 1)
+
 def build_es_timestamping(date, data = 'alert'):
     format_table = { 'daily': '%Y.%m.%d', 'hourly': '%Y.%m.%d.%H' }
+    timestamping = settings.ELASTICSEARCH_LOGSTASH_TIMESTAMPING
     now = datetime.now()
-    if settings.ELASTICSEARCH_LOGSTASH_TIMESTAMPING == 'daily':
+    if timestamping == 'daily':
         end = now + timedelta(days=1)
-    elif settings.ELASTICSEARCH_LOGSTASH_TIMESTAMPING == 'hourly':
+    elif timestamping == 'hourly':
         end = now + timedelta(hours=1)
     if data == 'alert':
         base_index = settings.ELASTICSEARCH_LOGSTASH_ALERT_INDEX
     else:
         base_index = settings.ELASTICSEARCH_LOGSTASH_INDEX
+    # index of the current period may have been created after the list of
+    # existing indices was cached, a missing index is ignored by queries
+    current = "%s%s" % (base_index, now.strftime(format_table[timestamping]))
     try:
+        existing = get_es_indices(base_index)
+        def exists(prefix):
+            if existing == None or current.startswith(prefix):
+                return True
+            return any([ name.startswith(prefix) for name in existing ])
+        # months and days completely in the time range are matched with a
+        # wildcard, other indices are listed if they exist
         indexes = []
+        if timestamping == 'daily':
+            date = date.replace(hour = 0, minute = 0, second = 0, microsecond = 0)
+        else:
+            date = date.replace(minute = 0, second = 0, microsecond = 0)
         while date < end:
-            indexes.append("%s%s" % (base_index, date.strftime(format_table[settings.ELASTICSEARCH_LOGSTASH_TIMESTAMPING])))
-            if settings.ELASTICSEARCH_LOGSTASH_TIMESTAMPING == 'daily':
-                date += timedelta(days=1)
-            elif settings.ELASTICSEARCH_LOGSTASH_TIMESTAMPING == 'hourly':
-                date += timedelta(hours=1)
-        if len(indexes) > 20:
+            if date.day == 1 and date.hour == 0 and next_month(date) <= end:
+                prefix = "%s%s." % (base_index, date.strftime('%Y.%m'))
+                step = next_month(date)
+            elif timestamping == 'hourly' and date.hour == 0 and date + timedelta(days=1) <= end:
+                prefix = "%s%s." % (base_index, date.strftime('%Y.%m.%d'))
+                step = date + timedelta(days=1)
+            else:
+                prefix = None
+                name = "%s%s" % (base_index, date.strftime(format_table[timestamping]))
+                if existing == None or name in existing or name == current:
+                    indexes.append(name)
+                if timestamping == 'daily':
+                    date += timedelta(days=1)
+                elif timestamping == 'hourly':
+                    date += timedelta(hours=1)
+            if prefix != None:
+                if exists(prefix):
+                    indexes.append(prefix + '*')
+                date = step
+        if len(indexes) == 0:
+            # no index in time range, query the one of the current period
+            return current
+        indexes = ','.join(indexes)
+        # stay under the size limit of the HTTP request line
+        if len(indexes) > MAX_INDEXES_LENGTH:
             return base_index + '*'
-        return ','.join(indexes)
+        return indexes
     except:
         return base_index + '*'
 
-def get_es_url(from_date, data = 'alert'):
+def get_es_index(from_date, data = 'alert'):
     if (data == 'alert' and '*' in settings.ELASTICSEARCH_LOGSTASH_ALERT_INDEX) or (data != 'alert' and '*' in settings.ELASTICSEARCH_LOGSTASH_INDEX):
             if data == 'alert':
                 indexes = settings.ELASTICSEARCH_LOGSTASH_ALERT_INDEX
@@ -685,74 +140,73 @@ def get_es_url(from_date, data = 'alert'):
         else:
             start = datetime.fromtimestamp(int(from_date)/1000)
             indexes = build_es_timestamping(start, data = data)
-    return URL % (settings.ELASTICSEARCH_ADDRESS, indexes)
+    return indexes
 
-def es_get_rules_stats(request, hostname, count=20, from_date=0 , qfilter = None):
-    templ = Template(TOP_QUERY)
-    context = Context({'appliance_hostname': hostname, 'count': count, 'from_date': from_date, 'field': 'alert.signature_id'})
-    if qfilter != None:
-        query_filter = " AND " + qfilter
-        context['query_filter'] = re.sub('"','\\"', query_filter)
-    data = templ.render(context)
-    es_url = get_es_url(from_date)
-    req = urllib2.Request(es_url, data)
-    try:
-        out = urllib2.urlopen(req)
-    except:
-        return None
-    data = out.read()
-    # returned data is JSON
-    data = json.loads(data)
-    # total number of results
+def get_es_url(from_date, data = 'alert'):
+    return URL % (get_es_index(from_date, data = data))
+
+# Dashboard panels are split in a build function returning the index, the
+# query body and the arguments of the parse function which converts the
+# answer of Elasticsearch. This allows to send them alone or grouped in a
+# single _msearch request.
+
+def build_rules_stats(hostname, count=20, from_date=0, qfilter = None):
+    body = top_query('alert.signature_id', hostname, count, from_date, qfilter)
+    return (get_es_index(from_date), body, {})
+
+def parse_rules_stats(data):
+    # return list of (sid, hits)
     try:
         if settings.ELASTICSEARCH_2X:
-            data = data['aggregations']['table']['buckets']
+            return [ (elt['key'], elt['doc_count']) for elt in data['aggregations']['table']['buckets'] ]
         else:
-            data = data['facets']['table']['terms']
+            return [ (elt['term'], elt['count']) for elt in data['facets']['table']['terms'] ]
     except:
-        rules = ExtendedRuleTable([])
-        tables.RequestConfig(request).configure(rules)
-        return rules
-    rules = []
-    if data != None:
-        for elt in data:
-            try:
-                if settings.ELASTICSEARCH_2X:
-                    sid=elt['key']
-                else:
-                    sid=elt['term']
-                rule = Rule.objects.get(sid=sid)
-            except:
-                print "Can not find rule with sid " + str(sid)
-                continue
-            if settings.ELASTICSEARCH_2X:
-                rule.hits = elt['doc_count']
-            else:
-                rule.hits = elt['count']
-            rules.append(rule)
-        rules = ExtendedRuleTable(rules)
-        tables.RequestConfig(request).configure(rules)
-    else:
-        rules = ExtendedRuleTable([])
-        tables.RequestConfig(request).configure(rules)
+        return None
+
+def rules_stats_table(request, hits):
+    counts = dict([ (int(sid), count) for (sid, count) in hits ])
+    rules = sid_map.get_rules([ int(sid) for (sid, count) in hits ])
+    for rule in rules:
+        rule.hits = counts[rule.sid]
+    if len(rules) != len(counts):
+        print "Can not find rules with sids " + ", ".join([ str(sid) for sid in set(counts.keys()) - set([ rule.sid for rule in rules ]) ])
+    rules = ExtendedRuleTable(rules)
+    tables.RequestConfig(request).configure(rules)
     return rules
 
+def rollup_rules_stats(hostname, count=20, from_date=0, qfilter = None):
+    end = rollup.to_millis(rollup.rollup_end(from_date))
+    hits = rollup.rollup_hits(from_date, hostname)
+    # alerts after the rolled up hours
+    (es_index, body, extra) = build_rules_stats(hostname, count * 2, end)
+    data = es_search(es_index, body)
+    if data == None:
+        return None
+    recent = parse_rules_stats(data)
+    if recent == None:
+        return None
+    for (sid, hit) in recent:
+        hits[sid] = hits.get(sid, 0) + hit
+    return sorted(hits.items(), key = lambda hit: hit[1], reverse = True)[:count]
+
+def es_get_rules_stats(request, hostname, count=20, from_date=0 , qfilter = None):
+    try:
+        hits = es_panel('rules', hostname = hostname, count = count, from_date = from_date, qfilter = qfilter)
+    except:
+        return None
+    if hits == None:
+        return None
+    return rules_stats_table(request, hits)
+
 def es_get_field_stats(request, field, FieldTable, hostname, key='host', count=20, from_date=0 , qfilter = None):
-    templ = Template(TOP_QUERY)
-    context = Context({'appliance_hostname': hostname, 'count': count, 'from_date': from_date, 'field': field})
-    if qfilter != None:
-        query_filter = " AND " + qfilter
-        context['query_filter'] = re.sub('"','\\"', query_filter)
-    data = templ.render(context)
+    from_date = round_date(from_date)
+    data = top_query(field, hostname, count, from_date, qfilter)
     es_url = get_es_url(from_date)
-    req = urllib2.Request(es_url, data)
     try:
-        out = urllib2.urlopen(req)
+        data = cached('field_stats', (field, hostname, count, from_date, qfilter), lambda: es_request('POST', es_url, body = data))
     except:
         return None
-    data = out.read()
-    # returned data is JSON
-    data = json.loads(data)
     # total number of results
     try:
         if settings.ELASTICSEARCH_2X:
@@ -779,18 +233,13 @@ def es_get_field_stats(request, field, FieldTable, hostname, key='host', count=2
     return objects
 
 def es_get_sid_by_hosts(request, sid, count=20, from_date=0):
-    templ = Template(SID_BY_HOST_QUERY)
-    context = Context({'rule_sid': sid, 'alerts_number': count, 'from_date': from_date})
-    data = templ.render(context)
+    from_date = round_date(from_date)
+    data = sid_by_host_query(sid, count, from_date)
     es_url = get_es_url(from_date)
-    req = urllib2.Request(es_url, data)
     try:
-        out = urllib2.urlopen(req)
+        data = cached('sid_by_hosts', (sid, count, from_date), lambda: es_request('POST', es_url, body = data))
     except:
         return None
-    data = out.read()
-    # returned data is JSON
-    data = json.loads(data)
     # total number of results
     try:
         if settings.ELASTICSEARCH_2X:
@@ -814,14 +263,10 @@ def es_get_sid_by_hosts(request, sid, count=20, from_date=0):
     return stats
 
 def es_get_dashboard(count=20):
-    req = urllib2.Request(DASHBOARDS_QUERY_URL + str(count))
     try:
-        out = urllib2.urlopen(req)
+        data = es_request('GET', DASHBOARDS_QUERY_URL + str(count))
     except:
         return None
-    data = out.read()
-    # returned data is JSON
-    data = json.loads(data)
     # total number of results
     try:
         data = data['hits']['hits']
@@ -838,94 +283,173 @@ def es_get_dashboard(count=20):
         return dashboards
     return None
 
-def es_get_timeline(from_date=0, interval=None, hosts = None, qfilter = None):
-    templ = Template(TIMELINE_QUERY)
+def build_timeline(from_date=0, interval=None, hosts = None, qfilter = None):
     # 100 points on graph per default
     if interval == None:
         interval = int((time() - (int(from_date) / 1000)) / 100)
-    context = Context({'from_date': from_date, 'interval': str(interval) + "s", 'hosts': hosts})
-    if qfilter != None:
-        query_filter = " AND " + qfilter
-        context['query_filter'] = re.sub('"','\\"', query_filter)
-    data = templ.render(context)
-    es_url = get_es_url(from_date)
-    req = urllib2.Request(es_url, data)
-    try:
-        out = urllib2.urlopen(req)
-    except:
+    shards = timeline_shards(hosts)
+    if shards:
+        # one query per shard of hosts, sent together in a _msearch
+        body = [ timeline_query(from_date, str(interval) + "s", hosts, qfilter, shard = shard) for shard in shards ]
+    else:
+        body = timeline_query(from_date, str(interval) + "s", hosts, qfilter)
+    return (get_es_index(from_date), body, {'from_date': from_date, 'interval': interval})
+
+def timeline_shards(hosts):
+    # split explicit list of hosts in shards, None to get the most active hosts
+    if not settings.ELASTICSEARCH_2X or not hosts or '*' in hosts:
         return None
-    data = out.read()
-    # returned data is JSON
-    data = json.loads(data)
-    # total number of results
+    size = settings.ELASTICSEARCH_TIMELINE_SHARD_SIZE
+    return [ hosts[i:i + size] for i in range(0, len(hosts), size) ]
+
+def timeline_columns(responses):
+    # merge date histograms of the responses in a time axis and a list of
+    # counts per host along this axis
+    times = set()
+    for response in responses:
+        times.update([ elt['key'] for elt in response['aggregations']['date']['buckets'] ])
+    times = sorted(times)
+    position = dict([ (date, i) for (i, date) in enumerate(times) ])
+    counts = {}
+    for response in responses:
+        for elt in response['aggregations']['date']['buckets']:
+            i = position[elt['key']]
+            for host in elt['host']['buckets']:
+                if not counts.has_key(host['key']):
+                    counts[host['key']] = [0] * len(times)
+                counts[host['key']][i] = host['doc_count']
+    return (times, counts)
+
+def facets_columns(facets, field):
+    # same as timeline_columns for the date histogram facets of
+    # Elasticsearch 1.x, with None where a host has no value
+    times = sorted(set([ entry['time'] for host in facets for entry in facets[host]['entries'] ]))
+    position = dict([ (date, i) for (i, date) in enumerate(times) ])
+    values = {}
+    for host in facets:
+        values[host] = [None] * len(times)
+        for entry in facets[host]['entries']:
+            values[host][position[entry['time']]] = entry.get(field)
+    return (times, values)
+
+def columns_timeline(times, values, from_date, interval):
+    # timeline in columns format: a shared time axis and a list of values
+    # per host along this axis, interval is in milliseconds
+    return { 'format': 'columns', 'from_date': from_date, 'interval': interval,
+             'times': times, 'values': values }
+
+def parse_timeline(data, from_date, interval):
     try:
         if settings.ELASTICSEARCH_2X:
-            data = data['aggregations']["date"]['buckets']
-            rdata = {}
-            for elt in data:
-                date = elt['key']
-                for host in elt["host"]['buckets']:
-                    if not rdata.has_key(host["key"]):
-                        rdata[host["key"]] = { 'entries': [ { "time": date, "count": host["doc_count"] } ] }
-                    else:
-                        rdata[host["key"]]['entries'].append({ "time": date, "count": host["doc_count"] })
-            data = rdata
+            if not isinstance(data, list):
+                data = [data]
+            (times, counts) = timeline_columns(data)
         else:
-            data = data['facets']
+            (times, counts) = facets_columns(data['facets'], 'count')
     except:
+        # failed panels must not be cached
+        return None
+    if len(counts) == 0:
         return {}
-    if data != {}:
-        data['from_date'] = from_date
-        data['interval'] = int(interval) * 1000
-    return data
+    return columns_timeline(times, counts, from_date, int(interval) * 1000)
 
-def es_get_metrics_timeline(from_date=0, interval=None, value = "eve.total.rate_1m", hosts = None):
-    templ = Template(STATS_QUERY)
-    # 100 points on graph per default
+def rollup_timeline(from_date=0, interval=None, hosts = None, qfilter = None):
     if interval == None:
-        interval = int((time() - (int(from_date)/ 1000)) / 100)
-    context = Context({'from_date': from_date, 'interval': str(interval) + "s", 'value': value, 'hosts': hosts})
-    data = templ.render(context)
-    es_url = get_es_url(from_date, data = 'stats')
-    req = urllib2.Request(es_url, data)
+        interval = int((time() - (int(from_date) / 1000)) / 100)
+    interval_ms = int(interval) * 1000
+    end = rollup.to_millis(rollup.rollup_end(from_date))
+    # rolled up and recent alerts must be restricted to the same hosts
+    explicit = None
+    if hosts and not '*' in hosts:
+        explicit = hosts
+    counts = rollup.rollup_timeline(from_date, hosts = explicit)
+    # alerts after the rolled up hours, per hour as rolled up ones
+    (es_index, body, extra) = build_timeline(end, 3600, hosts)
+    data = es_search(es_index, body)
+    if data == None:
+        return None
+    tail = parse_timeline(data, **extra)
+    if tail == None:
+        return None
+    for host in tail.get('values', {}):
+        counts.extend([ (host, date, count) for (date, count) in zip(tail['times'], tail['values'][host]) ])
+    buckets = {}
+    for (host, date, count) in counts:
+        if not buckets.has_key(host):
+            buckets[host] = {}
+        bucket = date - date % interval_ms
+        buckets[host][bucket] = buckets[host].get(bucket, 0) + count
+    if len(buckets) == 0:
+        return {}
+    if explicit:
+        # every requested host is kept, even without alerts
+        hosts = explicit
+    else:
+        # keep most active hosts as the timeline query does
+        hosts = sorted(buckets.keys(), key = lambda host: sum(buckets[host].values()), reverse = True)[:5]
+    first = int(from_date) - int(from_date) % interval_ms
+    times = range(first, int(time() * 1000) + 1, interval_ms)
+    values = {}
+    for host in hosts:
+        host_buckets = buckets.get(host, {})
+        values[host] = [ host_buckets.get(date, 0) for date in times ]
+    return columns_timeline(times, values, from_date, interval_ms)
+
+def es_get_timeline(from_date=0, interval=None, hosts = None, qfilter = None):
     try:
-        out = urllib2.urlopen(req)
+        return es_panel('timeline', from_date = from_date, interval = interval, hosts = hosts, qfilter = qfilter)
     except:
         return None
-    data = out.read()
-    # returned data is JSON
-    data = json.loads(data)
-    # total number of results
+
+def timeline_entries(data, field):
+    """
+    Convert a timeline in columns format to the format with a list of
+    entries per host, each entry having the time and the value in field.
+    Points without value are skipped.
+    """
+    if not isinstance(data, dict) or data.get('format', None) != 'columns':
+        return data
+    rdata = { 'from_date': data['from_date'], 'interval': data['interval'] }
+    times = data['times']
+    for (host, values) in data['values'].iteritems():
+        rdata[host] = { 'entries': [ { 'time': date, field: value } for (date, value) in zip(times, values) if value != None ] }
+    return rdata
+
+def build_metrics_timeline(from_date=0, interval=None, value = "eve.total.rate_1m", hosts = None):
+    # 100 points on graph per default
+    if interval == None:
+        interval = int((time() - (int(from_date)/ 1000)) / 100)
+    body = stats_query(from_date, str(interval) + "s", value, hosts)
+    return (get_es_index(from_date, data = 'stats'), body,
+            {'from_date': from_date, 'interval': interval, 'hosts': hosts})
+
+def parse_metrics_timeline(data, from_date, interval, hosts):
     if hosts == None:
         hosts = ["global"]
     try:
         if settings.ELASTICSEARCH_2X:
-            data = data['aggregations']["date"]['buckets']
-            rdata = {}
-            for elt in data:
-                date = elt['key']
-                if not rdata.has_key(hosts[0]):
-                    rdata[hosts[0]] = { 'entries': [ { "time": date, "mean": elt["stat"]["value"] } ] }
-                else:
-                    rdata[hosts[0]]['entries'].append({ "time": date, "mean": elt["stat"]["value"] })
-            data = rdata
+            buckets = data['aggregations']["date"]['buckets']
+            times = [ elt['key'] for elt in buckets ]
+            means = {}
+            if len(buckets):
+                means[hosts[0]] = [ elt["stat"]["value"] for elt in buckets ]
         else:
-            data = data['facets']
+            (times, means) = facets_columns(data['facets'], 'mean')
     except:
-        return {}
-    data['from_date'] = from_date
-    data['interval'] = int(interval) * 1000
-    return data
+        return None
+    return columns_timeline(times, means, from_date, int(interval) * 1000)
+
+def es_get_metrics_timeline(from_date=0, interval=None, value = "eve.total.rate_1m", hosts = None):
+    try:
+        return es_panel('metrics_timeline', from_date = from_date, interval = interval, value = value, hosts = hosts)
+    except:
+        return None
 
 def es_get_json(uri):
-    req = urllib2.Request(uri)
     try:
-        out = urllib2.urlopen(req)
+        data = es_request('GET', uri)
     except:
         return None
-    data = out.read()
-    # returned data is JSON
-    data = json.loads(data)
     return data
 
 def es_get_health():
@@ -957,22 +481,11 @@ def compact_tree(tree):
         cdata.append(data)
     return cdata
 
-def es_get_rules_per_category(from_date=0, hosts = None, qfilter = None):
-    templ = Template(RULES_PER_CATEGORY)
-    context = Context({'from_date': from_date, 'hosts': hosts[0]})
-    if qfilter != None:
-        query_filter = " AND " + qfilter
-        context['query_filter'] = query_filter
-    data = templ.render(context)
-    es_url = get_es_url(from_date)
-    req = urllib2.Request(es_url, data)
-    try:
-        out = urllib2.urlopen(req)
-    except:
-        return None
-    data = out.read()
-    # returned data is JSON
-    data = json.loads(data)
+def build_rules_per_category(from_date=0, hosts = None, qfilter = None):
+    body = rules_per_category_query(from_date, hosts[0], qfilter)
+    return (get_es_index(from_date), body, {})
+
+def parse_rules_per_category(data):
     # clean the data: we need to compact the leaf and previous data
     if data["hits"]["total"] > 0:
         cdata = compact_tree(data["aggregations"]["category"]["buckets"])
@@ -983,62 +496,226 @@ def es_get_rules_per_category(from_date=0, hosts = None, qfilter = None):
     rdata["children"] = cdata
     return rdata
 
-def es_delete_alerts_by_sid(sid):
-    delete_url = DELETE_ALERTS_URL % (settings.ELASTICSEARCH_ADDRESS, settings.ELASTICSEARCH_LOGSTASH_ALERT_INDEX + "*", int(sid))
-    r = requests.delete(delete_url)
-    data = json.loads(r.text)
-    return data
+def es_get_rules_per_category(from_date=0, hosts = None, qfilter = None):
+    try:
+        return es_panel('rules_per_category', from_date = from_date, hosts = hosts, qfilter = qfilter)
+    except:
+        return None
 
-def es_get_alerts_count(from_date=0, hosts = None, qfilter = None, prev = 0):
-    if prev:
-        templ = Template(ALERTS_TREND_PER_HOST)
-    else:
-        templ = Template(ALERTS_COUNT_PER_HOST)
-    context = Context({'from_date': from_date, 'hosts': hosts[0]})
-    if qfilter != None:
-        query_filter = " AND " + qfilter
-        context['query_filter'] = query_filter
+def es_get_alerts_rollup(start, end):
+    # return (host, sid, count) of alerts between the start and end
+    # datetimes, alerts of signatures beyond the terms limit of a host
+    # are counted with rollup.OTHER_SID so host totals stay exact
+    (start, end) = (rollup.to_millis(start), rollup.to_millis(end))
+    body = rollup_query(start, end, settings.ELASTICSEARCH_ROLLUP_TERMS)
+    data = es_request('POST', get_es_url(start), body = body)
+    rows = []
+    for host in data['aggregations']['host']['buckets']:
+        for sid in host['sid']['buckets']:
+            rows.append((host['key'], sid['key'], sid['doc_count']))
+        other = host['sid'].get('sum_other_doc_count', 0)
+        if other:
+            rows.append((host['key'], rollup.OTHER_SID, other))
+    return rows
+
+def es_delete_alerts_by_sid(sid, progress = None):
+    """
+    Delete alerts of a signature by batches read with a scroll search and
+    deleted with bulk requests, at most ELASTICSEARCH_DELETE_RATE alerts
+    per second. progress is called with the percentage of deleted alerts
+    and a message after each batch.
+    """
+    index = settings.ELASTICSEARCH_LOGSTASH_ALERT_INDEX + "*"
+    body = delete_by_sid_query(int(sid), settings.ELASTICSEARCH_DELETE_BATCH)
+    # the transport adds params to the url, it must not have a query string
+    data = es_request('POST', '/%s/_search' % (index), body = body,
+                      params = {'scroll': SCROLL_TIMEOUT, 'ignore_unavailable': 'true'})
+    total = data['hits']['total']
+    deleted = 0
+    failed = 0
+    try:
+        while len(data['hits']['hits']):
+            start = time()
+            actions = [ json.dumps({ 'delete': { '_index': hit['_index'], '_type': hit['_type'], '_id': hit['_id'] } })
+                        for hit in data['hits']['hits'] ]
+            result = es_request('POST', BULK_URL, body = '\n'.join(actions) + '\n')
+            for item in result['items']:
+                if item['delete'].get('status', 200) < 300:
+                    deleted += 1
+                else:
+                    failed += 1
+            if progress:
+                progress(min(99, (deleted + failed) * 100 / max(total, 1)), "%d of %d alerts deleted" % (deleted, total))
+            # throttle to not slow down ingestion
+            delay = float(len(actions)) / settings.ELASTICSEARCH_DELETE_RATE - (time() - start)
+            if delay > 0:
+                sleep(delay)
+            data = es_request('POST', SCROLL_URL, body = data['_scroll_id'], params = {'scroll': SCROLL_TIMEOUT})
+    finally:
+        try:
+            es_request('DELETE', SCROLL_URL, body = data['_scroll_id'])
+        except (TransportError, ConnectionError, KeyError):
+            pass
+        # cached dashboards may contain deleted alerts
+        es_cache.clear()
+    return { 'total': total, 'deleted': deleted, 'failed': failed }
+
+def build_alerts_count(from_date=0, hosts = None, qfilter = None, prev = 0):
     if prev:
         # compute delta with now and from_date
         from_datetime = datetime.fromtimestamp(int(from_date)/1000)
         start_datetime = from_datetime - (datetime.now() - from_datetime)
         start_date = int(mktime(start_datetime.timetuple()) * 1000)
-        context['start_date'] = start_date
-        es_url = get_es_url(start_date)
-    else:
-        es_url = get_es_url(from_date)
-    data = templ.render(context)
-    req = urllib2.Request(es_url, data)
-    try:
-        out = urllib2.urlopen(req)
-    except Exception, e:
-        return "BAM: " + str(e)
-    data = out.read()
-    # returned data is JSON
-    data = json.loads(data)
+        return (get_es_index(start_date), alerts_trend_query(start_date, from_date, hosts[0], qfilter), {'prev': prev})
+    return (get_es_index(from_date), alerts_count_query(from_date, hosts[0], qfilter), {'prev': prev})
+
+def parse_alerts_count(data, prev):
     if prev:
         countsdata = data["aggregations"]["trend"]["buckets"]
         return {"prev_doc_count": countsdata[0]["doc_count"], "doc_count": countsdata[1]["doc_count"]}
     else:
         return {"doc_count": data["hits"]["total"] };
 
-def es_get_latest_stats(from_date=0, hosts = None, qfilter = None):
-    templ = Template(LATEST_STATS_ENTRY)
-    context = Context({'from_date': from_date, 'hosts': hosts[0]})
-    if qfilter != None:
-        query_filter = " AND " + qfilter
-        context['query_filter'] = query_filter
-    data = templ.render(context)
-    es_url = get_es_url(from_date, data = 'stats')
-    req = urllib2.Request(es_url, data)
+def es_get_alerts_count(from_date=0, hosts = None, qfilter = None, prev = 0):
     try:
-        out = urllib2.urlopen(req)
-    except Exception, e:
+        return es_panel('alerts_count', from_date = from_date, hosts = hosts, qfilter = qfilter, prev = prev)
+    except (TransportError, ConnectionError), e:
         return "BAM: " + str(e)
-    data = out.read()
-    # returned data is JSON
-    data = json.loads(data)
+
+def build_latest_stats(from_date=0, hosts = None, qfilter = None):
+    body = latest_stats_query(from_date, hosts[0], qfilter)
+    return (get_es_index(from_date, data = 'stats'), body, {})
+
+def parse_latest_stats(data):
     try:
         return data['hits']['hits'][0]['_source']
     except:
         return None
+
+def es_get_latest_stats(from_date=0, hosts = None, qfilter = None):
+    try:
+        return es_panel('latest_stats', from_date = from_date, hosts = hosts, qfilter = qfilter)
+    except (TransportError, ConnectionError), e:
+        return "BAM: " + str(e)
+
+# panel name -> (build function, parse function), panel names are also
+# the query types used for caching
+ES_PANELS = {
+    'rules': (build_rules_stats, parse_rules_stats),
+    'timeline': (build_timeline, parse_timeline),
+    'metrics_timeline': (build_metrics_timeline, parse_metrics_timeline),
+    'rules_per_category': (build_rules_per_category, parse_rules_per_category),
+    'alerts_count': (build_alerts_count, parse_alerts_count),
+    'latest_stats': (build_latest_stats, parse_latest_stats),
+}
+
+# panels which can be answered from rolled up alerts on long time ranges
+ROLLUP_PANELS = {
+    'rules': rollup_rules_stats,
+    'timeline': rollup_timeline,
+}
+
+def use_rollup(name, kwargs):
+    # rolled up alerts can't be filtered
+    if not ROLLUP_PANELS.has_key(name) or kwargs.get('qfilter', None) != None:
+        return False
+    return rollup.rollup_end(kwargs.get('from_date', 0)) != None
+
+def panel_key(name, kwargs):
+    if kwargs.has_key('from_date'):
+        kwargs['from_date'] = round_date(kwargs['from_date'])
+    return (name,) + tuple(sorted([ (arg, freeze(kwargs[arg])) for arg in kwargs ]))
+
+def msearch_lines(es_index, bodies):
+    lines = []
+    for body in bodies:
+        lines.append(json.dumps({'index': es_index, 'ignore_unavailable': True}))
+        lines.append(json.dumps(body))
+    return lines
+
+def failed_response(response):
+    # answers of failed queries and answers missing the alerts of failed
+    # shards must not be used or cached
+    return response.has_key('error') or response.get('_shards', {}).get('failed', 0) > 0
+
+def es_search(es_index, body):
+    # body is a query or a list of queries sent in a single _msearch,
+    # return None if any of them has failed
+    if isinstance(body, list):
+        data = es_request('POST', MSEARCH_URL, body = '\n'.join(msearch_lines(es_index, body)) + '\n')
+        responses = data['responses']
+        if any([ failed_response(response) for response in responses ]):
+            return None
+        return responses
+    data = es_request('POST', URL % (es_index), body = body)
+    if failed_response(data):
+        return None
+    return data
+
+def es_panel(name, **kwargs):
+    (build, parse) = ES_PANELS[name]
+    key = panel_key(name, kwargs)
+    def compute():
+        if use_rollup(name, kwargs):
+            return ROLLUP_PANELS[name](**kwargs)
+        (es_index, body, extra) = build(**kwargs)
+        data = es_search(es_index, body)
+        if data == None:
+            # failed panels are not cached
+            return None
+        return parse(data, **extra)
+    return es_cache.get(key, get_ttl(name), compute)
+
+def es_msearch(panels):
+    """
+    Get the data of a list of (panel name, arguments) with a single
+    _msearch request for the panels not in cache. Result is the list
+    of panel data, None for the panels that have failed.
+    """
+    results = [None] * len(panels)
+    pending = []
+    lines = []
+    for (index, (name, kwargs)) in enumerate(panels):
+        kwargs = dict(kwargs)
+        if use_rollup(name, kwargs):
+            try:
+                results[index] = es_panel(name, **kwargs)
+            except (TransportError, ConnectionError):
+                pass
+            continue
+        key = panel_key(name, kwargs)
+        ttl = get_ttl(name)
+        entry = es_cache.peek(key)
+        if ttl > 0 and entry != None:
+            results[index] = entry
+            continue
+        (build, parse) = ES_PANELS[name]
+        (es_index, body, extra) = build(**kwargs)
+        if isinstance(body, list):
+            lines.extend(msearch_lines(es_index, body))
+            pending.append((index, key, ttl, parse, extra, len(body)))
+        else:
+            lines.extend(msearch_lines(es_index, [body]))
+            pending.append((index, key, ttl, parse, extra, None))
+    if len(pending) == 0:
+        return results
+    data = es_request('POST', MSEARCH_URL, body = '\n'.join(lines) + '\n')
+    responses = data['responses']
+    for (index, key, ttl, parse, extra, count) in pending:
+        if count == None:
+            response = responses.pop(0)
+            if failed_response(response):
+                continue
+        else:
+            # panel made of several queries, incomplete if any has failed
+            response = responses[:count]
+            responses = responses[count:]
+            if any([ failed_response(elt) for elt in response ]):
+                continue
+        try:
+            results[index] = parse(response, **extra)
+        except:
+            continue
+        if ttl > 0:
+            es_cache.put(key, ttl, results[index])
+    return results
@@ -0,0 +1,235 @@
+"""
+Copyright(C) 2014, 2015 Stamus Networks
+Written by Eric Leblond <eleblond@stamus-networks.com>
+
+This file is part of Scirius.
+
+Scirius is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Scirius is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Scirius.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from django.conf import settings
+
+# Builders of Elasticsearch request bodies. They return dicts which are
+# serialized by the Elasticsearch client, so user provided values don't
+# need to be escaped. Elasticsearch 1.x queries use facets, 2.x ones use
+# aggregations.
+
+def time_range(from_date, to = True):
+    if to:
+        return { "range": { "@timestamp": { "from": from_date, "to": "now" } } }
+    return { "range": { "@timestamp": { "gte": from_date } } }
+
+def filtered_query(query, from_date, analyze_wildcard = None, to = True, must_not = False):
+    query_string = { "query": query }
+    if analyze_wildcard != None:
+        query_string["analyze_wildcard"] = analyze_wildcard
+    bool_filter = { "must": [ time_range(from_date, to = to) ] }
+    if must_not:
+        bool_filter["must_not"] = []
+    return { "filtered": { "query": { "query_string": query_string }, "filter": { "bool": bool_filter } } }
+
+def facet_filter(query, from_date):
+    return { "fquery": { "query": filtered_query(query, from_date) } }
+
+def alert_query(query, qfilter = None):
+    query = "event_type:alert AND " + query
+    if qfilter != None:
+        query += " AND " + qfilter
+    return query
+
+def top_query(field, hostname, count, from_date, qfilter = None):
+    query = alert_query("host.raw:%s" % (hostname), qfilter)
+    if settings.ELASTICSEARCH_2X:
+        return {
+            "size": 0,
+            "aggs": { "table": { "terms": { "field": field, "size": count, "order": { "_count": "desc" } } } },
+            "query": filtered_query(query, from_date, analyze_wildcard = False),
+        }
+    return {
+        "facets": {
+            "table": {
+                "terms": { "field": field, "size": count, "exclude": [] },
+                "facet_filter": { "fquery": { "query": { "filtered": {
+                    "query": { "bool": { "should": [ { "query_string": { "query": query } } ] } },
+                    "filter": { "bool": { "must": [ time_range(from_date) ] } } } } } },
+            }
+        },
+        "size": 0,
+    }
+
+def sid_by_host_query(sid, count, from_date):
+    query = alert_query("alert.signature_id:%s" % (sid))
+    if settings.ELASTICSEARCH_2X:
+        return {
+            "size": 0,
+            "aggs": { "host": { "terms": { "field": "host.raw", "size": count, "order": { "_count": "desc" } } } },
+            "query": filtered_query(query, from_date, analyze_wildcard = False),
+        }
+    return {
+        "facets": {
+            "terms": {
+                "terms": { "field": "host.raw", "size": count, "order": "count", "exclude": [] },
+                "facet_filter": { "fquery": { "query": { "filtered": {
+                    "query": { "bool": { "should": [ { "query_string": { "query": query } } ] } },
+                    "filter": { "bool": { "must": [ time_range(from_date) ] } } } } } },
+            }
+        },
+        "size": 0,
+    }
+
+def timeline_query(from_date, interval, hosts, qfilter = None, shard = None):
+    # with Elasticsearch 2.x, shard is a list of hosts to restrict the query
+    # to, the most active hosts are used otherwise
+    if settings.ELASTICSEARCH_2X:
+        query = "event_type:alert"
+        if qfilter != None:
+            query += " AND " + qfilter
+        must = [ { "range": { "@timestamp": { "gte": from_date, "lte": "now", "format": "epoch_millis" } } } ]
+        hosts_count = 5
+        if shard:
+            must.append({ "terms": { "host.raw": shard } })
+            hosts_count = len(shard)
+        return {
+            "size": 0,
+            "aggs": {
+                "date": {
+                    "date_histogram": { "field": "@timestamp", "interval": interval,
+                                        "time_zone": "Europe/Berlin", "min_doc_count": 0 },
+                    "aggs": { "host": { "terms": { "field": "host.raw", "size": hosts_count, "order": { "_count": "desc" } } } },
+                }
+            },
+            "query": {
+                "filtered": {
+                    "query": { "query_string": { "query": query, "analyze_wildcard": False } },
+                    "filter": { "bool": { "must": must, "must_not": [] } },
+                }
+            },
+        }
+    facets = {}
+    for host in hosts:
+        facets[host] = {
+            "date_histogram": { "field": "@timestamp", "interval": interval },
+            "global": True,
+            "facet_filter": facet_filter(alert_query("host.raw:%s" % (host), qfilter), from_date),
+        }
+    return { "facets": facets, "size": 0 }
+
+def stats_query(from_date, interval, value, hosts = None):
+    if settings.ELASTICSEARCH_2X:
+        if hosts:
+            query = "host.raw:%s" % (hosts[0])
+        else:
+            query = "tags:metric"
+        return {
+            "size": 0,
+            "aggs": {
+                "date": {
+                    "date_histogram": { "field": "@timestamp", "interval": interval,
+                                        "time_zone": "Europe/Berlin", "min_doc_count": 0 },
+                    "aggs": { "stat": { "avg": { "field": value } } },
+                }
+            },
+            "query": filtered_query(query, from_date, analyze_wildcard = False),
+        }
+    facets = {}
+    if hosts:
+        for host in hosts:
+            facets[host] = {
+                "date_histogram": { "key_field": "@timestamp", "value_field": value,
+                                    "interval": interval, "min_doc_count": 0 },
+                "global": True,
+                "facet_filter": facet_filter("host.raw:%s" % (host), from_date),
+            }
+    else:
+        facets["global"] = {
+            "date_histogram": { "key_field": "@timestamp", "value_field": value, "interval": interval },
+            "global": True,
+            "facet_filter": facet_filter("*", from_date),
+        }
+    return { "facets": facets, "size": 0 }
+
+def terms_agg(field, size, aggs = None):
+    agg = { "terms": { "field": field, "size": size, "order": { "_count": "desc" } } }
+    if aggs:
+        agg["aggs"] = aggs
+    return agg
+
+def rules_per_category_query(from_date, hosts, qfilter = None):
+    return {
+        "size": 0,
+        "aggs": {
+            "category": terms_agg("alert.category.raw", 50, {
+                "rule": terms_agg("alert.signature_id", 50, {
+                    "rule_info": terms_agg("alert.signature.raw", 1) }) }),
+        },
+        "query": filtered_query(alert_query("host.raw:%s" % (hosts), qfilter), from_date,
+                                analyze_wildcard = True, to = False, must_not = True),
+    }
+
+def alerts_count_query(from_date, hosts, qfilter = None):
+    return {
+        "size": 0,
+        "query": filtered_query(alert_query("host.raw:%s" % (hosts), qfilter), from_date,
+                                analyze_wildcard = True, to = False, must_not = True),
+        "aggs": {},
+    }
+
+def alerts_trend_query(start_date, from_date, hosts, qfilter = None):
+    return {
+        "size": 0,
+        "aggs": {
+            "trend": { "date_range": { "field": "@timestamp",
+                                       "ranges": [ { "from": start_date, "to": from_date }, { "from": from_date } ] } },
+        },
+        "query": filtered_query(alert_query("host.raw:%s" % (hosts), qfilter), start_date,
+                                analyze_wildcard = True, to = False, must_not = True),
+    }
+
+def latest_stats_query(from_date, hosts, qfilter = None):
+    query = "event_type:stats AND host.raw:%s" % (hosts)
+    if qfilter != None:
+        query += " AND " + qfilter
+    return {
+        "size": 1,
+        "sort": [ { "@timestamp": { "order": "desc", "unmapped_type": "boolean" } } ],
+        "query": filtered_query(query, from_date, analyze_wildcard = True, to = False, must_not = True),
+        "fields": [ "_source" ],
+        "fielddata_fields": [ "@timestamp", "flow.start", "timestamp", "flow.end" ],
+    }
+
+def rollup_query(start, end, size):
+    # alerts from start included to end excluded, counted by host and
+    # signature, at most size * size buckets
+    return {
+        "size": 0,
+        "aggs": {
+            "host": terms_agg("host.raw", size, {
+                "sid": terms_agg("alert.signature_id", size) }),
+        },
+        "query": {
+            "filtered": {
+                "query": { "query_string": { "query": "event_type:alert", "analyze_wildcard": False } },
+                "filter": { "bool": { "must": [
+                    { "range": { "@timestamp": { "gte": start, "lt": end, "format": "epoch_millis" } } } ] } },
+            }
+        },
+    }
+
+def delete_by_sid_query(sid, size):
+    # only ids of alerts are needed to delete them
+    return {
+        "size": size,
+        "_source": False,
+        "query": { "filtered": { "query": { "term": { "alert.signature_id": sid } } } },
+    }
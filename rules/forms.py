@@ -37,7 +37,7 @@ class SourceForm(forms.ModelForm):
                               required = False)
     class Meta:
         model = Source
-        exclude = ['created_date', 'updated_date']
+        exclude = ['created_date', 'updated_date', 'etag', 'last_modified', 'checksum', 'skipped_updates', 'full_updates']
 
 class AddSourceForm(forms.ModelForm):
     file  = forms.FileField(required = False)
@@ -47,7 +47,7 @@ class AddSourceForm(forms.ModelForm):
 
     class Meta:
         model = Source
-        exclude = ['created_date', 'updated_date']
+        exclude = ['created_date', 'updated_date', 'etag', 'last_modified', 'checksum', 'skipped_updates', 'full_updates']
 
     def __init__(self, *args, **kwargs):
         super(AddSourceForm, self).__init__(*args, **kwargs)
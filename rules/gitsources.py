@@ -0,0 +1,121 @@
+"""
+Copyright(C) 2016, Stamus Networks
+Written by Eric Leblond <eleblond@stamus-networks.com>
+
+This file is part of Scirius.
+
+Scirius is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Scirius is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Scirius.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from django.conf import settings
+from git.objects.util import altz_to_utctz_str
+
+from rules.models import SourceAtVersion, SourceUpdate
+
+from time import time
+import tempfile
+import os
+
+# diff of a source is done with the previous commit
+MIN_KEEP_VERSIONS = 2
+
+def repo_size(repo):
+    size = 0
+    for (root, dirs, files) in os.walk(repo.git_dir):
+        for filename in files:
+            size += os.path.getsize(os.path.join(root, filename))
+    return size
+
+def archive_latency(repo):
+    # time needed to export the last version, as done by export_files
+    start = time()
+    with tempfile.TemporaryFile() as f:
+        repo.archive(f, treeish = 'HEAD')
+    return time() - start
+
+def loose_objects(repo):
+    stats = {}
+    for line in repo.git.count_objects('-v').splitlines():
+        (key, value) = line.split(': ')
+        stats[key] = value
+    return int(stats['count'])
+
+def needs_maintenance(repo):
+    return loose_objects(repo) > settings.GIT_SOURCES_LOOSE_OBJECTS
+
+def squash_history(repo, keep, referenced = []):
+    # rewrite the master branch so it only contains the last keep commits,
+    # the oldest kept commit becoming the root one. Commits in referenced
+    # and all commits after them are kept. Return a dict old sha -> new sha
+    # of the kept commits.
+    commits = list(repo.iter_commits('master'))
+    for (index, commit) in enumerate(commits):
+        if commit.hexsha in referenced:
+            keep = max(keep, index + 1)
+    if len(commits) <= keep:
+        return {}
+    mapping = {}
+    parent = None
+    for commit in reversed(commits[:keep]):
+        args = [commit.tree.hexsha]
+        if parent:
+            args += ['-p', parent]
+        args += ['-m', commit.message]
+        env = { 'GIT_AUTHOR_NAME': commit.author.name, 'GIT_AUTHOR_EMAIL': commit.author.email,
+                'GIT_AUTHOR_DATE': "%d %s" % (commit.authored_date, altz_to_utctz_str(commit.author_tz_offset)),
+                'GIT_COMMITTER_NAME': commit.committer.name, 'GIT_COMMITTER_EMAIL': commit.committer.email,
+                'GIT_COMMITTER_DATE': "%d %s" % (commit.committed_date, altz_to_utctz_str(commit.committer_tz_offset)) }
+        with repo.git.custom_environment(**env):
+            parent = repo.git.commit_tree(*args)
+        mapping[commit.hexsha] = parent
+    repo.git.update_ref('refs/heads/master', parent, commits[0].hexsha)
+    return mapping
+
+def maintain_source(source, keep = None):
+    """
+    Repack the git repository of a source and, if keep is set, drop the
+    commits older than the last keep ones not referenced by a SourceAtVersion.
+    At least MIN_KEEP_VERSIONS commits are kept.
+    """
+    source_git_dir = os.path.join(settings.GIT_SOURCES_BASE_DIRECTORY, str(source.pk))
+    if not os.path.isdir(source_git_dir):
+        return None
+    repo = source.get_git_repo()
+    if not repo.head.is_valid():
+        return None
+    report = { 'source': source.name, 'squashed': 0 }
+    report['size_before'] = repo_size(repo)
+    report['archive_before'] = archive_latency(repo)
+    prune = []
+    if keep:
+        keep = max(keep, MIN_KEEP_VERSIONS)
+        versions = SourceAtVersion.objects.filter(source = source)
+        referenced = set(versions.values_list('version', flat = True)) | set(versions.values_list('git_version', flat = True))
+        commits_count = len(list(repo.iter_commits('master')))
+        mapping = squash_history(repo, keep, referenced)
+        if len(mapping):
+            report['squashed'] = commits_count - len(mapping)
+            for old in mapping:
+                SourceAtVersion.objects.filter(source = source, version = old).update(version = mapping[old])
+                SourceAtVersion.objects.filter(source = source, git_version = old).update(git_version = mapping[old])
+                SourceUpdate.objects.filter(source = source, version = old).update(version = mapping[old])
+            # old commits are only reachable through the reflog
+            repo.git.reflog('expire', '--expire=now', '--all')
+            prune = ['--prune=now']
+    repo.git.gc('--quiet', *prune)
+    report['size_after'] = repo_size(repo)
+    report['archive_after'] = archive_latency(repo)
+    report['reclaimed'] = report['size_before'] - report['size_after']
+    return report
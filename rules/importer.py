@@ -0,0 +1,316 @@
+"""
+Copyright(C) 2016, Stamus Networks
+Written by Eric Leblond <eleblond@stamus-networks.com>
+
+This file is part of Scirius.
+
+Scirius is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Scirius is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Scirius.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from django.conf import settings
+from django.db import connection, transaction
+
+import hashlib
+import os
+import re
+
+from rules.models import Rule, Category, Flowbit
+
+# SQLite refuses statements with more than 999 parameters so every
+# query built on a list of sids is split in chunks of BATCH_SIZE.
+# Updates are sent with executemany and can use larger batches.
+BATCH_SIZE = 500
+UPDATE_BATCH_SIZE = 1000
+
+def chunks(elts, size = BATCH_SIZE):
+    for i in xrange(0, len(elts), size):
+        yield elts[i:i + size]
+
+def bulk_update(model, rows, fields, key = 'pk', batch_size = UPDATE_BATCH_SIZE):
+    # rows is a list of dict containing key and fields values,
+    # each batch is sent to the database as a single executemany
+    qn = connection.ops.quote_name
+    meta = model._meta
+    if key == 'pk':
+        key_field = meta.pk
+    else:
+        key_field = meta.get_field(key)
+    fields = [ meta.get_field(field) for field in fields ]
+    sql = "UPDATE %s SET %s WHERE %s = %%s" % (qn(meta.db_table),
+              ", ".join([ "%s = %%s" % (qn(field.column)) for field in fields ]),
+              qn(key_field.column))
+    cursor = connection.cursor()
+    for batch in chunks(rows, batch_size):
+        params = []
+        for row in batch:
+            values = [ field.get_db_prep_save(row[field.name], connection) for field in fields ]
+            values.append(key_field.get_db_prep_save(row[key], connection))
+            params.append(values)
+        cursor.executemany(sql, params)
+
+def rule_hash(content):
+    # leading and trailing blanks are not significant
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return hashlib.sha1(content.strip()).hexdigest()
+
+def flowbits_groups(links):
+    # links is an iterable of (sid, flowbit_id), rules sharing a flowbit
+    # directly or through other rules end in the same connected component
+    # identified by its lowest sid
+    parent = {}
+    def find(node):
+        root = node
+        while parent[root] != root:
+            root = parent[root]
+        while parent[node] != root:
+            parent[node], node = root, parent[node]
+        return root
+    for (sid, flowbit_id) in links:
+        nodes = [('rule', sid), ('flowbit', flowbit_id)]
+        for node in nodes:
+            if not parent.has_key(node):
+                parent[node] = node
+        (rule_root, flowbit_root) = (find(nodes[0]), find(nodes[1]))
+        if rule_root != flowbit_root:
+            parent[flowbit_root] = rule_root
+    components = {}
+    for node in parent:
+        if node[0] == 'rule':
+            root = find(node)
+            components[root] = min(components.get(root, node[1]), node[1])
+    groups = {}
+    for node in parent:
+        if node[0] == 'rule':
+            groups[node[1]] = components[find(node)]
+    return groups
+
+class FlowbitResolver(object):
+    """
+    Collect the flowbits, hostbits and xbits used by the rules of a source
+    and write them and their links to rules with a few bulk queries.
+    """
+    bitsregexp = re.compile("(flowbits|hostbits|xbits) *: *(isset|set),(.*?) *;")
+
+    def __init__(self, source):
+        self.source = source
+        # (type, name) -> {'set': bool, 'isset': bool}
+        self.flowbits = {}
+        # sid -> set of (type, name)
+        self.rules = {}
+        # rules that may already have links in database
+        self.replaced = []
+
+    def parse(self, sid, line, replace = False):
+        keys = set()
+        if 'bits' in line:
+            for (ftype, action, name) in self.bitsregexp.findall(line):
+                key = (ftype, name)
+                if not self.flowbits.has_key(key):
+                    self.flowbits[key] = { 'set': False, 'isset': False }
+                self.flowbits[key][action] = True
+                keys.add(key)
+        self.rules[sid] = keys
+        if replace:
+            self.replaced.append(sid)
+
+    def get_flowbits(self):
+        flowbits = {}
+        for flowbit in Flowbit.objects.filter(source = self.source):
+            flowbits[(flowbit.type, flowbit.name)] = flowbit
+        return flowbits
+
+    def resolve(self):
+        flowbits = self.get_flowbits()
+        created = []
+        to_set = []
+        to_isset = []
+        for key in self.flowbits:
+            flags = self.flowbits[key]
+            if not flowbits.has_key(key):
+                created.append(Flowbit(type = key[0], name = key[1], source = self.source,
+                                       set = flags['set'], isset = flags['isset']))
+                continue
+            if flags['set'] and not flowbits[key].set:
+                to_set.append(flowbits[key].pk)
+            if flags['isset'] and not flowbits[key].isset:
+                to_isset.append(flowbits[key].pk)
+        for batch in chunks(to_set):
+            Flowbit.objects.filter(pk__in = batch).update(set = True)
+        for batch in chunks(to_isset):
+            Flowbit.objects.filter(pk__in = batch).update(isset = True)
+        if len(created):
+            Flowbit.objects.bulk_create(created, batch_size = BATCH_SIZE)
+            # bulk_create does not set primary keys on all backends
+            flowbits = self.get_flowbits()
+        return flowbits
+
+    def link(self, removed = []):
+        # removed rules are unlinked now so they are not kept in the
+        # flowbits groups, groups change even if no rule was parsed
+        if not len(self.rules) and not len(removed):
+            return
+        flowbits = self.resolve()
+        through = Rule.flowbits.through
+        for batch in chunks(self.replaced + list(removed)):
+            through.objects.filter(rule_id__in = batch).delete()
+        links = []
+        for sid in self.rules:
+            for key in self.rules[sid]:
+                links.append(through(rule_id = sid, flowbit_id = flowbits[key].pk))
+        through.objects.bulk_create(links, batch_size = BATCH_SIZE)
+        self.update_groups()
+
+    def update_groups(self):
+        through = Rule.flowbits.through
+        links = through.objects.filter(flowbit__source = self.source).values_list('rule_id', 'flowbit_id')
+        groups = flowbits_groups(links.iterator())
+        current = Rule.objects.filter(category__source = self.source).exclude(flowbits_group = None)
+        current = dict(current.values_list('sid', 'flowbits_group'))
+        changes = []
+        for sid in groups:
+            if current.get(sid) != groups[sid]:
+                changes.append({ 'sid': sid, 'flowbits_group': groups[sid] })
+        for sid in current:
+            if not groups.has_key(sid):
+                changes.append({ 'sid': sid, 'flowbits_group': None })
+        bulk_update(Rule, changes, ['flowbits_group'], key = 'sid')
+
+class RulesImporter(object):
+    """
+    Import the rules files of a source in a single pass.
+
+    Existing rules are loaded once for the whole source and the database
+    is written with batched inserts and updates.
+    """
+    getsid = re.compile("sid *: *(\d+)")
+    getrev = re.compile("rev *: *(\d+)")
+    getmsg = re.compile("msg *: *\"(.*?)\"")
+
+    def __init__(self, source):
+        self.source = source
+        self.source_git_dir = os.path.join(settings.GIT_SOURCES_BASE_DIRECTORY, str(source.pk))
+
+    def parse_line(self, line):
+        state = True
+        if line.startswith('#'):
+            # check if it is a commented signature
+            if "->" in line and "sid" in line and ")" in line:
+                line = line.lstrip("# ")
+                state = False
+            else:
+                return None
+        match = self.getsid.search(line)
+        if not match:
+            return None
+        sid = int(match.groups()[0])
+        match = self.getrev.search(line)
+        if match:
+            rev = int(match.groups()[0])
+        else:
+            rev = None
+        match = self.getmsg.search(line)
+        if not match:
+            msg = ""
+        else:
+            msg = match.groups()[0]
+        return { 'sid': sid, 'rev': rev, 'msg': msg, 'content': line, 'state': state }
+
+    def file_hash(self, category):
+        digest = hashlib.sha1()
+        with open(os.path.join(self.source_git_dir, category.filename), 'rb') as rfile:
+            for block in iter(lambda: rfile.read(64 * 1024), ''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def parse_category(self, category):
+        with open(os.path.join(self.source_git_dir, category.filename)) as rfile:
+            for line in rfile:
+                rule = self.parse_line(line)
+                if rule:
+                    yield rule
+
+    def get_existing_rules(self):
+        # sid is the primary key of Rule so a sid already known in an
+        # other source is moved to the category where we find it
+        existing = {}
+        for (sid, category_id, content_hash) in Rule.objects.values_list('sid', 'category_id', 'content_hash').iterator():
+            existing[sid] = { 'category_id': category_id, 'content_hash': content_hash }
+        return existing
+
+    def import_categories(self, categories):
+        rules_update = {"added": [], "deleted": [], "updated": []}
+        existing = self.get_existing_rules()
+        seen = set()
+        updated = []
+        flowbits = FlowbitResolver(self.source)
+
+        # a file with the same digest as in last import is not parsed
+        # and all its rules are considered as unchanged
+        changed = []
+        unchanged_pk = set()
+        for category in categories:
+            digest = self.file_hash(category)
+            if digest == category.content_hash:
+                unchanged_pk.add(category.pk)
+            else:
+                changed.append((category, digest))
+        for sid in existing:
+            if existing[sid]['category_id'] in unchanged_pk:
+                seen.add(sid)
+
+        with transaction.atomic():
+            for (category, digest) in changed:
+                for parsed in self.parse_category(category):
+                    sid = parsed['sid']
+                    if sid in seen:
+                        continue
+                    seen.add(sid)
+                    rev = parsed['rev']
+                    if rev == None:
+                        rev = 0
+                    content_hash = rule_hash(parsed['content'])
+                    if existing.has_key(sid):
+                        # FIXME update references if needed
+                        old = existing[sid]
+                        if old['content_hash'] != content_hash or old['category_id'] != category.pk:
+                            rule = Rule(category = category, sid = sid, rev = rev,
+                                        content = parsed['content'], msg = parsed['msg'],
+                                        content_hash = content_hash)
+                            updated.append({ 'sid': sid, 'rev': rev, 'msg': parsed['msg'],
+                                             'content': parsed['content'], 'category': category.pk,
+                                             'content_hash': content_hash })
+                            rules_update["updated"].append(rule)
+                            flowbits.parse(sid, parsed['content'], replace = True)
+                    else:
+                        rule = Rule(category = category, sid = sid,
+                                    rev = rev, content = parsed['content'], msg = parsed['msg'],
+                                    state_in_source = parsed['state'], state = parsed['state'],
+                                    content_hash = content_hash)
+                        rules_update["added"].append(rule)
+                        flowbits.parse(sid, parsed['content'])
+
+            Rule.objects.bulk_create(rules_update["added"], batch_size = BATCH_SIZE)
+            bulk_update(Rule, updated, ['rev', 'msg', 'content', 'category', 'content_hash'], key = 'sid')
+
+            categories_pk = set([ cat.pk for (cat, digest) in changed ])
+            deleted = [ sid for sid in existing if existing[sid]['category_id'] in categories_pk and not sid in seen ]
+            flowbits.link(removed = deleted)
+            for batch in chunks(deleted):
+                rules_update["deleted"].extend(Rule.objects.select_related('category').filter(sid__in = batch))
+
+            for (category, digest) in changed:
+                category.content_hash = digest
+                Category.objects.filter(pk = category.pk).update(content_hash = digest)
+        return rules_update
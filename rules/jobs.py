@@ -0,0 +1,193 @@
+"""
+Copyright(C) 2016, Stamus Networks
+Written by Eric Leblond <eleblond@stamus-networks.com>
+
+This file is part of Scirius.
+
+Scirius is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Scirius is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Scirius.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from django.conf import settings
+from django.db import transaction, connection, IntegrityError
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import autodiscover_modules
+
+from datetime import timedelta
+import hashlib
+import json
+import threading
+
+from rules.models import Job, Source, SourceAtVersion, Ruleset
+
+# action name -> handler(job, **args), filled by the job_handler
+# decorator in the jobs module of each application
+JOB_HANDLERS = {}
+handlers_loaded = False
+
+def job_handler(action):
+    def register(func):
+        JOB_HANDLERS[action] = func
+        return func
+    return register
+
+def load_job_handlers():
+    global handlers_loaded
+    if not handlers_loaded:
+        autodiscover_modules('jobs')
+        handlers_loaded = True
+
+def job_key(action, args):
+    return "%s:%s" % (action, json.dumps(args, sort_keys = True))
+
+def submit_job(action, **kwargs):
+    # a pending job doing the same thing is returned instead of a new one
+    key = job_key(action, kwargs)
+    pending_key = hashlib.sha1(key).hexdigest()
+    job = None
+    while job == None:
+        try:
+            with transaction.atomic():
+                job = Job.objects.create(action = action, args = json.dumps(kwargs), key = key,
+                                         pending_key = pending_key)
+        except IntegrityError:
+            # the pending job may be claimed in between, then try again
+            pending = Job.objects.filter(pending_key = pending_key)
+            if len(pending):
+                return pending[0]
+    if not settings.USE_JOB_WORKER:
+        job = run_job(job)
+    return job
+
+def start_fields(worker = ''):
+    # fields updated when a job is started
+    now = timezone.now()
+    return { 'status': 'running', 'pending_key': None, 'worker': worker, 'started_date': now,
+             'heartbeat_date': now, 'attempts': F('attempts') + 1 }
+
+def claim_job(worker):
+    # jobs of workers without sign of life for JOB_STALE_TIMEOUT seconds
+    # are started again, or failed after JOB_MAX_ATTEMPTS attempts
+    stale = timezone.now() - timedelta(seconds = settings.JOB_STALE_TIMEOUT)
+    for job in Job.objects.filter(status = 'running', heartbeat_date__lt = stale).order_by('pk')[:10]:
+        claimed = Job.objects.filter(pk = job.pk, status = 'running', heartbeat_date = job.heartbeat_date)
+        if job.attempts >= settings.JOB_MAX_ATTEMPTS:
+            claimed.update(status = 'failed', message = "Worker %s stopped running the job" % (job.worker),
+                           finished_date = timezone.now())
+        elif claimed.update(**start_fields(worker)):
+            return Job.objects.get(pk = job.pk)
+    # the conditional update ensures only one worker gets a job
+    for job in Job.objects.filter(status = 'pending').order_by('created_date', 'pk')[:10]:
+        if Job.objects.filter(pk = job.pk, status = 'pending').update(**start_fields(worker)):
+            return Job.objects.get(pk = job.pk)
+    return None
+
+def owned_job(job):
+    # the job row as long as it was not started again by another worker
+    return Job.objects.filter(pk = job.pk, worker = job.worker, attempts = job.attempts)
+
+class JobHeartbeat(threading.Thread):
+    """
+    Update the heartbeat of a job while its handler runs, so a handler
+    giving no progress for a long time is not taken as lost.
+    """
+    def __init__(self, job):
+        super(JobHeartbeat, self).__init__()
+        self.daemon = True
+        self.job = job
+        self.stopped = threading.Event()
+
+    def beat(self):
+        # return False when the job was started again by another worker
+        return owned_job(self.job).update(heartbeat_date = timezone.now()) > 0
+
+    def run(self):
+        interval = max(settings.JOB_STALE_TIMEOUT / 4.0, 1)
+        try:
+            while not self.stopped.wait(interval) and self.beat():
+                pass
+        finally:
+            # the thread has its own database connection
+            connection.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+def run_job(job):
+    load_job_handlers()
+    if job.status == 'pending':
+        Job.objects.filter(pk = job.pk).update(**start_fields())
+        job = Job.objects.get(pk = job.pk)
+    handler = JOB_HANDLERS.get(job.action)
+    heartbeat = JobHeartbeat(job)
+    heartbeat.start()
+    try:
+        if handler == None:
+            raise ValueError("Unknown job action '%s'" % (job.action))
+        result = handler(job, **json.loads(job.args))
+        job.result = json.dumps(result)
+        job.status = 'done'
+        job.progress = 100
+    except Exception, e:
+        job.status = 'failed'
+        job.message = str(e)
+    finally:
+        heartbeat.stop()
+    job.finished_date = timezone.now()
+    if not owned_job(job).update(status = job.status, result = job.result, progress = job.progress,
+                                 message = job.message, finished_date = job.finished_date):
+        # the job was started again by another worker, which sets its result
+        return Job.objects.get(pk = job.pk)
+    return job
+
+@job_handler('update_source')
+def update_source(job, source_id):
+    source = Source.objects.get(pk = source_id)
+    try:
+        source.update()
+    except (IOError, OSError), errors:
+        return { 'status': False, 'errors': str(errors) }
+    return { 'status': True }
+
+@job_handler('update_ruleset')
+def update_ruleset(job, ruleset_id):
+    ruleset = Ruleset.objects.get(pk = ruleset_id)
+    try:
+        ruleset.update(progress = job.set_progress)
+    except IOError, errors:
+        return { 'status': False, 'errors': "Can not fetch data: %s" % (errors), 'sources': ruleset.update_report }
+    return { 'status': True, 'sources': ruleset.update_report }
+
+@job_handler('test_ruleset')
+def test_ruleset(job, ruleset_id, full = False):
+    ruleset = Ruleset.objects.get(pk = ruleset_id)
+    return ruleset.test(full = full)
+
+@job_handler('test_source')
+def test_source(job, source_id):
+    sourceatversion = SourceAtVersion.objects.get(source__pk = source_id, version = 'HEAD')
+    return sourceatversion.test()
+
+@job_handler('git_maintenance')
+def git_maintenance(job, source_id, keep = None):
+    from rules.gitsources import maintain_source
+    source = Source.objects.get(pk = source_id)
+    return maintain_source(source, keep = keep)
+
+@job_handler('delete_alerts')
+def delete_alerts(job, sid):
+    from rules.es_graphs import es_delete_alerts_by_sid
+    return es_delete_alerts_by_sid(sid, progress = job.set_progress)
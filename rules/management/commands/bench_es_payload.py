@@ -0,0 +1,65 @@
+"""
+Copyright(C) 2014, 2015 Stamus Networks
+Written by Eric Leblond <eleblond@stamus-networks.com>
+
+This file is part of Scirius.
+
+Scirius is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Scirius is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Scirius.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from django.core.management.base import BaseCommand
+from django.utils.text import compress_string
+
+from rules.es_graphs import columns_timeline, timeline_entries
+
+from time import time
+import json
+
+class Command(BaseCommand):
+    help = 'Benchmark size and serialization time of timeline responses in entries and columns formats.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hosts', type=int, default=50, help='Number of hosts in the timeline')
+        parser.add_argument('--points', type=int, default=100, help='Number of points per host')
+        parser.add_argument('--iterations', type=int, default=100, help='Number of serializations for each format')
+
+    def synthetic_timeline(self, hosts, points):
+        from_date = 1500000000000
+        interval = 864000
+        times = [ from_date + point * interval for point in xrange(points) ]
+        values = {}
+        for host in xrange(hosts):
+            values['probe-%d' % (host)] = [ (host * point) % 97 for point in xrange(points) ]
+        return columns_timeline(times, values, from_date, interval)
+
+    def measure(self, iterations, serialize):
+        start = time()
+        for _ in xrange(iterations):
+            payload = serialize()
+        return (payload, (time() - start) * 1000.0 / iterations)
+
+    def handle(self, *args, **options):
+        data = self.synthetic_timeline(options['hosts'], options['points'])
+        self.stdout.write('Synthetic timeline: %d hosts, %d points' % (options['hosts'], options['points']))
+        formats = [
+            ('entries', lambda: json.dumps(timeline_entries(data, 'count'))),
+            ('columns', lambda: json.dumps(data, separators = (',', ':'))),
+        ]
+        for (name, serialize) in formats:
+            (payload, duration) = self.measure(options['iterations'], serialize)
+            start = time()
+            compressed = compress_string(payload)
+            gzip_duration = (time() - start) * 1000.0
+            self.stdout.write('%s: %d bytes in %.2fms, gzip %d bytes in %.2fms' %
+                              (name, len(payload), duration, len(compressed), gzip_duration))
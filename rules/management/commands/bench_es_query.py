@@ -0,0 +1,155 @@
+"""
+Copyright(C) 2014, 2015 Stamus Networks
+Written by Eric Leblond <eleblond@stamus-networks.com>
+
+This file is part of Scirius.
+
+Scirius is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Scirius is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Scirius.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from django.core.management.base import BaseCommand
+from django.template import Context, Template
+
+from rules.es_query import top_query, timeline_query
+
+from time import time
+import json
+
+# Elasticsearch 2.x bodies as they were rendered from Django templates
+TOP_TEMPLATE = """
+{
+  "size": 0,
+  "aggs": {
+    "table": {
+      "terms": {
+        "field": "{{ field }}",
+        "size": {{ count }},
+        "order": {
+          "_count": "desc"
+        }
+      }
+    }
+  },
+  "query": {
+    "filtered": {
+      "query": {
+        "query_string": {
+          "query": "event_type:alert AND host.raw:{{ appliance_hostname }} {{ query_filter|safe }}",
+          "analyze_wildcard": false
+        }
+      },
+      "filter": {
+        "bool": {
+          "must": [
+            {
+              "range": {
+                 "@timestamp": {
+                    "from": {{ from_date }},
+                    "to": "now"
+                 }
+              }
+            }
+          ]
+        }
+      }
+    }
+  }
+}
+"""
+
+TIMELINE_TEMPLATE = """
+{
+  "size": 0,
+  "aggs": {
+    "date": {
+      "date_histogram": {
+        "field": "@timestamp",
+        "interval": "{{ interval }}",
+        "time_zone": "Europe/Berlin",
+        "min_doc_count": 0
+      },
+      "aggs": {
+        "host": {
+          "terms": {
+            "field": "host.raw",
+            "size": 5,
+            "order": {
+              "_count": "desc"
+            }
+          }
+        }
+      }
+    }
+  },
+  "query": {
+    "filtered": {
+      "query": {
+        "query_string": {
+          "query": "event_type:alert {{ query_filter|safe }}",
+          "analyze_wildcard": false
+        }
+      },
+      "filter": {
+        "bool": {
+          "must": [
+            {
+              "range": {
+                "@timestamp": {
+                  "gte": {{ from_date }},
+                  "lte": "now",
+                  "format": "epoch_millis"
+                }
+              }
+            }
+          ],
+          "must_not": []
+        }
+      }
+    }
+  }
+}
+"""
+
+class Command(BaseCommand):
+    help = 'Benchmark building of Elasticsearch query bodies from templates and from dict builders.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=5000, help='Number of bodies built for each method')
+
+    def measure(self, iterations, build):
+        start = time()
+        for _ in xrange(iterations):
+            build()
+        return (time() - start) * 1000000.0 / iterations
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        from_date = 1500000000000
+        qfilter = 'alert.signature_id:2000001'
+        queries = [
+            ('top', TOP_TEMPLATE,
+             {'appliance_hostname': '*', 'count': 20, 'from_date': from_date, 'field': 'alert.signature_id',
+              'query_filter': ' AND ' + qfilter},
+             lambda: top_query('alert.signature_id', '*', 20, from_date, qfilter)),
+            ('timeline', TIMELINE_TEMPLATE,
+             {'from_date': from_date, 'interval': '864s', 'query_filter': ' AND ' + qfilter},
+             lambda: timeline_query(from_date, '864s', ['*'], qfilter)),
+        ]
+        for (name, source, context, builder) in queries:
+            templ = Template(source)
+            parse_render = self.measure(iterations, lambda: Template(source).render(Context(context)))
+            render = self.measure(iterations, lambda: templ.render(Context(context)))
+            build = self.measure(iterations, lambda: json.dumps(builder()))
+            self.stdout.write('%s: template parse and render %.1fus, cached template render %.1fus, dict build and dump %.1fus' %
+                              (name, parse_render, render, build))
@@ -0,0 +1,82 @@
+"""
+Copyright(C) 2016, Stamus Networks
+Written by Eric Leblond <eleblond@stamus-networks.com>
+
+This file is part of Scirius.
+
+Scirius is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Scirius is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Scirius.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from rules.models import Source, Category, Rule, Ruleset, Transformation
+from rules.bench import Measure, write_synthetic_rules
+
+import tempfile
+import shutil
+import os
+
+class Command(BaseCommand):
+    help = 'Benchmark generation of a ruleset built on a synthetic source. Database changes are rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rules', type=int, default=40000, help='Number of rules in the source')
+        parser.add_argument('--files', type=int, default=60, help='Number of rules files in the source')
+        parser.add_argument('--suppress-every', type=int, default=10, help='Suppress one rule out of this number')
+
+    def handle(self, *args, **options):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with override_settings(GIT_SOURCES_BASE_DIRECTORY=tmpdir):
+                with transaction.atomic():
+                    self.run_bench(tmpdir, options['rules'], options['files'], options['suppress_every'])
+                    transaction.set_rollback(True)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def legacy_buffer(self, ruleset):
+        # rules instances set difference and one transformation query per rule
+        rules = Rule.objects.filter(category__in = ruleset.categories.all(), state = True)
+        rules = list(set(rules.all()) - set(ruleset.suppressed_rules.all()))
+        return "\n".join([ rule.content_updated(ruleset) for rule in rules ])
+
+    def run_bench(self, tmpdir, rules_count, files_count, suppress_every):
+        source = Source.objects.create(name = 'scirius-bench-%d' % (os.getpid()), method = 'local',
+                                       datatype = 'sigs', created_date = timezone.now())
+        source_dir = os.path.join(tmpdir, str(source.pk))
+        filenames = write_synthetic_rules(source_dir, rules_count, files_count)
+        categories = [ Category.objects.create(source = source, name = os.path.basename(filename)[:-len('.rules')],
+                                               created_date = timezone.now(), filename = filename)
+                       for filename in filenames ]
+        source.import_categories(categories)
+        ruleset = Ruleset.objects.create(name = 'scirius-bench-%d' % (os.getpid()), created_date = timezone.now(),
+                                         updated_date = timezone.now())
+        ruleset.categories.add(*categories)
+        rules = list(Rule.objects.filter(category__source = source))
+        # each rule has a transformation as when created from the ruleset form
+        Transformation.objects.bulk_create([ Transformation(datatype = 'alert', ruleset = ruleset, rule = rule)
+                                             for rule in rules ])
+        ruleset.suppressed_rules.add(*rules[::suppress_every])
+        del(rules)
+        self.stdout.write('Synthetic ruleset: %d rules in %d categories' % (rules_count, files_count))
+
+        with Measure() as measure:
+            self.legacy_buffer(ruleset)
+        self.stdout.write('instances and per rule transformation: %s' % (measure))
+        with Measure() as measure:
+            ruleset.to_buffer()
+        self.stdout.write('single query generation: %s (%d rules)' % (measure, ruleset.rules_count))
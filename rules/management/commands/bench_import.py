@@ -0,0 +1,79 @@
+"""
+Copyright(C) 2016, Stamus Networks
+Written by Eric Leblond <eleblond@stamus-networks.com>
+
+This file is part of Scirius.
+
+Scirius is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Scirius is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Scirius.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from rules.models import Source, Category
+from rules.bench import Measure, write_synthetic_rules
+
+import tempfile
+import shutil
+import os
+
+class Command(BaseCommand):
+    help = 'Benchmark rules import on a synthetic source. Database changes are rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rules', type=int, default=50000, help='Number of rules in the source')
+        parser.add_argument('--files', type=int, default=60, help='Number of rules files in the source')
+
+    def handle(self, *args, **options):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with override_settings(GIT_SOURCES_BASE_DIRECTORY=tmpdir):
+                with transaction.atomic():
+                    self.run_bench(tmpdir, options['rules'], options['files'])
+                    transaction.set_rollback(True)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def get_categories(self, source, filenames):
+        categories = []
+        for filename in filenames:
+            name = os.path.basename(filename)[:-len('.rules')]
+            category = Category.objects.filter(source = source, name = name)
+            if category:
+                categories.append(category[0])
+            else:
+                categories.append(Category.objects.create(source = source, name = name,
+                                  created_date = timezone.now(), filename = filename))
+        return categories
+
+    def run_bench(self, tmpdir, rules_count, files_count):
+        source = Source.objects.create(name = 'scirius-bench-%d' % (os.getpid()), method = 'local',
+                                       datatype = 'sigs', created_date = timezone.now())
+        source_dir = os.path.join(tmpdir, str(source.pk))
+        filenames = write_synthetic_rules(source_dir, rules_count, files_count)
+        self.stdout.write('Synthetic source: %d rules in %d files' % (rules_count, files_count))
+
+        steps = [('first import', 1), ('identical reimport', 1), ('reimport with new revisions', 2)]
+        for (name, rev) in steps:
+            if rev != 1:
+                write_synthetic_rules(source_dir, rules_count, files_count, rev = rev)
+            source = Source.objects.get(pk = source.pk)
+            categories = self.get_categories(source, filenames)
+            with Measure() as measure:
+                source.import_categories(categories)
+            update = source.updated_rules
+            self.stdout.write('%s: %s (%d added, %d updated, %d deleted)' %
+                              (name, measure, len(update['added']), len(update['updated']), len(update['deleted'])))
@@ -0,0 +1,81 @@
+"""
+Copyright(C) 2016, Stamus Networks
+Written by Eric Leblond <eleblond@stamus-networks.com>
+
+This file is part of Scirius.
+
+Scirius is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Scirius is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Scirius.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from rules.models import Source, Category, Ruleset
+from rules.bench import Measure, write_synthetic_rules
+from rules.validation import shard_buffers
+from suricata.common import Test
+
+from distutils.spawn import find_executable
+import tempfile
+import shutil
+import os
+
+class Command(BaseCommand):
+    help = 'Benchmark wall time of a full ruleset test against the number of Suricata processes. Database changes are rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rules', type=int, default=40000, help='Number of rules in the source')
+        parser.add_argument('--files', type=int, default=60, help='Number of rules files in the source')
+        parser.add_argument('--shards', default='1,2,4,8,16', help='Comma separated list of numbers of processes')
+
+    def handle(self, *args, **options):
+        if not find_executable(settings.SURICATA_BINARY):
+            raise CommandError("Suricata binary '%s' not found" % (settings.SURICATA_BINARY))
+        shards = [ int(count) for count in options['shards'].split(',') ]
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with override_settings(GIT_SOURCES_BASE_DIRECTORY=tmpdir):
+                with transaction.atomic():
+                    self.run_bench(tmpdir, options['rules'], options['files'], shards)
+                    transaction.set_rollback(True)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def run_bench(self, tmpdir, rules_count, files_count, shards):
+        source = Source.objects.create(name = 'scirius-bench-%d' % (os.getpid()), method = 'local',
+                                       datatype = 'sigs', created_date = timezone.now())
+        source_dir = os.path.join(tmpdir, str(source.pk))
+        filenames = write_synthetic_rules(source_dir, rules_count, files_count)
+        categories = [ Category.objects.create(source = source, name = os.path.basename(filename)[:-len('.rules')],
+                                               created_date = timezone.now(), filename = filename)
+                       for filename in filenames ]
+        source.import_categories(categories)
+        ruleset = Ruleset.objects.create(name = 'scirius-bench-%d' % (os.getpid()), created_date = timezone.now(),
+                                         updated_date = timezone.now())
+        ruleset.categories.add(*categories)
+        self.stdout.write('Synthetic ruleset: %d rules in %d categories' % (rules_count, files_count))
+
+        # default test configuration, independent of the local Suricata
+        testor = Test()
+        for count in shards:
+            with Measure() as split:
+                (rule_buffers, line_maps) = shard_buffers(ruleset, ruleset.rules_header(), count)
+            with Measure() as measure:
+                result = testor.rules_sharded(rule_buffers, config_buffer = testor.CONFIG_FILE, line_maps = line_maps)
+            self.stdout.write('%d processes: split %.3fs, test %.3fs, status %s, %d errors' %
+                              (count, split.duration, measure.duration, result['status'], len(result.get('errors', []))))
@@ -0,0 +1,51 @@
+"""
+Copyright(C) 2016, Stamus Networks
+Written by Eric Leblond <eleblond@stamus-networks.com>
+
+This file is part of Scirius.
+
+Scirius is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Scirius is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Scirius.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from django.core.management.base import BaseCommand, CommandError
+
+from rules.models import Source
+from rules.gitsources import maintain_source, MIN_KEEP_VERSIONS
+
+class Command(BaseCommand):
+    help = 'Repack git repositories of sources and optionally drop old versions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep', type=int, default=None, help='Number of versions to keep in history of each source')
+        parser.add_argument('--source', default=None, help='Only handle source with this name')
+
+    def handle(self, *args, **options):
+        sources = Source.objects.all()
+        if options['source']:
+            sources = sources.filter(name = options['source'])
+            if not len(sources):
+                raise CommandError("No source with name '%s' is defined" % (options['source']))
+        if options['keep'] != None and options['keep'] < MIN_KEEP_VERSIONS:
+            raise CommandError("At least %d versions must be kept" % (MIN_KEEP_VERSIONS))
+        total = 0
+        for source in sources:
+            report = maintain_source(source, keep = options['keep'])
+            if report == None:
+                continue
+            total += report['reclaimed']
+            self.stdout.write('%s: %.1f MB -> %.1f MB, archive %.3fs -> %.3fs, %d commits squashed' %
+                              (source.name, report['size_before'] / (1024.0 * 1024), report['size_after'] / (1024.0 * 1024),
+                               report['archive_before'], report['archive_after'], report['squashed']))
+        self.stdout.write('Reclaimed %.1f MB' % (total / (1024.0 * 1024)))
@@ -0,0 +1,53 @@
+"""
+Copyright(C) 2016, Stamus Networks
+Written by Eric Leblond <eleblond@stamus-networks.com>
+
+This file is part of Scirius.
+
+Scirius is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Scirius is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Scirius.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from rules.jobs import load_job_handlers, claim_job, run_job
+
+from time import sleep
+import socket
+import os
+
+class Command(BaseCommand):
+    help = 'Run background jobs. Several workers can run at the same time.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', default=False, help='Exit when there is no more pending job')
+        parser.add_argument('--poll', type=float, default=2.0, help='Delay in seconds between checks for new jobs')
+
+    def handle(self, *args, **options):
+        load_job_handlers()
+        worker = "%s:%d" % (socket.gethostname(), os.getpid())
+        while True:
+            # connections closed by the database or too old are reopened
+            close_old_connections()
+            job = claim_job(worker)
+            if job == None:
+                if options['once']:
+                    break
+                sleep(options['poll'])
+                continue
+            self.stdout.write('Running job %d (%s)' % (job.pk, job.action))
+            job = run_job(job)
+            if job.status == 'failed':
+                self.stderr.write('Job %d failed: %s' % (job.pk, job.message))
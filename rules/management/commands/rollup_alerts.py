@@ -0,0 +1,44 @@
+"""
+Copyright(C) 2016, Stamus Networks
+Written by Eric Leblond <eleblond@stamus-networks.com>
+
+This file is part of Scirius.
+
+Scirius is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Scirius is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Scirius.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from rules import rollup
+from rules.es_graphs import es_get_alerts_rollup
+
+class Command(BaseCommand):
+    help = 'Count alerts per hour of completed hours, to be run every hour when ELASTICSEARCH_ROLLUP is set'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None, help='Number of days to roll up on first run (default ELASTICSEARCH_ROLLUP_DAYS)')
+
+    def handle(self, *args, **options):
+        if not settings.ELASTICSEARCH_2X:
+            raise CommandError("Alerts rollup requires Elasticsearch 2.x")
+        days = options['days'] or settings.ELASTICSEARCH_ROLLUP_DAYS
+        hours = rollup.hours_to_roll(days)
+        rows = 0
+        for hour in hours:
+            hour_rows = es_get_alerts_rollup(hour, hour + rollup.HOUR)
+            rollup.store_hour(hour, hour_rows)
+            rows += len(hour_rows)
+        pruned = rollup.prune(settings.ELASTICSEARCH_ROLLUP_DAYS)
+        self.stdout.write('%d hours rolled up in %d rows, %d old rows deleted' % (len(hours), rows, pruned))
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rules', '0047_proxy_validation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Transformation',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('datatype', models.CharField(default=b'alert', max_length=10, choices=[(b'alert', b'Action: Alert when the rule match; Default value'), (b'allow', b'Action: Allow the packets through the net'), (b'drop', b'Action: Drop the packets when the rule match')])),
+                ('rule', models.ForeignKey(default=1, to='rules.Rule')),
+                ('ruleset', models.ForeignKey(to='rules.Ruleset')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='rule',
+            name='transformations',
+            field=models.ManyToManyField(to='rules.Ruleset', through='rules.Transformation', blank=True),
+        ),
+    ]
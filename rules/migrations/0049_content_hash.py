@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rules', '0048_transformation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='content_hash',
+            field=models.CharField(default=b'', max_length=40, blank=True),
+        ),
+        migrations.AddField(
+            model_name='rule',
+            name='content_hash',
+            field=models.CharField(default=b'', max_length=40, blank=True),
+        ),
+    ]
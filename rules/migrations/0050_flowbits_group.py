@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def compute_flowbits_groups(apps, schema_editor):
+    Rule = apps.get_model('rules', 'Rule')
+    through = Rule.flowbits.through
+    # connected components of rules sharing flowbits, named by lowest sid
+    parent = {}
+    def find(node):
+        while parent[node] != node:
+            node = parent[node]
+        return node
+    for (sid, flowbit_id) in through.objects.values_list('rule_id', 'flowbit_id').iterator():
+        nodes = [('rule', sid), ('flowbit', flowbit_id)]
+        for node in nodes:
+            parent.setdefault(node, node)
+        (rule_root, flowbit_root) = (find(nodes[0]), find(nodes[1]))
+        if rule_root != flowbit_root:
+            parent[flowbit_root] = rule_root
+    components = {}
+    for node in parent:
+        if node[0] == 'rule':
+            components.setdefault(find(node), []).append(node[1])
+    for sids in components.values():
+        for i in xrange(0, len(sids), 500):
+            Rule.objects.filter(sid__in = sids[i:i + 500]).update(flowbits_group = min(sids))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rules', '0049_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rule',
+            name='flowbits_group',
+            field=models.IntegerField(db_index=True, null=True, blank=True),
+        ),
+        migrations.RunPython(compute_flowbits_groups, migrations.RunPython.noop),
+    ]
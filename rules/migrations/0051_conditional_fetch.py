@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rules', '0050_flowbits_group'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='source',
+            name='check_md5',
+            field=models.BooleanField(default=False, help_text=b'Skip update when the ".md5" file published next to the URL did not change.', verbose_name=b'Check md5 file'),
+        ),
+        migrations.AddField(
+            model_name='source',
+            name='checksum',
+            field=models.CharField(default=b'', max_length=32, blank=True),
+        ),
+        migrations.AddField(
+            model_name='source',
+            name='etag',
+            field=models.CharField(default=b'', max_length=200, blank=True),
+        ),
+        migrations.AddField(
+            model_name='source',
+            name='full_updates',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='source',
+            name='last_modified',
+            field=models.CharField(default=b'', max_length=100, blank=True),
+        ),
+        migrations.AddField(
+            model_name='source',
+            name='skipped_updates',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rules', '0051_conditional_fetch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('action', models.CharField(max_length=50)),
+                ('args', models.TextField(default=b'{}')),
+                ('key', models.CharField(max_length=400, db_index=True)),
+                ('pending_key', models.CharField(max_length=40, unique=True, null=True, blank=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('heartbeat_date', models.DateTimeField(null=True, verbose_name=b'date of last sign of life', blank=True)),
+                ('status', models.CharField(default=b'pending', max_length=10, db_index=True, choices=[(b'pending', b'Pending'), (b'running', b'Running'), (b'done', b'Done'), (b'failed', b'Failed')])),
+                ('progress', models.IntegerField(default=0)),
+                ('message', models.TextField(blank=True)),
+                ('result', models.TextField(blank=True)),
+                ('worker', models.CharField(max_length=200, blank=True)),
+                ('created_date', models.DateTimeField(default=django.utils.timezone.now, verbose_name=b'date created')),
+                ('started_date', models.DateTimeField(null=True, verbose_name=b'date started', blank=True)),
+                ('finished_date', models.DateTimeField(null=True, verbose_name=b'date finished', blank=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rules', '0053_alert_rollup'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='transformation',
+            index_together=set([('rule', 'ruleset')]),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rules', '0054_transformation_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RulesetValidation',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('valid', models.BooleanField(default=False)),
+                ('config_hash', models.CharField(max_length=40, blank=True)),
+                ('full_date', models.DateTimeField(null=True, verbose_name=b'date of last full test', blank=True)),
+                ('rules', models.TextField(blank=True)),
+                ('ruleset', models.OneToOneField(related_name='validation', to='rules.Ruleset')),
+            ],
+        ),
+    ]
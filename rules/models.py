@@ -23,8 +23,10 @@ from django.conf import settings
 from django.core.exceptions import FieldError, SuspiciousOperation, ValidationError
 from django.core.validators import validate_ipv4_address
 from django.db import transaction
+from django.db.models import F, Count, Max
 from django.utils import timezone
 import requests
+import hashlib
 import tempfile
 import tarfile
 import re
@@ -34,6 +36,7 @@ import git
 import shutil
 import json
 import IPy
+import threading
 
 
 def validate_proxy(val):
@@ -99,6 +102,7 @@ class Source(models.Model):
         ('other', 'Other content'),
     )
     TMP_DIR = "/tmp/"
+    DOWNLOAD_CHUNK_SIZE = 64 * 1024
 
     name = models.CharField(max_length=100, unique = True)
     created_date = models.DateTimeField('date created')
@@ -108,6 +112,14 @@ class Source(models.Model):
     uri = models.CharField(max_length=400, blank = True, null = True)
     cert_verif = models.BooleanField('Check certificates', default=True)
     authkey = models.CharField(max_length=400, blank = True, null = True)
+    check_md5 = models.BooleanField('Check md5 file', default=False,
+                                    help_text='Skip update when the ".md5" file published next to the URL did not change.')
+    # state of the last download, used for conditional requests
+    etag = models.CharField(max_length=200, blank = True, default = '')
+    last_modified = models.CharField(max_length=100, blank = True, default = '')
+    checksum = models.CharField(max_length=32, blank = True, default = '')
+    skipped_updates = models.IntegerField(default=0)
+    full_updates = models.IntegerField(default=0)
 
     editable = True
     # git repo where we store the physical thing
@@ -130,10 +142,11 @@ class Source(models.Model):
             self.update_ruleset = None
         self.first_run = False
         self.updated_rules = {"added": [], "deleted": [], "updated": []}
-        if len(Flowbit.objects.filter(source = self)) == 0:
-            self.init_flowbits = True
-        else:
-            self.init_flowbits = False
+        self.fetch_state = {}
+        self.firstimport = False
+        self.proxy_params = None
+        # a commit was done in the git repository during the update
+        self.committed = False
 
     def delete(self):
         self.needs_test()
@@ -146,30 +159,42 @@ class Source(models.Model):
             pass
         # delete model
         models.Model.delete(self)
+        sid_map.clear()
 
     def __unicode__(self):
         return self.name
 
+    def has_changes(self):
+        for key in self.updated_rules:
+            if len(self.updated_rules[key]):
+                return True
+        return False
+
     def aggregate_update(self, update):
         self.updated_rules["added"] = list(set(self.updated_rules["added"]).union(set(update["added"])))
         self.updated_rules["deleted"] = list(set(self.updated_rules["deleted"]).union(set(update["deleted"])))
         self.updated_rules["updated"] = list(set(self.updated_rules["updated"]).union(set(update["updated"])))
 
-    def get_categories(self, tarfile):
+    def get_categories(self, rules_files):
         catname = re.compile("\/(.+)\.rules$")
-        for member in tarfile.getmembers():
-            if member.name.endswith('.rules'):
-                match = catname.search(member.name)
-                name = match.groups()[0]
-                category = Category.objects.filter(source = self, name = name)
-                if not category:
-                    category = Category.objects.create(source = self,
-                                            name = name, created_date = timezone.now(),
-                                            filename = member.name)
-                    category.get_rules(self)
-                else:
-                    category[0].get_rules(self)
-                # get rules in this category
+        existing = dict([ (cat.name, cat) for cat in Category.objects.filter(source = self) ])
+        categories = []
+        for filename in rules_files:
+            match = catname.search(filename)
+            name = match.groups()[0]
+            if not existing.has_key(name):
+                existing[name] = Category.objects.create(source = self,
+                                        name = name, created_date = timezone.now(),
+                                        filename = filename)
+            categories.append(existing[name])
+        # get rules in all categories at once
+        self.import_categories(categories)
+
+    def import_categories(self, categories):
+        from rules.importer import RulesImporter
+        importer = RulesImporter(self)
+        self.aggregate_update(importer.import_categories(categories))
+        sid_map.clear()
 
     def get_git_repo(self, delete = False):
         # check if git tree is in place
@@ -207,6 +232,122 @@ class Source(models.Model):
             sversion = SourceAtVersion.objects.create(source = self, version = version,
                                                     updated_date = self.updated_date, git_version = version)
 
+    def check_tar_member(self, member):
+        # only file and dir are allowed
+        if not (member.isfile() or member.isdir()):
+            raise SuspiciousOperation("Suspect tar file contains non regular file '%s'" % (member.name))
+        # don't allow tar file with file in root dir
+        if member.isfile() and not '/' in member.name:
+            raise SuspiciousOperation("Suspect tar file contains file in root directory '%s' instead of under 'rules' directory" % (member.name))
+        # don't allow file outside of extraction directory
+        if os.path.isabs(member.name) or '..' in member.name.split('/'):
+            raise SuspiciousOperation("Suspect tar file contains file outside of archive directory '%s'" % (member.name))
+
+    def extract_tar(self, f, path):
+        # validate and extract members in a single pass over the archive
+        tfile = tarfile.open(fileobj=f, mode='r|*')
+        dir_list = set()
+        rules_files = []
+        for member in tfile:
+            self.check_tar_member(member)
+            dir_list.add(member.name.split('/')[0])
+            if member.isfile() and member.name.endswith('.rules'):
+                rules_files.append(member.name)
+            tfile.extract(member, path=path)
+        tfile.close()
+        return (list(dir_list), rules_files)
+
+    def blob_sha(self, path):
+        # same hash as the one of the git blob object of the file
+        digest = hashlib.sha1()
+        digest.update("blob %d\0" % (os.path.getsize(path)))
+        with open(path, 'rb') as blob:
+            for block in iter(lambda: blob.read(64 * 1024), ''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def get_head_blobs(self, repo, dirs):
+        # path -> blob sha of the files under dirs in last commit
+        blobs = {}
+        try:
+            tree = repo.head.commit.tree
+        except ValueError:
+            # no commit yet
+            return blobs
+        for dirname in dirs:
+            try:
+                subtree = tree[dirname]
+            except KeyError:
+                continue
+            if subtree.type == 'blob':
+                blobs[subtree.path] = subtree.hexsha
+                continue
+            for item in subtree.traverse():
+                if item.type == 'blob':
+                    blobs[item.path] = item.hexsha
+        return blobs
+
+    def commit_staged(self, repo, staging_dir, dir_list):
+        # replace dir_list and rules directories of the git tree by the
+        # staged ones, only files whose content differs from last commit
+        # are written to the tree and added to the index
+        source_git_dir = os.path.join(settings.GIT_SOURCES_BASE_DIRECTORY, str(self.pk))
+        head = self.get_head_blobs(repo, set(dir_list + ['rules']))
+        staged = set()
+        changed = []
+        for dirname in dir_list:
+            for (root, dirs, files) in os.walk(os.path.join(staging_dir, dirname)):
+                for filename in files:
+                    src = os.path.join(root, filename)
+                    path = os.path.relpath(src, staging_dir)
+                    target = os.path.join(source_git_dir, path)
+                    staged.add(path)
+                    if head.get(path) == self.blob_sha(src) and os.path.isfile(target):
+                        continue
+                    if not os.path.isdir(os.path.dirname(target)):
+                        os.makedirs(os.path.dirname(target))
+                    os.rename(src, target)
+                    changed.append(path)
+        removed = [ path for path in head if not path in staged ]
+        for path in removed:
+            target = os.path.join(source_git_dir, path)
+            if os.path.isfile(target):
+                os.remove(target)
+
+        index = repo.index
+        if len(removed):
+            index.remove(removed)
+        if len(changed):
+            index.add(changed)
+        if len(changed) or len(removed) or self.first_run:
+            os.environ['USERNAME'] = 'scirius'
+            message =  'source version at %s' % (self.updated_date)
+            index.commit(message)
+            self.committed = True
+
+    def schedule_maintenance(self):
+        # maintenance may rewrite the git history, so it must only be done
+        # once the update is recorded and outside of its transaction
+        if not self.committed:
+            return
+        self.committed = False
+        from rules.gitsources import needs_maintenance
+        if needs_maintenance(self.get_git_repo()):
+            from rules.jobs import submit_job
+            submit_job('git_maintenance', source_id = self.pk, keep = settings.GIT_SOURCES_KEEP_VERSIONS)
+
+    def commit_file(self, repo, f, filename):
+        # the rules directory of the source only contains this file
+        staging_dir = tempfile.mkdtemp(dir=settings.GIT_SOURCES_BASE_DIRECTORY)
+        try:
+            os.makedirs(os.path.join(staging_dir, 'rules'))
+            f.seek(0)
+            os.fsync(f)
+            shutil.copy(f.name, os.path.join(staging_dir, 'rules', filename))
+            self.commit_staged(repo, staging_dir, ['rules'])
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
     def handle_rules_in_tar(self, f):
         f.seek(0)
         if (not tarfile.is_tarfile(f.name)):
@@ -215,59 +356,31 @@ class Source(models.Model):
         self.updated_date = timezone.now()
         self.first_run = False
 
-        repo = self.get_git_repo(delete = True)
+        repo = self.get_git_repo()
 
         f.seek(0)
-        # extract file
-        tfile = tarfile.open(fileobj=f)
-        dir_list = []
-        for member in tfile.getmembers():
-            # only file and dir are allowed
-            if not (member.isfile() or member.isdir()):
-                raise SuspiciousOperation("Suspect tar file contains non regular file '%s'" % (member.name))
-            # don't allow tar file with file in root dir
-            if member.isfile() and not '/' in member.name:
-                raise SuspiciousOperation("Suspect tar file contains file in root directory '%s' instead of under 'rules' directory" % (member.name))
-            if member.isdir() and not '/' in member.name:
-                dir_list.append(member.name)
-
-        source_git_dir = os.path.join(settings.GIT_SOURCES_BASE_DIRECTORY, str(self.pk))
-        tfile.extractall(path=source_git_dir)
-        index = repo.index
-        if len(index.diff(None)) or self.first_run:
-            os.environ['USERNAME'] = 'scirius'
-            index.add(dir_list)
-            message =  'source version at %s' % (self.updated_date)
-            index.commit(message)
+        # extract to a staging directory so the git tree is only
+        # modified once the whole archive has been validated
+        staging_dir = tempfile.mkdtemp(dir=settings.GIT_SOURCES_BASE_DIRECTORY)
+        try:
+            (dir_list, rules_files) = self.extract_tar(f, staging_dir)
+            self.commit_staged(repo, staging_dir, dir_list)
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
 
         self.save()
         # Now we must update SourceAtVersion for this source
         # or create it if needed
         self.create_sourceatversion()
         # Get categories
-        self.get_categories(tfile)
+        self.get_categories(rules_files)
 
     def handle_other_file(self, f):
         self.updated_date = timezone.now()
         self.first_run = False
 
-        repo = self.get_git_repo(delete = True)
-
-        rules_dir = os.path.join(settings.GIT_SOURCES_BASE_DIRECTORY, str(self.pk), 'rules')
-        # create rules dir if needed
-        if not  os.path.isdir(rules_dir):
-            os.makedirs(rules_dir)
-        # copy file content to target
-        f.seek(0)
-        os.fsync(f)
-        shutil.copy(f.name, os.path.join(rules_dir, self.name))
-
-        index = repo.index
-        if len(index.diff(None)) or self.first_run:
-            os.environ['USERNAME'] = 'scirius'
-            index.add(['rules'])
-            message =  'source version at %s' % (self.updated_date)
-            index.commit(message)
+        repo = self.get_git_repo()
+        self.commit_file(repo, f, self.name)
 
         self.save()
         # Now we must update SourceAtVersion for this source
@@ -284,23 +397,8 @@ class Source(models.Model):
         self.updated_date = timezone.now()
         self.first_run = False
 
-        repo = self.get_git_repo(delete = True)
-
-        rules_dir = os.path.join(settings.GIT_SOURCES_BASE_DIRECTORY, str(self.pk), 'rules')
-        # create rules dir if needed
-        if not os.path.isdir(rules_dir):
-            os.makedirs(rules_dir)
-        # copy file content to target
-        f.seek(0)
-        os.fsync(f)
-        shutil.copy(f.name, os.path.join(rules_dir, 'sigs.rules'))
-
-        index = repo.index
-        if len(index.diff(None)) or self.first_run:
-            os.environ['USERNAME'] = 'scirius'
-            index.add(["rules"])
-            message =  'source version at %s' % (self.updated_date)
-            index.commit(message)
+        repo = self.get_git_repo()
+        self.commit_file(repo, f, 'sigs.rules')
 
         self.save()
         # Now we must update SourceAtVersion for this source
@@ -312,9 +410,9 @@ class Source(models.Model):
             category = Category.objects.create(source = self,
                                     name = '%s Sigs' % (self.name), created_date = timezone.now(),
                                     filename = os.path.join('rules', 'sigs.rules'))
-            category.get_rules(self)
         else:
-            category[0].get_rules(self)
+            category = category[0]
+        self.import_categories([category])
 
     def json_rules_list(self, rlist):
         rules = []
@@ -332,7 +430,7 @@ class Source(models.Model):
         update["added"] = self.json_rules_list(self.updated_rules["added"])
         update["updated"] = self.json_rules_list(self.updated_rules["updated"])
         repo = self.get_git_repo(delete = False)
-        sha = repo.heads.master.log()[-1].newhexsha
+        sha = repo.head.commit.hexsha
         SourceUpdate.objects.create(
             source = self,
             created_date = timezone.now(),
@@ -341,29 +439,70 @@ class Source(models.Model):
             changed = len(update["deleted"]) + len(update["added"]) + len(update["updated"]),
         )
 
-    @transaction.atomic
     def update(self):
+        with transaction.atomic():
+            self.prepare_update()
+            f = self.fetch_update()
+            self.apply_update(f)
+        self.schedule_maintenance()
+
+    def prepare_update(self):
+        # database accesses needed by fetch_update
+        if not self.method in ['http', 'local']:
+            raise FieldError("Currently unsupported method")
         # look for categories list: if none, first import
         categories = Category.objects.filter(source = self)
-        firstimport = False
+        self.firstimport = False
         if not categories:
-            firstimport = True
-        if not self.method in ['http', 'local']:
-            raise FieldError("Currently unsupported method")
+            self.firstimport = True
+        self.proxy_params = get_system_settings().get_proxy_params()
+
+    def fetch_update(self):
+        # download content without accessing the database so it can
+        # run in a thread, return None if upstream did not change
+        if not self.update_ruleset:
+            return None
+        f = tempfile.NamedTemporaryFile(dir=self.TMP_DIR)
+        if not self.update_ruleset(f, conditional = not self.firstimport):
+            f.close()
+            return None
+        return f
+
+    def apply_update(self, f):
         if self.update_ruleset:
-            f = tempfile.NamedTemporaryFile(dir=self.TMP_DIR)
-            self.update_ruleset(f)
+            # nothing to import, commit or test if upstream did not change
+            if f == None:
+                self.count_update(skipped = True)
+                return
             if self.datatype == 'sigs':
                 self.handle_rules_in_tar(f)
             elif self.datatype == 'sig':
                 self.handle_rules_file(f)
             elif self.datatype == 'other':
                 self.handle_other_file(f)
-        if not self.datatype == 'other' and not firstimport:
+            f.close()
+        if not self.datatype == 'other' and not self.firstimport:
             self.create_update()
         for rule in self.updated_rules["deleted"]:
             rule.delete()
-        self.needs_test()
+        # nothing to test if the rules did not change
+        if self.datatype == 'other' or self.has_changes():
+            self.needs_test()
+        if self.update_ruleset:
+            self.count_update()
+
+    def count_update(self, skipped = False):
+        # counters are incremented in database to not lose concurrent updates
+        if skipped:
+            Source.objects.filter(pk = self.pk).update(skipped_updates = F('skipped_updates') + 1)
+            self.skipped_updates += 1
+            return
+        fields = dict(self.fetch_state)
+        for key in fields:
+            setattr(self, key, fields[key])
+        fields['full_updates'] = F('full_updates') + 1
+        Source.objects.filter(pk = self.pk).update(**fields)
+        self.full_updates += 1
 
     def diff(self):
         source_git_dir = os.path.join(settings.GIT_SOURCES_BASE_DIRECTORY, str(self.pk))
@@ -398,17 +537,13 @@ class Source(models.Model):
         from django.core.urlresolvers import reverse
         return reverse('source', args=[str(self.id)])
 
-    def update_ruleset_http(self, f):
-        proxy_params = get_system_settings().get_proxy_params()
-        if self.authkey:
-            hdrs = { 'Authorization': self.authkey }
-        else:
-            hdrs = None
+    def http_get(self, uri, headers = None, stream = False):
+        proxy_params = self.proxy_params
         try:
             if proxy_params:
-                resp = requests.get(self.uri, proxies = proxy_params, headers = hdrs, verify = self.cert_verif)
+                resp = requests.get(uri, proxies = proxy_params, headers = headers, verify = self.cert_verif, stream = stream)
             else:
-                resp = requests.get(self.uri, headers = hdrs, verify = self.cert_verif)
+                resp = requests.get(uri, headers = headers, verify = self.cert_verif, stream = stream)
             resp.raise_for_status()
         except requests.exceptions.ConnectionError, e:
             raise IOError("Connection error '%s'" % (e))
@@ -420,7 +555,57 @@ class Source(models.Model):
             raise IOError("Request timeout, server may be down")
         except requests.exceptions.TooManyRedirects:
             raise IOError("Too many redirects, server may be broken")
-        f.write(resp.content)
+        return resp
+
+    def get_remote_md5(self):
+        # md5 files are of the form "<md5sum>  <filename>" or just "<md5sum>"
+        hdrs = None
+        if self.authkey:
+            hdrs = { 'Authorization': self.authkey }
+        try:
+            resp = self.http_get(self.uri + '.md5', headers = hdrs)
+        except IOError:
+            return None
+        match = re.match(r"\s*([0-9a-fA-F]{32})\b", resp.text)
+        if not match:
+            return None
+        return match.groups()[0].lower()
+
+    def update_ruleset_http(self, f, conditional = False):
+        # return False if upstream content did not change since last download
+        source_git_dir = os.path.join(settings.GIT_SOURCES_BASE_DIRECTORY, str(self.pk))
+        if not self.checksum or not os.path.isdir(source_git_dir):
+            conditional = False
+        if self.check_md5 and conditional:
+            if self.get_remote_md5() == self.checksum:
+                return False
+        hdrs = {}
+        if self.authkey:
+            hdrs['Authorization'] = self.authkey
+        if conditional:
+            if self.etag:
+                hdrs['If-None-Match'] = self.etag
+            if self.last_modified:
+                hdrs['If-Modified-Since'] = self.last_modified
+        resp = self.http_get(self.uri, headers = hdrs, stream = True)
+        if resp.status_code == 304:
+            resp.close()
+            return False
+        # write archive to disk as it arrives to keep memory usage flat
+        digest = hashlib.md5()
+        try:
+            for chunk in resp.iter_content(chunk_size = self.DOWNLOAD_CHUNK_SIZE):
+                digest.update(chunk)
+                f.write(chunk)
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError), e:
+            raise IOError("Connection error during download '%s'" % (e))
+        finally:
+            resp.close()
+        f.flush()
+        self.fetch_state = { 'etag': resp.headers.get('ETag', ''),
+                             'last_modified': resp.headers.get('Last-Modified', ''),
+                             'checksum': digest.hexdigest() }
+        return True
 
     def handle_uploaded_file(self, f):
         dest = tempfile.NamedTemporaryFile(dir=self.TMP_DIR)
@@ -440,7 +625,10 @@ class Source(models.Model):
             self.create_update()
         for rule in self.updated_rules["deleted"]:
             rule.delete()
-        self.needs_test()
+        # nothing to test if the rules did not change
+        if self.datatype == 'other' or self.has_changes():
+            self.needs_test()
+        self.schedule_maintenance()
 
     def needs_test(self):
         try:
@@ -526,11 +714,8 @@ class Category(models.Model):
     descr = models.CharField(max_length=400, blank = True)
     created_date = models.DateTimeField('date created', default = timezone.now)
     source = models.ForeignKey(Source)
-
-    bitsregexp = {'flowbits': re.compile("flowbits *: *(isset|set),(.*?) *;"),
-                  'hostbits': re.compile("hostbits *: *(isset|set),(.*?) *;"),
-                  'xbits': re.compile("xbits *: *(isset|set),(.*?) *;"),
-                 }
+    # digest of the rules file at last import
+    content_hash = models.CharField(max_length=40, blank = True, default = '')
 
     class Meta:
         verbose_name_plural = "categories"
@@ -538,117 +723,10 @@ class Category(models.Model):
     def __unicode__(self):
         return self.name
 
-    def parse_rule_flowbit(self, source, line):
-        flowbits = []
-        for ftype in self.bitsregexp:
-            match = self.bitsregexp[ftype].findall(line)
-            if match:
-                for flowinst in match:
-                   elt = Flowbit.objects.filter(source = source, name = flowinst[1], type=ftype)
-                   if elt:
-                       elt = elt[0]
-                       if flowinst[0] == "isset" and not elt.isset:
-                           elt.isset = True
-                           elt.save()
-                       if flowinst[0] == "set" and not elt.set:
-                           elt.set = True
-                           elt.save()
-                   else:
-                       if flowinst[0] == "isset":
-                           fisset = True
-                           fset = False
-                       else:
-                           fisset = False
-                           fset = True
-                       elt = Flowbit(type = ftype, name = flowinst[1], source = source, isset = fisset, set = fset)
-                       elt.save()
-                   flowbits.append(elt)
-        return flowbits
-
     def get_rules(self, source):
         # parse file
-        # return an object with updates
-        getsid = re.compile("sid *: *(\d+)")
-        getrev = re.compile("rev *: *(\d+)")
-        getmsg = re.compile("msg *: *\"(.*?)\"")
-        source_git_dir = os.path.join(settings.GIT_SOURCES_BASE_DIRECTORY, str(self.source.pk))
-        rfile = open(os.path.join(source_git_dir, self.filename))
-
-        rules_update = {"added": [], "deleted": [], "updated": []}
-        rules_unchanged = []
-
-        existing_rules_hash = {}
-        for rule in Rule.objects.all():
-            existing_rules_hash[rule.sid] = rule
-        rules_list = []
-        for rule in Rule.objects.filter(category = self):
-            rules_list.append(rule)
-
-        # If no flowbits are knowned in the source we try
-        # to parse them all. There should be no database query for ruleset
-        # that are not using them. If there is some, then do it only in update.
-        with transaction.atomic():
-            for line in rfile.readlines():
-                state = True
-                if line.startswith('#'):
-                    # check if it is a commented signature
-                    if "->" in line and "sid" in line and ")" in line:
-                        line = line.lstrip("# ")
-                        state = False
-                    else:
-                        continue
-                match = getsid.search(line)
-                if not match:
-                    continue
-                sid = match.groups()[0]
-                match = getrev.search(line)
-                if match:
-                    rev = int(match.groups()[0])
-                else:
-                    rev = None
-                match = getmsg.search(line)
-                if not match:
-                    msg = ""
-                else:
-                    msg = match.groups()[0]
-                flowbits = []
-                if source.init_flowbits:
-                    flowbits = self.parse_rule_flowbit(source, line)
-                # FIXME detect if nothing has changed to avoir rules reload
-                if existing_rules_hash.has_key(int(sid)):
-                    # FIXME update references if needed
-                    rule = existing_rules_hash[int(sid)]
-                    if rev == None or rule.rev < rev or source.init_flowbits:
-                        rule.content = line
-                        if rev == None:
-                            rule.rev = 0
-                        else:
-                            rule.rev = rev
-                        if rule.category != self:
-                            rule.category = self
-                        if not source.init_flowbits:
-                            flowbits = self.parse_rule_flowbit(source, line)
-                        rule.flowbits = flowbits
-                        rules_update["updated"].append(rule)
-                        rule.save()
-                    else:
-                        rules_unchanged.append(rule)
-                else:
-                    if rev == None:
-                        rev = 0
-                    rule = Rule(category = self, sid = sid,
-                                        rev = rev, content = line, msg = msg,
-                                        state_in_source = state, state = state)
-                    if not source.init_flowbits:
-                        flowbits = self.parse_rule_flowbit(source, line)
-                    rule.flowbits = flowbits
-                    rules_update["added"].append(rule)
-            if len(rules_update["added"]):
-                Rule.objects.bulk_create(rules_update["added"])
-            rules_update["deleted"] = list(set(rules_list) -
-                                      set(rules_update["added"]).union(set(rules_update["updated"])) -
-                                      set(rules_unchanged))
-            source.aggregate_update(rules_update)
+        # update source with the changes
+        source.import_categories([self])
 
     def get_absolute_url(self):
         from django.core.urlresolvers import reverse
@@ -674,6 +752,10 @@ class Transformation(models.Model):
     rule = models.ForeignKey('Rule', on_delete=models.CASCADE, null=False, default=1)
     ruleset = models.ForeignKey('Ruleset', on_delete=models.CASCADE, null=False)
 
+    class Meta:
+        # used to get the transformation of each rule at ruleset generation
+        index_together = [('rule', 'ruleset')]
+
     def modify(self, action):
         if action == 'alert' or action == 'allow' or action == 'drop':
             self.datatype = action
@@ -683,6 +765,37 @@ class Transformation(models.Model):
     def __unicode__(self):
         return self.datatype
 
+def write_file_atomic(filename, chunks):
+    # file is written to a temporary file renamed at the end, so
+    # readers never see a partially written file
+    (fd, tmpname) = tempfile.mkstemp(dir = os.path.dirname(filename), prefix = '.' + os.path.basename(filename))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            for chunk in chunks:
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmpname, 0644)
+        os.rename(tmpname, filename)
+    except:
+        os.unlink(tmpname)
+        raise
+
+def transform_content(content, action):
+    # action is the datatype of the transformation of the rule
+    if action == 'allow':
+        return content.replace('alert', 'allow', 1)
+    elif action == 'drop':
+        return content.replace('alert', 'drop', 1)
+    return content
+
+def rule_line(content, action):
+    # line of the rule in generated rules files
+    line = transform_content(content, action)
+    if not line.endswith("\n"):
+        line += "\n"
+    return line
+
 class Rule(models.Model):
     sid = models.IntegerField(primary_key=True)
     category = models.ForeignKey(Category)
@@ -691,7 +804,11 @@ class Rule(models.Model):
     state_in_source = models.BooleanField(default=True)
     rev = models.IntegerField(default=0)
     content = models.CharField(max_length=10000)
+    # digest of the normalized content, used to detect changes at import
+    content_hash = models.CharField(max_length=40, blank = True, default = '')
     flowbits = models.ManyToManyField(Flowbit)
+    # connected component of rules linked by flowbits, computed at import
+    flowbits_group = models.IntegerField(blank = True, null = True, db_index = True)
     transformations = models.ManyToManyField('Ruleset', through=Transformation, blank=True)
 
     hits = 0
@@ -704,11 +821,9 @@ class Rule(models.Model):
         return reverse('rule', args=[str(self.sid)])
 
     def get_flowbits_group(self):
-        rules = set()
-        for flowbit in self.flowbits.all():
-            rules_dep = Rule.objects.filter(category = self.category, flowbits = flowbit)
-            rules |= set(rules_dep)
-        return rules
+        if self.flowbits_group == None:
+            return set()
+        return set(Rule.objects.filter(flowbits_group = self.flowbits_group))
 
     def enable(self, ruleset):
         enable_rules = self.get_flowbits_group()
@@ -737,19 +852,14 @@ class Rule(models.Model):
             rule.save()
 
     def content_updated(self, ruleset):
-        data = self.transformations.filter(ruleset=ruleset)
+        data = Transformation.objects.filter(rule=self, ruleset=ruleset)
 
         #TODO Erase next line
         # If it was a problem creating the transformation during the ruleset creation it sends the default content with alert
         if not data:
             return self.content
 
-        if data[0].datatype == 'alert':
-            return self.content
-        elif data[0].datatype == 'allow':
-            return self.content.replace('alert', 'allow', 1)
-        elif data[0].datatype == 'drop':
-            return self.content.replace('alert', 'drop', 1)
+        return transform_content(self.content, data[0].datatype)
 
     def transformation_type(self, ruleset):
         trans = Transformation.objects.get(rule=self, ruleset=ruleset)
@@ -770,7 +880,57 @@ class Rule(models.Model):
             elif trans != action:
                 trans.modify(action)
 
+class SidMap(object):
+    """
+    In process map of sid to (msg, category) of the rules displayed
+    with Elasticsearch statistics, filled on demand. It is cleared when
+    a source is imported or deleted in this process and when sources
+    have changed in another process.
+    """
+    def __init__(self):
+        self.rules = {}
+        self.version = None
+        self.lock = threading.Lock()
+
+    def clear(self):
+        with self.lock:
+            self.rules = {}
+            self.version = None
+
+    def get_version(self):
+        # changes when a source is added, updated or deleted
+        sources = Source.objects.aggregate(count = Count('pk'), updated = Max('updated_date'))
+        return (sources['count'], sources['updated'])
+
+    def get(self, sids):
+        version = self.get_version()
+        with self.lock:
+            if version != self.version:
+                self.rules = {}
+                self.version = version
+            known = dict([ (sid, self.rules[sid]) for sid in sids if self.rules.has_key(sid) ])
+        missing = [ sid for sid in sids if not known.has_key(sid) ]
+        if len(missing):
+            found = {}
+            for rule in Rule.objects.select_related('category').filter(sid__in = missing).only('sid', 'msg', 'category'):
+                found[rule.sid] = (rule.msg, rule.category)
+            with self.lock:
+                if version == self.version:
+                    self.rules.update(found)
+            known.update(found)
+        return known
+
+    def get_rules(self, sids):
+        # return unsaved Rule objects for display, in the order of sids
+        known = self.get(sids)
+        rules = []
+        for sid in sids:
+            if known.has_key(sid):
+                (msg, category) = known[sid]
+                rules.append(Rule(sid = sid, msg = msg, category = category))
+        return rules
 
+sid_map = SidMap()
 
 # we should use django reversion to keep track of this one
 # even if fixing HEAD may be complicated
@@ -786,6 +946,9 @@ class Ruleset(models.Model):
 
     editable = True
 
+    # size of chunks of the generated rules file
+    RULES_CHUNK_SIZE = 64 * 1024
+
     # List of Source that can be used in the ruleset
     # It can be a specific version or HEAD if we want to use
     # latest available
@@ -827,22 +990,40 @@ class Ruleset(models.Model):
         from django.core.urlresolvers import reverse
         return reverse('ruleset', args=[str(self.id)])
 
-    def update(self):
-        sourcesatversion = self.sources.all()
-        for sourcesat in sourcesatversion:
-            sourcesat.source.update()
+    def update(self, progress = None):
+        from rules.orchestrator import UpdateOrchestrator
+        sources = [ sourcesat.source for sourcesat in self.sources.select_related('source') ]
+        orchestrator = UpdateOrchestrator(sources, progress = progress)
+        self.update_report = orchestrator.run()
 #            for cat in Category.objects.filter(source=sourcesat):
 #                for rule in Rule.objects.filter(category=cat):
 #                    rule.transform(rule.transformation, ruleset=self)
         self.updated_date = timezone.now()
         self.need_test = True
         self.save()
+        errors = orchestrator.errors()
+        if len(errors):
+            raise IOError(", ".join(errors))
 
     def generate(self):
         rules = Rule.objects.filter(category__in = self.categories.all(), state = True)
         # remove suppressed list
-        rules = list(set(rules.all()) - set(self.suppressed_rules.all()))
-        return rules
+        return rules.exclude(pk__in = self.suppressed_rules.all())
+
+    def generate_rules(self, selection = None):
+        """
+        Iterate on (sid, content, action) of the rules of the ruleset, with
+        action the datatype of the rule transformation or None. Selection of
+        rules and transformations are done by the database in one query.
+        selection is an optional Q object restricting the rules.
+        """
+        action = 'SELECT datatype FROM %s WHERE rule_id = %s.sid AND ruleset_id = %%s LIMIT 1' % \
+                 (Transformation._meta.db_table, Rule._meta.db_table)
+        rules = self.generate()
+        if selection != None:
+            rules = rules.filter(selection)
+        rules = rules.order_by('sid').extra(select = {'action': action}, select_params = (self.pk,))
+        return rules.values_list('sid', 'content', 'action').iterator()
 
     def generate_threshold(self, directory):
         thresholdfile = os.path.join(directory, 'threshold.config')
@@ -887,35 +1068,61 @@ class Ruleset(models.Model):
                     sdiff[sourceat.name] = srcdiff
         return sdiff
 
+    def rules_header(self):
+        return "# Rules file for " + self.name + " generated by Scirius at " + str(timezone.now()) + "\n"
+
+    def iter_buffer(self, header = None):
+        """
+        Iterate on chunks of the rules file of the ruleset. Rules are read
+        from a database cursor so memory use doesn't depend on the number
+        of rules.
+        """
+        if header == None:
+            header = self.rules_header()
+        chunk = [ header.encode('utf-8') ]
+        size = len(chunk[0])
+        self.rules_count = 0
+        for (sid, content, action) in self.generate_rules():
+            line = rule_line(content, action).encode('utf-8')
+            chunk.append(line)
+            size += len(line)
+            self.rules_count += 1
+            if size >= self.RULES_CHUNK_SIZE:
+                yield "".join(chunk)
+                chunk = []
+                size = 0
+        if len(chunk):
+            yield "".join(chunk)
+
     def to_buffer(self):
-        rules = self.generate()
-        self.rules_count = len(rules)
-        file_content = "# Rules file for " + self.name + " generated by Scirius at " + str(timezone.now()) + "\n"
-        rules_content = [ rule.content_updated(self) for rule in rules ]
-        file_content += "\n".join(rules_content)
-        return file_content
+        return "".join(self.iter_buffer())
 
-    def test_rule_buffer(self, rule_buffer, single = False):
+    def write_rules(self, filename, header = None):
+        write_file_atomic(filename, self.iter_buffer(header))
+        return self.rules_count
+
+    def get_build(self):
+        # generated files from the build cache, only rebuilt on changes
+        from rules.build_cache import get_build
+        return get_build(self)
+
+    def test_rule_buffer(self, rule_buffer, single = False, build = None):
         Probe = __import__(settings.RULESET_MIDDLEWARE)
         testor = Probe.common.Test()
-        tmpdir = tempfile.mkdtemp()
-        self.export_files(tmpdir)
-        related_files = {}
-        for root, _, files in os.walk(tmpdir):
-            for f in files:
-                fullpath = os.path.join(root, f)
-                with open(fullpath, 'r') as cf:
-                    related_files[f] = cf.read( 50 * 1024)
-        shutil.rmtree(tmpdir)
+        if build == None:
+            build = self.get_build()
+        related_files = build.related_files()
         if single:
             return testor.rule(rule_buffer, related_files = related_files)
         else:
             return testor.rules(rule_buffer, related_files = related_files)
 
-    def test(self):
+    def test(self, full = False):
+        # only rules changed since last validation are tested, unless
+        # full is set or a full test is due
+        from rules.validation import validate_ruleset
         self.need_test = False
-        rule_buffer = self.to_buffer()
-        result = self.test_rule_buffer(rule_buffer)
+        result = validate_ruleset(self, full = full)
         result['rules_count'] = self.rules_count
         self.validity = result['status']
         if result.has_key('errors'):
@@ -937,6 +1144,25 @@ class Ruleset(models.Model):
         self.need_test = True
         self.save()
 
+class RulesetValidation(models.Model):
+    # state of the last validation of a ruleset, used to only test the
+    # rules changed since then
+    ruleset = models.OneToOneField(Ruleset, related_name = 'validation')
+    valid = models.BooleanField(default = False)
+    # digest of the Suricata configuration and related files
+    config_hash = models.CharField(max_length=40, blank = True)
+    full_date = models.DateTimeField('date of last full test', blank = True, null = True)
+    # JSON list of [sid, digest of generated rule] of the validated rules
+    rules = models.TextField(blank = True)
+
+    def get_rules(self):
+        if not self.rules:
+            return {}
+        return dict([ (sid, digest) for (sid, digest) in json.loads(self.rules) ])
+
+    def set_rules(self, rules):
+        self.rules = json.dumps(sorted(rules.items()), separators = (',', ':'))
+
 class Threshold(models.Model):
     THRESHOLD_TYPES = (('threshold', 'threshold'), ('suppress', 'suppress'))
     THRESHOLD_TYPE_TYPES = (('limit', 'limit'), ('threshold', 'threshold'), ('both', 'both'))
@@ -975,6 +1201,74 @@ class Threshold(models.Model):
                 return False
         return True
 
+class Job(models.Model):
+    STATUS = (
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    )
+    action = models.CharField(max_length=50)
+    # JSON encoded arguments of the job handler
+    args = models.TextField(default = '{}')
+    # identical pending jobs share the same key
+    key = models.CharField(max_length=400, db_index = True)
+    # digest of key while the job is pending, the unique constraint
+    # prevents concurrent submissions from creating the same job twice
+    pending_key = models.CharField(max_length=40, unique = True, null = True, blank = True)
+    # number of times the job was started, it is started again when
+    # its worker stopped updating heartbeat_date
+    attempts = models.IntegerField(default=0)
+    heartbeat_date = models.DateTimeField('date of last sign of life', blank = True, null = True)
+    status = models.CharField(max_length=10, choices=STATUS, default = 'pending', db_index = True)
+    progress = models.IntegerField(default=0)
+    message = models.TextField(blank = True)
+    # JSON encoded value returned by the job handler
+    result = models.TextField(blank = True)
+    worker = models.CharField(max_length=200, blank = True)
+    created_date = models.DateTimeField('date created', default = timezone.now)
+    started_date = models.DateTimeField('date started', blank = True, null = True)
+    finished_date = models.DateTimeField('date finished', blank = True, null = True)
+
+    def __unicode__(self):
+        return "%s #%d (%s)" % (self.action, self.pk, self.status)
+
+    def set_progress(self, progress, message = None):
+        self.progress = progress
+        if message != None:
+            self.message = message
+        self.heartbeat_date = timezone.now()
+        Job.objects.filter(pk = self.pk).update(progress = self.progress, message = self.message,
+                                                heartbeat_date = self.heartbeat_date)
+
+    def to_dict(self):
+        job = { 'id': self.pk, 'action': self.action, 'status': self.status,
+                'progress': self.progress, 'message': self.message, 'result': None }
+        if self.result:
+            job['result'] = json.loads(self.result)
+        return job
+
+class AlertRollup(models.Model):
+    # number of alerts per hour, built from Elasticsearch by the
+    # rollup_alerts command to answer queries on long time ranges
+    hour = models.DateTimeField(db_index = True)
+    host = models.CharField(max_length=200)
+    sid = models.IntegerField()
+    count = models.IntegerField()
+
+class RollupState(models.Model):
+    # hours from first_hour included to last_hour excluded are rolled up
+    first_hour = models.DateTimeField()
+    last_hour = models.DateTimeField()
+
+def get_flowbits_closure(rules):
+    # rules and all rules depending on them through flowbits
+    closure = set(rules)
+    groups = set([ rule.flowbits_group for rule in rules if rule.flowbits_group != None ])
+    if len(groups):
+        closure |= set(Rule.objects.filter(flowbits_group__in = list(groups)))
+    return closure
+
 def dependencies_check(obj):
     if obj == Source:
         return
@@ -0,0 +1,104 @@
+"""
+Copyright(C) 2016, Stamus Networks
+Written by Eric Leblond <eleblond@stamus-networks.com>
+
+This file is part of Scirius.
+
+Scirius is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Scirius is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Scirius.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from django.conf import settings
+from django.db import transaction
+
+from multiprocessing.pool import ThreadPool
+from time import time
+
+class UpdateOrchestrator(object):
+    """
+    Update a list of sources in two phases.
+
+    Downloads are done in parallel by a pool of threads which do not
+    access the database. Imports are then applied one source at a time,
+    each one in its own transaction.
+    """
+    def __init__(self, sources, threads = None, progress = None):
+        self.sources = sources
+        # progress(percent, message) is only called from the caller thread
+        self.progress = progress
+        if threads == None:
+            threads = settings.SOURCE_UPDATE_THREADS
+        self.threads = max(1, min(threads, len(sources)))
+        self.report = []
+
+    def fetch(self, index):
+        source = self.sources[index]
+        result = self.report[index]
+        start = time()
+        try:
+            result['file'] = source.fetch_update()
+        except Exception, e:
+            result['status'] = 'failed'
+            result['error'] = "%s: %s" % (source.name, e)
+        result['fetch_time'] = time() - start
+
+    def apply(self, index):
+        source = self.sources[index]
+        result = self.report[index]
+        start = time()
+        try:
+            with transaction.atomic():
+                source.apply_update(result['file'])
+            source.schedule_maintenance()
+            if source.update_ruleset and result['file'] == None:
+                result['status'] = 'skipped'
+            else:
+                result['status'] = 'updated'
+        except Exception, e:
+            # a failing source must not prevent the others from being applied
+            result['status'] = 'failed'
+            result['error'] = "%s: %s" % (source.name, e)
+        result['apply_time'] = time() - start
+
+    def run(self):
+        self.report = []
+        for source in self.sources:
+            self.report.append({ 'source': source.name, 'pk': source.pk, 'status': None, 'error': None,
+                                 'fetch_time': 0.0, 'apply_time': 0.0, 'file': None })
+            source.prepare_update()
+        if len(self.sources):
+            pool = ThreadPool(self.threads)
+            try:
+                pool.map(self.fetch, range(len(self.sources)))
+            finally:
+                pool.close()
+                pool.join()
+        self.set_progress(50, "Sources downloaded")
+        for index in xrange(len(self.sources)):
+            if self.report[index]['status'] != 'failed':
+                self.apply(index)
+            elif self.report[index]['file']:
+                self.report[index]['file'].close()
+            self.set_progress(50 + 50 * (index + 1) / len(self.sources),
+                              "Source '%s' applied" % (self.sources[index].name))
+        for result in self.report:
+            del(result['file'])
+        return self.report
+
+    def set_progress(self, percent, message):
+        if self.progress:
+            self.progress(percent, message)
+
+    def errors(self):
+        return [ result['error'] for result in self.report if result['status'] == 'failed' ]
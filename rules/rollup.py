@@ -0,0 +1,126 @@
+"""
+Copyright(C) 2014, 2015 Stamus Networks
+Written by Eric Leblond <eleblond@stamus-networks.com>
+
+This file is part of Scirius.
+
+Scirius is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Scirius is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Scirius.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from rules.models import AlertRollup, RollupState
+
+from datetime import datetime, timedelta
+from calendar import timegm
+
+# Alerts are rolled up per hour in AlertRollup. Queries on time ranges
+# longer than ELASTICSEARCH_ROLLUP_MIN_RANGE hours use the rolled up hours
+# and only ask Elasticsearch for the alerts after the last rolled up one.
+
+HOUR = timedelta(hours = 1)
+# sid of the alerts of signatures not in the top terms of a host
+OTHER_SID = 0
+
+def to_datetime(date):
+    # date in milliseconds since epoch
+    return datetime.utcfromtimestamp(int(date) / 1000).replace(tzinfo = timezone.utc)
+
+def to_millis(date):
+    return timegm(date.utctimetuple()) * 1000
+
+def floor_hour(date):
+    return date.replace(minute = 0, second = 0, microsecond = 0)
+
+def get_state():
+    states = RollupState.objects.all()
+    if len(states):
+        return states[0]
+    return None
+
+def rollup_end(from_date):
+    """
+    Return the end of rolled up hours if they can be used to answer a
+    query starting at from_date, None otherwise.
+    """
+    if not settings.ELASTICSEARCH_ROLLUP or not settings.ELASTICSEARCH_2X or not from_date:
+        return None
+    start = to_datetime(from_date)
+    if timezone.now() - start < timedelta(hours = settings.ELASTICSEARCH_ROLLUP_MIN_RANGE):
+        return None
+    state = get_state()
+    if state == None or start < state.first_hour or start >= state.last_hour:
+        return None
+    return state.last_hour
+
+def hours_to_roll(days):
+    # complete hours not yet rolled up, starting days ago on first run,
+    # an hour is complete ELASTICSEARCH_ROLLUP_DELAY minutes after its end
+    # so alerts indexed late are counted
+    end = floor_hour(timezone.now() - timedelta(minutes = settings.ELASTICSEARCH_ROLLUP_DELAY))
+    state = get_state()
+    if state == None:
+        start = end - timedelta(days = days)
+    else:
+        start = state.last_hour
+    hours = []
+    while start < end:
+        hours.append(start)
+        start += HOUR
+    return hours
+
+def store_hour(hour, rows):
+    # rows are (host, sid, count)
+    with transaction.atomic():
+        AlertRollup.objects.filter(hour = hour).delete()
+        AlertRollup.objects.bulk_create([ AlertRollup(hour = hour, host = host, sid = sid, count = count)
+                                          for (host, sid, count) in rows ])
+        state = get_state()
+        if state == None:
+            RollupState.objects.create(first_hour = hour, last_hour = hour + HOUR)
+        else:
+            state.first_hour = min(state.first_hour, hour)
+            state.last_hour = max(state.last_hour, hour + HOUR)
+            state.save()
+
+def prune(days):
+    # drop rolled up hours older than days
+    limit = floor_hour(timezone.now()) - timedelta(days = days)
+    with transaction.atomic():
+        deleted = AlertRollup.objects.filter(hour__lt = limit).count()
+        AlertRollup.objects.filter(hour__lt = limit).delete()
+        state = get_state()
+        if state != None and state.first_hour < limit:
+            state.first_hour = min(limit, state.last_hour)
+            state.save()
+    return deleted
+
+def rollup_hits(from_date, hostname = '*'):
+    # sid -> number of alerts, from the hour containing from_date
+    hits = AlertRollup.objects.filter(hour__gte = floor_hour(to_datetime(from_date))).exclude(sid = OTHER_SID)
+    if hostname != '*':
+        hits = hits.filter(host = hostname)
+    return dict([ (hit['sid'], hit['hits']) for hit in hits.values('sid').annotate(hits = Sum('count')) ])
+
+def rollup_timeline(from_date, hosts = None):
+    # list of (host, hour in milliseconds, number of alerts), of all hosts
+    # or only of the hosts in the hosts list
+    hours = AlertRollup.objects.filter(hour__gte = floor_hour(to_datetime(from_date)))
+    if hosts:
+        hours = hours.filter(host__in = hosts)
+    return [ (hour['host'], to_millis(hour['hour']), hour['hits'])
+             for hour in hours.values('host', 'hour').annotate(hits = Sum('count')) ]
@@ -28,13 +28,129 @@ $( 'document' ).ready(function() {
         prepare_rule_details();
 });
 
+/* Wait for a background job and call success with its result */
+function wait_job(job, success, error, progress) {
+    if (job['status'] == 'done') {
+        success(job['result']);
+        return;
+    }
+    if (job['status'] == 'failed') {
+        if (error) {
+            error(job);
+        }
+        return;
+    }
+    if (progress) {
+        progress(job);
+    }
+    setTimeout(function() {
+        $.ajax({
+            type:"GET",
+            url:"/rules/job/" + job['id'] + "/",
+            success: function(data) {
+                wait_job(data['job'], success, error, progress);
+            },
+            error: error,
+        });
+    }, 1000);
+}
+
+/* Same as $.ajax for views returning a background job */
+function job_ajax(options) {
+    var success = options.success;
+    var error = options.error;
+    var progress = options.progress;
+    options.success = function(data) {
+        if (data == null || data['job'] == undefined) {
+            success(data);
+        } else {
+            wait_job(data['job'], success, error, progress);
+        }
+    };
+    return $.ajax(options);
+}
+
+/* Same as $.ajax for dashboard queries to /rules/es: queries issued in
+   the same run of the page scripts are sent in a single batch request */
+var es_batch_queries = ['rules', 'timeline', 'logstash_eve', 'rules_per_category', 'alerts_count', 'latest_stats'];
+var es_batch = [];
+
+function es_query_params(url) {
+    var params = {};
+    var qs = url.split('?')[1];
+    if (qs == undefined) {
+        return params;
+    }
+    var args = qs.split('&');
+    for (var i = 0; i < args.length; i++) {
+        var idx = args[i].indexOf('=');
+        if (idx > 0) {
+            params[args[i].substring(0, idx)] = decodeURIComponent(args[i].substring(idx + 1));
+        }
+    }
+    return params;
+}
+
+function es_batch_flush() {
+    var batch = es_batch;
+    es_batch = [];
+    if (batch.length == 1) {
+        $.ajax(batch[0].options);
+        return;
+    }
+    var panels = [];
+    for (var i = 0; i < batch.length; i++) {
+        panels.push(batch[i].params);
+    }
+    $.ajax({
+        type: "GET",
+        url: "/rules/es/batch?panels=" + encodeURIComponent(JSON.stringify(panels)),
+        /* callbacks are called with the context of each query, as $.ajax does */
+        success: function(data, status, xhr) {
+            for (var i = 0; i < batch.length; i++) {
+                var options = batch[i].options;
+                if (options.success) {
+                    options.success.call(options.context || options, data[i], status, xhr);
+                }
+            }
+        },
+        error: function(xhr, status, error) {
+            for (var i = 0; i < batch.length; i++) {
+                var options = batch[i].options;
+                if (options.error) {
+                    options.error.call(options.context || options, xhr, status, error);
+                }
+            }
+        },
+        complete: function(xhr, status) {
+            for (var i = 0; i < batch.length; i++) {
+                var options = batch[i].options;
+                if (options.complete) {
+                    options.complete.call(options.context || options, xhr, status);
+                }
+            }
+        }
+    });
+}
+
+function es_ajax(options) {
+    var params = es_query_params(options.url);
+    if (es_batch_queries.indexOf(params['query']) == -1) {
+        return $.ajax(options);
+    }
+    if (es_batch.length == 0) {
+        setTimeout(es_batch_flush, 0);
+    }
+    es_batch.push({params: params, options: options});
+}
+
 
 function load_rules(from_date, hosts, filter) {
     var tgturl = "/rules/es?query=rules&host=" + hosts.join() + "&from_date=" + from_date;
     if (filter != null) {
        tgturl = tgturl + "&filter=" + filter;
     }
-    $.ajax({
+    es_ajax({
        url: tgturl,
           success: function(data) {
              if (data == null) {
@@ -55,18 +171,40 @@ function load_rules(from_date, hosts, filter) {
     });
 }
 
+/* Convert timeline in columns format, a shared time axis and a list of
+   values per host, to the entries of each host */
+function columns_to_entries(data, field) {
+    if (data == null || data['format'] != 'columns') {
+        return data;
+    }
+    var rdata = {from_date: data['from_date'], interval: data['interval']};
+    for (var host in data['values']) {
+        var values = data['values'][host];
+        var entries = [];
+        for (var i = 0; i < data['times'].length; i++) {
+            if (values[i] != null) {
+                var entry = {time: data['times'][i]};
+                entry[field] = values[i];
+                entries.push(entry);
+            }
+        }
+        rdata[host] = {entries: entries};
+    }
+    return rdata;
+}
 
 function draw_timeline(from_date, hosts, filter) {
 
-        esurl = "/rules/es?query=timeline&from_date=" + from_date + "&hosts=" + hosts.join()
+        esurl = "/rules/es?query=timeline&format=columns&from_date=" + from_date + "&hosts=" + hosts.join()
         if (filter) {
             esurl = esurl + "&filter=" + filter;
         }
-        $.ajax(
+        es_ajax(
                         {
                         type:"GET",
                         url:esurl,
                         success: function(data) {
+                        data = columns_to_entries(data, "count");
                         if (data == null) {
                             $("#timeline p").text("Unable to get data.");
                             $("#error").text("Unable to get data from Elasticsearch");
@@ -174,13 +312,14 @@ function draw_stats_timeline(from_date, value, tdiv, speed, hosts) {
             hosts_list = "";
             hosts = ['global'];
         }
-        esurl = "/rules/es?query=logstash_eve&from_date=" + from_date + "&value=" + value + hosts_list
+        esurl = "/rules/es?query=logstash_eve&format=columns&from_date=" + from_date + "&value=" + value + hosts_list
 
-        $.ajax(
+        es_ajax(
                         {
                         type:"GET",
                         url:esurl,
                         success: function(data) {
+                        data = columns_to_entries(data, "mean");
                         if (data == null) {
                             $("#logstash span").text("Unable to get data.");
                             $("#error").text("Unable to get data from Elasticsearch");
@@ -281,7 +420,7 @@ function draw_sunburst(from_date, hosts, filter, callback) {
         if (filter) {
             esurl = esurl + "&filter=" + filter;
         }
-        $.ajax(
+        es_ajax(
          {
          type:"GET",
          url:esurl,
@@ -429,7 +568,7 @@ function draw_circle(from_date, hosts, filter, callback) {
         if (filter) {
             esurl = esurl + "&filter=" + filter;
         }
-        $.ajax(
+        es_ajax(
          {
          type:"GET",
          url:esurl,
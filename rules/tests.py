@@ -19,12 +19,30 @@ along with Scirius.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 from django.test import TestCase
+from django.core.exceptions import SuspiciousOperation
+from django.db import IntegrityError, transaction
 
 from django.utils import timezone
+from django.conf import settings
+from elasticsearch import Elasticsearch, Connection, Transport
 
-from models import Source, SourceAtVersion, Category
+from models import Source, SourceAtVersion, SourceUpdate, Job, Category, Rule, Flowbit, Ruleset, Transformation, sid_map
+from orchestrator import UpdateOrchestrator
+from jobs import submit_job, claim_job, run_job
+from gitsources import maintain_source
+from es_cache import ResultCache
+import es_graphs
+import es_data
+import es_query
+import rollup
 
 import tempfile
+import json
+import tarfile
+import os
+import threading
+from time import sleep
+from datetime import datetime, timedelta
 from shutil import rmtree
 
 class SourceCreationTestCase(TestCase):
@@ -45,3 +63,810 @@ class SourceCreationTestCase(TestCase):
         self.source.update()
         self.assertEqual(len(SourceAtVersion.objects.filter(source = self.source)), 1)
         self.assertNotEqual(len(Category.objects.filter(source = self.source)), 0)
+
+class SourceImportTestCase(TestCase):
+    RULES = {
+        'rules/first.rules': [
+            'alert tcp any any -> any any (msg:"first set"; flowbits:set,test.bit; flowbits:noalert; sid:1000001; rev:1;)\n',
+            'alert tcp any any -> any any (msg:"first isset"; flowbits:isset,test.bit; sid:1000002; rev:1;)\n',
+            '# alert tcp any any -> any any (msg:"first commented"; sid:1000003; rev:1;)\n',
+            '# This is a comment\n',
+        ],
+        'rules/second.rules': [
+            'alert tcp any any -> any any (msg:"second"; sid:1000004; rev:1;)\n',
+        ],
+    }
+
+    def setUp(self):
+        self.tmpdirname = tempfile.mkdtemp()
+        self.settings_override = self.settings(GIT_SOURCES_BASE_DIRECTORY=self.tmpdirname)
+        self.settings_override.enable()
+        self.source = Source.objects.create(name="Local test",
+                                   method = "local",
+                                   datatype = "sigs",
+                                   created_date=timezone.now())
+
+    def tearDown(self):
+        self.settings_override.disable()
+        rmtree(self.tmpdirname)
+
+    def build_tar(self, rules):
+        srcdir = tempfile.mkdtemp(dir = self.tmpdirname)
+        os.makedirs(os.path.join(srcdir, 'rules'))
+        for filename in rules:
+            with open(os.path.join(srcdir, filename), 'w') as rfile:
+                rfile.write("".join(rules[filename]))
+        tfile = tempfile.NamedTemporaryFile(dir = self.tmpdirname)
+        tar = tarfile.open(fileobj = tfile, mode = 'w:gz')
+        tar.add(os.path.join(srcdir, 'rules'), 'rules')
+        tar.close()
+        tfile.flush()
+        rmtree(srcdir)
+        return tfile
+
+    def import_tar(self, rules):
+        source = Source.objects.get(pk = self.source.pk)
+        tfile = self.build_tar(rules)
+        source.handle_rules_in_tar(tfile)
+        tfile.close()
+        return source
+
+    def test_update_with_maintenance(self):
+        """Test source updates with git history squashed by maintenance"""
+        versions = [ self.RULES ]
+        for rev in (2, 3):
+            modified = dict(self.RULES)
+            modified['rules/second.rules'] = [ 'alert tcp any any -> any any (msg:"second"; sid:1000004; rev:%d;)\n' % (rev) ]
+            versions.append(modified)
+        # the previous version is kept for the diff of the source
+        with self.settings(GIT_SOURCES_KEEP_VERSIONS = 1, GIT_SOURCES_LOOSE_OBJECTS = 0):
+            for rules in versions:
+                source = Source.objects.get(pk = self.source.pk)
+                tfile = self.build_tar(rules)
+                def fetch(f, conditional = False):
+                    tfile.seek(0)
+                    f.write(tfile.read())
+                    f.flush()
+                    return True
+                source.update_ruleset = fetch
+                source.update()
+                tfile.close()
+        repo = source.get_git_repo()
+        self.assertEqual(len(list(repo.iter_commits('master'))), 2)
+        self.assertEqual(len(source.diff()), 1)
+        self.assertEqual(SourceUpdate.objects.filter(source = source).latest('created_date').version, repo.head.commit.hexsha)
+        self.assertEqual(Job.objects.filter(action = 'git_maintenance', status = 'done').count(), 3)
+
+    def test_source_import(self):
+        """Test import of a tar source"""
+        self.import_tar(self.RULES)
+        self.assertEqual(Category.objects.filter(source = self.source).count(), 2)
+        self.assertEqual(Rule.objects.filter(category__source = self.source).count(), 4)
+        self.assertFalse(Rule.objects.get(sid = 1000003).state)
+        self.assertEqual(Rule.objects.get(sid = 1000004).category.name, 'second')
+        flowbit = Flowbit.objects.get(source = self.source, name = 'test.bit')
+        self.assertTrue(flowbit.set)
+        self.assertTrue(flowbit.isset)
+        self.assertEqual(Rule.objects.filter(flowbits = flowbit).count(), 2)
+
+    def test_source_reimport(self):
+        """Test update of a tar source"""
+        self.import_tar(self.RULES)
+        rules = dict(self.RULES)
+        rules['rules/second.rules'] = [
+            'alert tcp any any -> any any (msg:"second updated"; sid:1000004; rev:2;)\n',
+            'alert tcp any any -> any any (msg:"moved"; flowbits:isset,test.bit; sid:1000002; rev:2;)\n',
+        ]
+        rules['rules/first.rules'] = self.RULES['rules/first.rules'][:1]
+        source = self.import_tar(rules)
+        self.assertEqual(sorted([ rule.sid for rule in source.updated_rules['updated'] ]), [1000002, 1000004])
+        self.assertEqual([ rule.sid for rule in source.updated_rules['deleted'] ], [1000003])
+        self.assertEqual(source.updated_rules['added'], [])
+        rule = Rule.objects.get(sid = 1000002)
+        self.assertEqual(rule.category.name, 'second')
+        self.assertEqual(rule.msg, 'moved')
+        self.assertEqual(rule.rev, 2)
+        self.assertEqual(rule.flowbits.count(), 1)
+
+    def test_source_identical_reimport(self):
+        """Test that an identical source does not touch rules"""
+        self.import_tar(self.RULES)
+        source = self.import_tar(self.RULES)
+        self.assertFalse(source.has_changes())
+        rules = dict(self.RULES)
+        # same revision but content has changed
+        rules['rules/second.rules'] = [
+            'alert tcp any any -> any any (msg:"second"; content:"new"; sid:1000004; rev:1;)\n',
+        ]
+        source = self.import_tar(rules)
+        self.assertEqual([ rule.sid for rule in source.updated_rules['updated'] ], [1000004])
+        self.assertEqual(source.updated_rules['deleted'], [])
+        self.assertNotEqual(Category.objects.get(source = self.source, name = 'second').content_hash, '')
+
+    def test_source_git_tree(self):
+        """Test that only changed files are written and committed"""
+        source = self.import_tar(self.RULES)
+        repo = source.get_git_repo()
+        first_path = os.path.join(self.tmpdirname, str(self.source.pk), 'rules', 'first.rules')
+        first_inode = os.stat(first_path).st_ino
+        self.import_tar(self.RULES)
+        self.assertEqual(len(list(repo.iter_commits())), 1)
+        rules = { 'rules/first.rules': self.RULES['rules/first.rules'] }
+        self.import_tar(rules)
+        self.assertEqual(len(list(repo.iter_commits())), 2)
+        self.assertEqual([ blob.path for blob in repo.head.commit.tree['rules'].blobs ], ['rules/first.rules'])
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdirname, str(self.source.pk), 'rules', 'second.rules')))
+        self.assertEqual(os.stat(first_path).st_ino, first_inode)
+        self.assertFalse(repo.is_dirty(untracked_files = True))
+
+    def test_source_git_maintenance(self):
+        """Test squash of source git history"""
+        for rev in range(1, 5):
+            rules = { 'rules/first.rules': [ 'alert tcp any any -> any any (msg:"first"; sid:1000001; rev:%d;)\n' % (rev) ] }
+            source = self.import_tar(rules)
+        repo = source.get_git_repo()
+        tree = repo.head.commit.tree.hexsha
+        report = maintain_source(source, keep = 2)
+        self.assertEqual(report['squashed'], 2)
+        self.assertEqual(len(list(repo.iter_commits())), 2)
+        self.assertEqual(repo.head.commit.tree.hexsha, tree)
+
+    def test_source_flowbits(self):
+        """Test flowbits, hostbits and xbits resolution"""
+        rules = {
+            'rules/bits.rules': [
+                'alert tcp any any -> any any (msg:"set and isset"; flowbits:isset,a.bit; flowbits:set,a.bit; sid:1000010; rev:1;)\n',
+                'alert tcp any any -> any any (msg:"hostbits"; hostbits:set,h.bit; sid:1000011; rev:1;)\n',
+                'alert tcp any any -> any any (msg:"xbits"; xbits:isset,x.bit; sid:1000012; rev:1;)\n',
+            ]
+        }
+        self.import_tar(rules)
+        self.assertEqual(Flowbit.objects.filter(source = self.source).count(), 3)
+        self.assertEqual(Rule.objects.get(sid = 1000010).flowbits.count(), 1)
+        self.assertEqual(Flowbit.objects.get(source = self.source, name = 'h.bit').type, 'hostbits')
+        xbit = Flowbit.objects.get(source = self.source, name = 'x.bit')
+        self.assertTrue(xbit.isset)
+        self.assertFalse(xbit.set)
+
+    def test_flowbits_groups(self):
+        """Test transitive flowbits dependencies"""
+        rules = {
+            'rules/chain.rules': [
+                'alert tcp any any -> any any (msg:"set a"; flowbits:set,a.bit; sid:1000020; rev:1;)\n',
+                'alert tcp any any -> any any (msg:"isset a set b"; flowbits:isset,a.bit; flowbits:set,b.bit; sid:1000021; rev:1;)\n',
+                'alert tcp any any -> any any (msg:"isset b"; flowbits:isset,b.bit; sid:1000022; rev:1;)\n',
+                'alert tcp any any -> any any (msg:"alone"; sid:1000023; rev:1;)\n',
+            ]
+        }
+        self.import_tar(rules)
+        group = Rule.objects.get(sid = 1000022).get_flowbits_group()
+        self.assertEqual(sorted([ rule.sid for rule in group ]), [1000020, 1000021, 1000022])
+        self.assertEqual(Rule.objects.get(sid = 1000023).get_flowbits_group(), set())
+        # breaking the chain splits the group
+        rules['rules/chain.rules'][1] = 'alert tcp any any -> any any (msg:"isset a"; flowbits:isset,a.bit; sid:1000021; rev:2;)\n'
+        self.import_tar(rules)
+        self.assertEqual(Rule.objects.get(sid = 1000022).flowbits_group, 1000022)
+        self.assertEqual(Rule.objects.get(sid = 1000021).flowbits_group, 1000020)
+        # groups are updated when rules are only removed
+        del(rules['rules/chain.rules'][0])
+        self.import_tar(rules)
+        self.assertEqual(Rule.objects.get(sid = 1000021).flowbits_group, 1000021)
+
+    def test_source_suspect_tar(self):
+        """Test tar file with a member outside of archive directory"""
+        self.import_tar(self.RULES)
+        tfile = tempfile.NamedTemporaryFile(dir = self.tmpdirname)
+        tar = tarfile.open(fileobj = tfile, mode = 'w:gz')
+        info = tarfile.TarInfo('rules/../../evil.rules')
+        tar.addfile(info)
+        tar.close()
+        tfile.flush()
+        source = Source.objects.get(pk = self.source.pk)
+        self.assertRaises(SuspiciousOperation, source.handle_rules_in_tar, tfile)
+        tfile.close()
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdirname, 'evil.rules')))
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdirname, str(self.source.pk), 'rules', 'second.rules')))
+
+    def test_source_unchanged_upstream(self):
+        """Test that an unchanged upstream skips the update"""
+        tfile = self.build_tar(self.RULES)
+        def fetch(f, conditional = False):
+            if conditional:
+                return False
+            tfile.seek(0)
+            f.write(tfile.read())
+            f.flush()
+            source.fetch_state = { 'etag': '"v1"', 'last_modified': '', 'checksum': 'abc' }
+            return True
+        source = Source.objects.get(pk = self.source.pk)
+        source.update_ruleset = fetch
+        source.update()
+        source = Source.objects.get(pk = self.source.pk)
+        source.update_ruleset = fetch
+        source.update()
+        tfile.close()
+        source = Source.objects.get(pk = self.source.pk)
+        self.assertEqual(source.full_updates, 1)
+        self.assertEqual(source.skipped_updates, 1)
+        self.assertEqual(source.etag, '"v1"')
+        self.assertEqual(Rule.objects.filter(category__source = self.source).count(), 4)
+
+    def test_sources_orchestrator(self):
+        """Test parallel update of sources with a failing one"""
+        tfile = self.build_tar(self.RULES)
+        def fetch(f, conditional = False):
+            tfile.seek(0)
+            f.write(tfile.read())
+            f.flush()
+            return True
+        def fail(f, conditional = False):
+            raise IOError("Connection error")
+        failing = Source.objects.create(name = "Failing test", method = "local",
+                                        datatype = "sigs", created_date = timezone.now())
+        sources = [ Source.objects.get(pk = self.source.pk), failing ]
+        sources[0].update_ruleset = fetch
+        sources[1].update_ruleset = fail
+        orchestrator = UpdateOrchestrator(sources, threads = 2)
+        report = orchestrator.run()
+        tfile.close()
+        self.assertEqual([ result['status'] for result in report ], ['updated', 'failed'])
+        self.assertEqual(orchestrator.errors(), ["Failing test: Connection error"])
+        self.assertEqual(Rule.objects.filter(category__source = self.source).count(), 4)
+
+    def test_sources_orchestrator_apply_error(self):
+        """Test that an error applying a source does not stop the others"""
+        tfile = self.build_tar(self.RULES)
+        def fetch(f, conditional = False):
+            tfile.seek(0)
+            f.write(tfile.read())
+            f.flush()
+            return True
+        def broken(f):
+            raise ValueError("Invalid rule")
+        failing = Source.objects.create(name = "Failing test", method = "local",
+                                        datatype = "sigs", created_date = timezone.now())
+        sources = [ failing, Source.objects.get(pk = self.source.pk) ]
+        for source in sources:
+            source.update_ruleset = fetch
+        sources[0].apply_update = broken
+        report = UpdateOrchestrator(sources, threads = 2).run()
+        tfile.close()
+        self.assertEqual([ result['status'] for result in report ], ['failed', 'updated'])
+        self.assertEqual(Rule.objects.filter(category__source = self.source).count(), 4)
+
+    def test_sid_map(self):
+        """Test resolution of sids for statistics tables"""
+        self.import_tar(self.RULES)
+        sid_map.clear()
+        # sources version and rules lookup
+        with self.assertNumQueries(2):
+            rules = sid_map.get_rules([1000004, 999, 1000001])
+            self.assertEqual([ (rule.sid, rule.msg, rule.category.name) for rule in rules ],
+                             [ (1000004, 'second', 'second'), (1000001, 'first set', 'first') ])
+        with self.assertNumQueries(1):
+            sid_map.get_rules([1000004, 1000001])
+        rules = dict(self.RULES)
+        rules['rules/second.rules'] = [ 'alert tcp any any -> any any (msg:"second updated"; sid:1000004; rev:2;)\n' ]
+        self.import_tar(rules)
+        self.assertEqual(sid_map.get_rules([1000004])[0].msg, 'second updated')
+
+    def test_ruleset_generate(self):
+        """Test rules selection and transformations of a ruleset"""
+        self.import_tar(self.RULES)
+        ruleset = Ruleset.objects.create(name = "Test ruleset", created_date = timezone.now(),
+                                         updated_date = timezone.now())
+        ruleset.categories.add(*Category.objects.filter(source = self.source))
+        ruleset.suppressed_rules.add(Rule.objects.get(sid = 1000001))
+        Transformation.objects.create(rule = Rule.objects.get(sid = 1000004), ruleset = ruleset, datatype = 'drop')
+        with self.assertNumQueries(1):
+            rules = list(ruleset.generate_rules())
+        self.assertEqual([ (sid, action) for (sid, content, action) in rules ], [ (1000002, None), (1000004, 'drop') ])
+        self.assertTrue(ruleset.to_buffer().endswith('drop tcp any any -> any any (msg:"second"; sid:1000004; rev:1;)\n'))
+        self.assertEqual(ruleset.rules_count, 2)
+
+    def test_ruleset_write_rules(self):
+        """Test streamed writing of the rules file of a ruleset"""
+        self.import_tar(self.RULES)
+        ruleset = Ruleset.objects.create(name = "Test ruleset", created_date = timezone.now(),
+                                         updated_date = timezone.now())
+        ruleset.categories.add(*Category.objects.filter(source = self.source))
+        outdir = tempfile.mkdtemp(dir = self.tmpdirname)
+        rfile = os.path.join(outdir, 'scirius.rules')
+        ruleset.RULES_CHUNK_SIZE = 1
+        chunks = list(ruleset.iter_buffer("# header\n"))
+        self.assertEqual(len(chunks), ruleset.rules_count)
+        self.assertEqual(ruleset.write_rules(rfile, "# header\n"), ruleset.rules_count)
+        with open(rfile) as f:
+            self.assertEqual(f.read(), "".join(chunks))
+        self.assertEqual(os.listdir(outdir), ['scirius.rules'])
+
+    def test_ruleset_build_cache(self):
+        """Test reuse and invalidation of cached ruleset builds"""
+        rules = dict(self.RULES)
+        rules['rules/classification.config'] = [ 'config classification: misc-activity,Misc activity,3\n' ]
+        self.import_tar(rules)
+        ruleset = Ruleset.objects.create(name = "Test ruleset", created_date = timezone.now(),
+                                         updated_date = timezone.now())
+        ruleset.sources.add(SourceAtVersion.objects.get(source = self.source))
+        ruleset.categories.add(*Category.objects.filter(source = self.source))
+        cachedir = os.path.join(self.tmpdirname, 'cache')
+        with self.settings(RULESET_CACHE_DIRECTORY = cachedir, RULESET_CACHE_SIZE = 1):
+            build = ruleset.get_build()
+            self.assertEqual(build.rules_count, 3)
+            self.assertTrue(build.related_files().has_key('classification.config'))
+            self.assertEqual(build.to_buffer("# header\n"), "".join(ruleset.iter_buffer("# header\n")))
+            self.assertEqual(ruleset.get_build().path, build.path)
+            ruleset.suppressed_rules.add(Rule.objects.get(sid = 1000001))
+            changed = ruleset.get_build()
+            self.assertNotEqual(changed.path, build.path)
+            self.assertEqual(changed.rules_count, 2)
+            self.assertEqual(os.listdir(cachedir), [ os.path.basename(changed.path) ])
+            outdir = tempfile.mkdtemp(dir = self.tmpdirname)
+            changed.export_files(outdir)
+            self.assertEqual(sorted(os.listdir(outdir)), ['classification.config', 'threshold.config'])
+
+    def test_incremental_validation(self):
+        """Test ruleset validation of changed rules only"""
+        import suricata.common
+        self.import_tar(self.RULES)
+        ruleset = Ruleset.objects.create(name = "Test ruleset", created_date = timezone.now(),
+                                         updated_date = timezone.now())
+        ruleset.categories.add(*Category.objects.filter(source = self.source))
+        tested = []
+        config = ['config']
+        def rules(testor, rule_buffer, config_buffer = None, related_files = {}):
+            sids = [ int(line.split('sid:')[1].split(';')[0]) for line in rule_buffer.splitlines() if 'sid:' in line ]
+            tested.append(sids)
+            return { 'status': 1000004 not in sids or 'drop' not in rule_buffer }
+        orig = (suricata.common.Test.rules, suricata.common.Test.get_system_config_buffer)
+        suricata.common.Test.rules = rules
+        suricata.common.Test.get_system_config_buffer = lambda testor: config[0]
+        try:
+            cachedir = os.path.join(self.tmpdirname, 'cache')
+            with self.settings(RULESET_CACHE_DIRECTORY = cachedir):
+                self.assertEqual(ruleset.test()['mode'], 'full')
+                result = ruleset.test()
+                self.assertEqual((result['mode'], result['tested']), ('incremental', 0))
+                self.assertEqual(len(tested), 1)
+                ruleset.suppressed_rules.add(Rule.objects.get(sid = 1000001))
+                ruleset.test()
+                self.assertEqual(tested[-1], [1000002])
+                Transformation.objects.create(rule = Rule.objects.get(sid = 1000004), ruleset = ruleset, datatype = 'drop')
+                self.assertFalse(ruleset.test()['status'])
+                self.assertEqual(tested[-1], [1000004])
+                Transformation.objects.filter(ruleset = ruleset).delete()
+                self.assertEqual(ruleset.test()['mode'], 'full')
+                config[0] = 'changed'
+                self.assertEqual(ruleset.test()['mode'], 'full')
+                self.assertEqual(ruleset.test(full = True)['mode'], 'full')
+        finally:
+            (suricata.common.Test.rules, suricata.common.Test.get_system_config_buffer) = orig
+
+    def test_sharded_validation(self):
+        """Test split of a ruleset in test shards and merge of errors"""
+        import suricata.common
+        from validation import shard_buffers
+        self.import_tar(self.RULES)
+        ruleset = Ruleset.objects.create(name = "Test ruleset", created_date = timezone.now(),
+                                         updated_date = timezone.now())
+        ruleset.categories.add(*Category.objects.filter(source = self.source))
+        (buffers, line_maps) = shard_buffers(ruleset, "# header\n", 4)
+        self.assertEqual(len(buffers), 2)
+        full_lines = "".join(ruleset.iter_buffer(header = "# header\n")).splitlines()
+        for (buf, line_map) in zip(buffers, line_maps):
+            self.assertEqual([ full_lines[line - 1] for line in line_map ], buf.splitlines())
+        self.assertTrue('sid:1000001;' in buffers[0] and 'sid:1000002;' in buffers[0])
+        self.assertTrue(buffers[1].startswith("# header\nalert") and 'sid:1000004;' in buffers[1])
+        def rule_buffer(testor, rule_buffer, config_buffer = None, related_files = {}):
+            errors = [ json.dumps({'engine': {'error_code': 2, 'message': 'bad config'}}) ]
+            if 'sid:1000004;' in rule_buffer:
+                errors.append(json.dumps({'engine': {'error_code': 39, 'message': 'error parsing signature "sid:1000004;" from file x'}}))
+                errors.append(json.dumps({'engine': {'error_code': 2, 'message': 'bad flowbits at line 2'}}))
+                errors.append(json.dumps({'engine': {'error_code': 41, 'message': 'bad file at line 99'}}))
+            return {'status': False, 'errors': "\n".join(errors)}
+        orig = suricata.common.Test.rule_buffer
+        suricata.common.Test.rule_buffer = rule_buffer
+        try:
+            result = suricata.common.Test().rules_sharded(buffers, config_buffer = 'config', line_maps = line_maps)
+            unmapped = suricata.common.Test().rules_sharded(buffers, config_buffer = 'config')
+        finally:
+            suricata.common.Test.rule_buffer = orig
+        self.assertFalse(result['status'])
+        self.assertEqual([ (error['error_code'], error.get('sid')) for error in result['errors'] ],
+                         [ (2, None), (39, 1000004), (2, None), (41, None) ])
+        # shard line numbers point to the same rule in the full rules file
+        self.assertEqual(result['errors'][2]['message'], 'bad flowbits at line %d' % (line_maps[1][1]))
+        self.assertEqual(full_lines[line_maps[1][1] - 1], buffers[1].splitlines()[1])
+        self.assertEqual((result['errors'][3]['message'], result['errors'][3]['shard']), ('bad file at line', 1))
+        self.assertEqual((unmapped['errors'][2]['message'], unmapped['errors'][2]['shard']), ('bad flowbits at line', 1))
+
+class JobTestCase(TestCase):
+    def setUp(self):
+        self.tmpdirname = tempfile.mkdtemp()
+        self.settings_override = self.settings(GIT_SOURCES_BASE_DIRECTORY=self.tmpdirname, USE_JOB_WORKER=True)
+        self.settings_override.enable()
+        self.source = Source.objects.create(name="Local test",
+                                   method = "local",
+                                   datatype = "sigs",
+                                   created_date=timezone.now())
+
+    def tearDown(self):
+        self.settings_override.disable()
+        rmtree(self.tmpdirname)
+
+    def test_job_queue(self):
+        """Test deduplication and execution of jobs"""
+        job = submit_job('update_source', source_id = self.source.pk)
+        self.assertEqual(job.status, 'pending')
+        self.assertEqual(submit_job('update_source', source_id = self.source.pk).pk, job.pk)
+        failing = submit_job('unknown_action')
+        self.assertNotEqual(failing.pk, job.pk)
+        claimed = claim_job('test')
+        self.assertEqual(claimed.pk, job.pk)
+        self.assertEqual(claimed.status, 'running')
+        claimed = run_job(claimed)
+        self.assertEqual(claimed.to_dict()['result'], {'status': True})
+        self.assertEqual(run_job(claim_job('test')).status, 'failed')
+        self.assertEqual(claim_job('test'), None)
+
+    def test_job_claims(self):
+        """Test atomic deduplication and recovery of jobs of lost workers"""
+        job = submit_job('update_source', source_id = self.source.pk)
+        # a concurrent submission can't insert the same pending job
+        with transaction.atomic():
+            self.assertRaises(IntegrityError, Job.objects.create, action = job.action, args = job.args,
+                              key = job.key, pending_key = job.pending_key)
+        self.assertEqual(claim_job('lost').pk, job.pk)
+        self.assertNotEqual(submit_job('update_source', source_id = self.source.pk).pk, job.pk)
+        stale = timezone.now() - timedelta(seconds = 10)
+        Job.objects.filter(pk = job.pk).update(heartbeat_date = stale)
+        with self.settings(JOB_STALE_TIMEOUT = 5, JOB_MAX_ATTEMPTS = 2):
+            claimed = claim_job('test')
+            self.assertEqual((claimed.pk, claimed.worker, claimed.attempts), (job.pk, 'test', 2))
+            Job.objects.filter(pk = job.pk).update(heartbeat_date = stale)
+            self.assertNotEqual(claim_job('test').pk, job.pk)
+        self.assertEqual(Job.objects.get(pk = job.pk).status, 'failed')
+
+    def test_job_ownership(self):
+        """Test that a job started again by another worker keeps its result"""
+        import jobs
+        def reclaimed(job):
+            self.assertTrue(jobs.JobHeartbeat(job).beat())
+            # the job is considered lost and claimed by another worker
+            Job.objects.filter(pk = job.pk).update(worker = 'other', attempts = job.attempts + 1)
+            self.assertFalse(jobs.JobHeartbeat(job).beat())
+            return { 'status': True }
+        jobs.load_job_handlers()
+        jobs.JOB_HANDLERS['reclaimed'] = reclaimed
+        try:
+            job = run_job(submit_job('reclaimed'))
+        finally:
+            del(jobs.JOB_HANDLERS['reclaimed'])
+        self.assertEqual((job.status, job.worker, job.result), ('running', 'other', ''))
+
+class ResultCacheTestCase(TestCase):
+    def test_cache(self):
+        """Test expiration and eviction of cached results"""
+        cache = ResultCache(2)
+        self.assertEqual(cache.get('a', 60, lambda: 1), 1)
+        self.assertEqual(cache.get('a', 60, lambda: 2), 1)
+        self.assertEqual(cache.get('b', 0, lambda: 3), 3)
+        self.assertEqual(cache.get('b', 60, lambda: None), None)
+        self.assertEqual(cache.get('b', 60, lambda: 4), 4)
+        cache.get('c', 60, lambda: 5)
+        # 'a' is the least recently used entry
+        self.assertEqual(cache.get('a', 60, lambda: 6), 6)
+        self.assertEqual(cache.stats()['entries'], 2)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_single_flight(self):
+        """Test that concurrent identical queries are computed once"""
+        cache = ResultCache(10)
+        calls = []
+        def compute():
+            calls.append(1)
+            sleep(0.2)
+            return { 'count': 1 }
+        results = []
+        threads = [ threading.Thread(target = lambda: results.append(cache.get('key', 60, compute))) for i in range(5) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{ 'count': 1 }] * 5)
+
+class ESBatchTestCase(TestCase):
+    def setUp(self):
+        self.requests = []
+        self.es_request = es_graphs.es_request
+        es_graphs.es_request = self.fake_request
+        es_graphs.es_cache.clear()
+
+    def tearDown(self):
+        es_graphs.es_request = self.es_request
+        es_graphs.es_cache.clear()
+
+    def fake_request(self, method, url, body = None, params = None):
+        self.requests.append((method, url, body))
+        return { 'responses': [
+                    { 'hits': { 'total': 12, 'hits': [] } },
+                    { 'hits': { 'total': 1, 'hits': [ { '_source': { 'host': 'probe' } } ] } },
+                    { 'error': 'index_not_found_exception' } ] }
+
+    def test_msearch(self):
+        """Test that panels are sent in one request and cached"""
+        panels = [ ('alerts_count', { 'from_date': 0, 'hosts': ['*'] }),
+                   ('latest_stats', { 'from_date': 0, 'hosts': ['*'] }),
+                   ('latest_stats', { 'from_date': 0, 'hosts': ['probe'] }) ]
+        results = es_graphs.es_msearch(panels)
+        self.assertEqual(results, [ { 'doc_count': 12 }, { 'host': 'probe' }, None ])
+        self.assertEqual(len(self.requests), 1)
+        (method, url, body) = self.requests[0]
+        self.assertEqual(url, es_graphs.MSEARCH_URL)
+        # header and body line per panel
+        self.assertEqual(len(body.splitlines()), 6)
+        self.assertEqual(es_graphs.es_msearch(panels[:2]), results[:2])
+        self.assertEqual(len(self.requests), 1)
+
+    def test_batch_errors(self):
+        """Test that invalid batches and failed panels are rejected"""
+        from django.test import RequestFactory
+        import views
+        for panels in ([ { 'query': 'timeline' } ], [ { 'query': 'timeline', 'from_date': 'now' } ]):
+            request = RequestFactory().get('/rules/es/batch', { 'panels': json.dumps(panels) })
+            self.assertRaises(SuspiciousOperation, views.elasticsearch_batch, request)
+        es_graphs.es_request = lambda method, url, body = None, params = None: { 'responses': [ { 'error': 'timeout' } ] * 2 }
+        panels = [ ('timeline', { 'from_date': 0, 'interval': 1, 'hosts': ['a', 'b'] }) ]
+        with self.settings(ELASTICSEARCH_2X = True, ELASTICSEARCH_TIMELINE_SHARD_SIZE = 1):
+            self.assertEqual(es_graphs.es_msearch(panels), [ None ])
+            self.assertEqual(es_graphs.es_cache.stats()['entries'], 0)
+        # answers without the expected data are failures, not empty panels
+        es_graphs.es_request = lambda method, url, body = None, params = None: { 'responses': [ { 'status': 500 } ] }
+        panels = [ ('rules', { 'hostname': '*', 'count': 10, 'from_date': 0 }),
+                   ('timeline', { 'from_date': 0, 'interval': 1, 'hosts': ['*'] }),
+                   ('metrics_timeline', { 'from_date': 0, 'interval': 1 }) ]
+        for es2x in (True, False):
+            with self.settings(ELASTICSEARCH_2X = es2x):
+                for panel in panels:
+                    self.assertEqual(es_graphs.es_msearch([ panel ]), [ None ])
+                    self.assertEqual(es_graphs.es_panel(panel[0], **panel[1]), None)
+        self.assertEqual(es_graphs.es_cache.stats()['entries'], 0)
+
+    def test_query_builders(self):
+        """Test that query bodies are valid for both dialects"""
+        qfilter = 'alert.signature:"ET POLICY"'
+        for es2x in (True, False):
+            with self.settings(ELASTICSEARCH_2X = es2x):
+                body = json.loads(json.dumps(es_query.top_query('alert.signature_id', '*', 20, 0, qfilter)))
+                if es2x:
+                    query = body['query']['filtered']['query']['query_string']['query']
+                else:
+                    query = body['facets']['table']['facet_filter']['fquery']['query']['filtered']['query']['bool']['should'][0]['query_string']['query']
+                self.assertEqual(query, 'event_type:alert AND host.raw:* AND ' + qfilter)
+                body = es_query.timeline_query(0, '60s', ['probe1', 'probe2'])
+                if not es2x:
+                    self.assertEqual(sorted(body['facets'].keys()), ['probe1', 'probe2'])
+                    continue
+                date_range = { "range": { "@timestamp": { "gte": 0, "lte": "now", "format": "epoch_millis" } } }
+                expected = {
+                    "size": 0,
+                    "aggs": {
+                        "date": {
+                            "date_histogram": { "field": "@timestamp", "interval": "60s",
+                                                "time_zone": "Europe/Berlin", "min_doc_count": 0 },
+                            "aggs": { "host": { "terms": { "field": "host.raw", "size": 5, "order": { "_count": "desc" } } } },
+                        }
+                    },
+                    "query": {
+                        "filtered": {
+                            "query": { "query_string": { "query": "event_type:alert", "analyze_wildcard": False } },
+                            "filter": { "bool": { "must": [ date_range ], "must_not": [] } },
+                        }
+                    },
+                }
+                self.assertEqual(body, expected)
+                # a shard of hosts restricts the query and the number of hosts
+                body = es_query.timeline_query(0, '60s', ['probe1', 'probe2'], qfilter, shard = ['probe2'])
+                expected['aggs']['date']['aggs']['host']['terms']['size'] = 1
+                expected['query']['filtered']['query']['query_string']['query'] = 'event_type:alert AND ' + qfilter
+                expected['query']['filtered']['filter']['bool']['must'].append({ "terms": { "host.raw": ['probe2'] } })
+                self.assertEqual(body, expected)
+
+    def test_rollup(self):
+        """Test long range queries answered from rolled up alerts"""
+        now = rollup.floor_hour(timezone.now())
+        first = now - timedelta(days = 10)
+        rollup.store_hour(first, [ ('probe', 1, 5), ('probe', 2, 1) ])
+        rollup.store_hour(first + rollup.HOUR, [ ('probe', 2, 2), ('probe', rollup.OTHER_SID, 3) ])
+        self.assertEqual(rollup.hours_to_roll(30)[0], first + 2 * rollup.HOUR)
+        # hours are rolled up once late alerts are indexed
+        with self.settings(ELASTICSEARCH_ROLLUP_DELAY = 90):
+            self.assertTrue(rollup.hours_to_roll(30)[-1] + rollup.HOUR <= timezone.now() - timedelta(minutes = 90))
+        def fake_request(method, url, body = None, params = None):
+            self.requests.append((method, url, body))
+            data = { 'aggregations': { 'table': { 'buckets': [ { 'key': 2, 'doc_count': 3 } ] },
+                                       'date': { 'buckets': [ { 'key': rollup.to_millis(now),
+                                                                'host': { 'buckets': [ { 'key': 'probe', 'doc_count': 4 } ] } } ] } } }
+            if url == es_graphs.MSEARCH_URL:
+                return { 'responses': [ data ] }
+            return data
+        es_graphs.es_request = fake_request
+        from_date = rollup.to_millis(first)
+        with self.settings(ELASTICSEARCH_ROLLUP = True, ELASTICSEARCH_2X = True):
+            self.assertEqual(es_graphs.es_panel('rules', hostname = '*', count = 10, from_date = from_date), [ (2, 6), (1, 5) ])
+            timeline = es_graphs.es_panel('timeline', from_date = from_date, interval = 3600 * 24)
+            self.assertEqual(sum(timeline['values']['probe']), 15)
+            # rolled up alerts of other hosts are not mixed with requested ones
+            rollup.store_hour(first, [ ('probe', 1, 5), ('probe', 2, 1), ('other', 1, 100) ])
+            es_graphs.es_cache.clear()
+            timeline = es_graphs.es_panel('timeline', from_date = from_date, interval = 3600 * 24, hosts = ['other', 'quiet'])
+            self.assertEqual(sorted(timeline['values'].keys()), ['other', 'quiet'])
+            self.assertEqual(sum(timeline['values']['other']), 100)
+            # filters need raw alerts
+            self.assertFalse(es_graphs.use_rollup('rules', { 'from_date': from_date, 'qfilter': 'src_ip:10.0.0.1' }))
+        # only alerts after rolled up hours are queried
+        searches = [ request for request in self.requests if request[2] != None ]
+        self.assertEqual(searches[0][2]['query']['filtered']['filter']['bool']['must'][0]['range']['@timestamp']['from'],
+                         rollup.to_millis(first + 2 * rollup.HOUR))
+        # alerts of signatures beyond the terms limit are kept in host totals
+        es_graphs.es_request = lambda method, url, body = None, params = None: { 'aggregations': { 'host': { 'buckets': [
+            { 'key': 'probe', 'doc_count': 10, 'sid': { 'sum_other_doc_count': 4, 'buckets': [ { 'key': 2, 'doc_count': 6 } ] } } ] } } }
+        self.assertEqual(es_graphs.es_get_alerts_rollup(first, first + rollup.HOUR), [ ('probe', 2, 6), ('probe', rollup.OTHER_SID, 4) ])
+
+    def test_index_selection(self):
+        """Test that only indices in time range are queried"""
+        now = datetime.now()
+        start = now - timedelta(days = 2)
+        hours = [ now - timedelta(hours = hour) for hour in (0, 3, 24 * 3) ]
+        def fake_request(method, url, body = None, params = None):
+            self.requests.append((method, url, body))
+            return "\n".join([ 'logstash-' + hour.strftime('%Y.%m.%d.%H') for hour in hours ]) + "\n"
+        es_graphs.es_request = fake_request
+        with self.settings(ELASTICSEARCH_LOGSTASH_TIMESTAMPING = 'hourly'):
+            indexes = es_graphs.build_es_timestamping(start).split(',')
+            # cached list of indices is used
+            es_graphs.build_es_timestamping(start)
+        self.assertEqual(len(self.requests), 1)
+        def covered(hour):
+            name = 'logstash-' + hour.strftime('%Y.%m.%d.%H')
+            return any([ index == name or (index.endswith('*') and name.startswith(index[:-1])) for index in indexes ])
+        self.assertEqual([ covered(hour) for hour in hours ], [True, True, False])
+        # full days are matched with a wildcard
+        self.assertTrue(len(indexes) <= 4)
+        # index of the current period is queried before being listed
+        hours = hours[1:]
+        es_graphs.es_cache.clear()
+        with self.settings(ELASTICSEARCH_LOGSTASH_TIMESTAMPING = 'hourly'):
+            indexes = es_graphs.build_es_timestamping(start).split(',')
+        self.assertTrue(covered(now))
+
+    def test_sharded_timeline(self):
+        """Test timeline of hosts built from several queries"""
+        def buckets(counts):
+            return { 'aggregations': { 'date': { 'buckets': [
+                { 'key': date, 'host': { 'buckets': [ { 'key': host, 'doc_count': count } for (host, count) in counts[date] ] } }
+                for date in counts ] } } }
+        def fake_request(method, url, body = None, params = None):
+            self.requests.append((method, url, body))
+            return { 'responses': [ buckets({ 1000: [ ('a', 1), ('b', 2) ], 2000: [ ('a', 3) ] }),
+                                    buckets({ 2000: [ ('c', 4) ] }) ] }
+        es_graphs.es_request = fake_request
+        with self.settings(ELASTICSEARCH_2X = True, ELASTICSEARCH_TIMELINE_SHARD_SIZE = 2):
+            timeline = es_graphs.es_panel('timeline', from_date = 0, interval = 1, hosts = ['a', 'b', 'c'])
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(len(self.requests[0][2].splitlines()), 4)
+        self.assertEqual(timeline['times'], [1000, 2000])
+        self.assertEqual((timeline['values']['a'], timeline['values']['c']), ([1, 3], [0, 4]))
+
+    def test_failed_shards(self):
+        """Test that errored or partial answers are not cached"""
+        good = { '_shards': { 'total': 2, 'failed': 0 }, 'aggregations': { 'date': { 'buckets': [
+            { 'key': 1000, 'host': { 'buckets': [ { 'key': 'a', 'doc_count': 1 } ] } } ] } } }
+        partial = { '_shards': { 'total': 2, 'failed': 1 }, 'hits': { 'total': 0, 'hits': [] } }
+        answers = { es_graphs.MSEARCH_URL: { 'responses': [ good, { 'error': 'timeout' } ] } }
+        es_graphs.es_request = lambda method, url, body = None, params = None: answers.get(url, partial)
+        with self.settings(ELASTICSEARCH_2X = True, ELASTICSEARCH_TIMELINE_SHARD_SIZE = 1):
+            self.assertEqual(es_graphs.es_panel('timeline', from_date = 0, interval = 1, hosts = ['a', 'b']), None)
+            self.assertEqual(es_graphs.es_panel('alerts_count', from_date = 0, hosts = ['*']), None)
+            answers[es_graphs.MSEARCH_URL] = { 'responses': [ partial ] }
+            self.assertEqual(es_graphs.es_msearch([ ('alerts_count', { 'from_date': 0, 'hosts': ['*'] }) ]), [ None ])
+        self.assertEqual(es_graphs.es_cache.stats()['entries'], 0)
+
+    def test_timeline_formats(self):
+        """Test timelines built in columns format and converted to entries"""
+        facets = { 'a': { '_type': 'date_histogram', 'entries': [ { 'time': 1000, 'mean': 1.5 }, { 'time': 2000, 'mean': 2.5 } ] },
+                   'b': { '_type': 'date_histogram', 'entries': [ { 'time': 2000, 'mean': 3.0 } ] } }
+        with self.settings(ELASTICSEARCH_2X = False):
+            data = es_graphs.parse_metrics_timeline({ 'facets': facets }, 0, 1, ['a', 'b'])
+        self.assertEqual(data, { 'format': 'columns', 'from_date': 0, 'interval': 1000, 'times': [1000, 2000],
+                                 'values': { 'a': [1.5, 2.5], 'b': [None, 3.0] } })
+        self.assertEqual(es_graphs.timeline_entries(data, 'mean'),
+                         { 'from_date': 0, 'interval': 1000,
+                           'a': { 'entries': [ { 'time': 1000, 'mean': 1.5 }, { 'time': 2000, 'mean': 2.5 } ] },
+                           'b': { 'entries': [ { 'time': 2000, 'mean': 3.0 } ] } })
+        self.assertEqual(es_graphs.timeline_entries({}, 'count'), {})
+        self.assertEqual(es_graphs.timeline_entries(None, 'count'), None)
+
+class FakeConnection(Connection):
+    # answers requests without Elasticsearch, as urllib3 connection does
+    requests = []
+
+    def perform_request(self, method, url, params = None, body = None, timeout = None, ignore = ()):
+        FakeConnection.requests.append((method, url, params, body))
+        return 200, { 'content-type': 'application/json' }, json.dumps(self.answer(method, url, body))
+
+    def answer(self, method, url, body):
+        return { 'responses': [ { 'hits': { 'total': 7, 'hits': [] } } ] }
+
+class TupleTransport(Transport):
+    # transport of clients before 5.0, returning (status, data)
+    def perform_request(self, *args, **kwargs):
+        return 200, super(TupleTransport, self).perform_request(*args, **kwargs)
+
+class ESRequestTestCase(TestCase):
+    def setUp(self):
+        FakeConnection.requests = []
+        es_graphs.es_cache.clear()
+
+    def tearDown(self):
+        es_data.es_client = None
+        es_data.es_retry_client = None
+        es_graphs.es_cache.clear()
+
+    def test_es_request(self):
+        """Test requests through the transport of current and older clients"""
+        panels = [ ('alerts_count', { 'from_date': 0, 'hosts': ['*'] }) ]
+        for transport in (Transport, TupleTransport):
+            es_data.es_client = Elasticsearch(['http://localhost:9200/'], connection_class = FakeConnection,
+                                              transport_class = transport)
+            es_graphs.es_cache.clear()
+            self.assertEqual(es_graphs.es_msearch(panels), [ { 'doc_count': 7 } ])
+        self.assertEqual([ request[1] for request in FakeConnection.requests ].count(es_graphs.MSEARCH_URL), 2)
+
+    def test_es_data_retries(self):
+        """Test that requests of ESData are retried on connection errors"""
+        from elasticsearch import ConnectionError
+        class FlakyConnection(FakeConnection):
+            def perform_request(self, *args, **kwargs):
+                if len(FakeConnection.requests) % 2 == 0:
+                    FakeConnection.requests.append(None)
+                    raise ConnectionError('N/A', 'connection refused', None)
+                return super(FlakyConnection, self).perform_request(*args, **kwargs)
+
+            def answer(self, method, url, body):
+                return { 'hits': { 'total': 0, 'hits': [] } }
+        orig = es_data.Elasticsearch
+        es_data.Elasticsearch = lambda *args, **kwargs: orig(*args, connection_class = FlakyConnection, **kwargs)
+        try:
+            es_data.ESData()._kibana_remove('dashboard', { 'query': { 'match_all': {} } })
+            self.assertEqual(len(FakeConnection.requests), 2)
+            # es_request has its own retry loop
+            self.assertEqual(es_data.get_es_client().transport.max_retries, 0)
+        finally:
+            es_data.Elasticsearch = orig
+
+    def test_delete_by_sid(self):
+        """Test deletion of alerts by batches"""
+        hits = [ { '_index': 'logstash-2017.01.01', '_type': 'log', '_id': str(i) } for i in range(3) ]
+        batches = [ hits[:2], hits[2:], [] ]
+        class DeleteConnection(FakeConnection):
+            def answer(self, method, url, body):
+                if url == es_graphs.BULK_URL:
+                    return { 'items': [ { 'delete': { 'status': 200 } } for line in body.splitlines() ] }
+                if method == 'DELETE':
+                    return {}
+                return { '_scroll_id': 'scroll', 'hits': { 'total': 3, 'hits': batches.pop(0) } }
+        es_data.es_client = Elasticsearch(['http://localhost:9200/'], connection_class = DeleteConnection)
+        progress = []
+        with self.settings(ELASTICSEARCH_DELETE_RATE = 1000000):
+            result = es_graphs.es_delete_alerts_by_sid(2000001, progress = lambda pct, msg: progress.append(pct))
+        self.assertEqual(result, { 'total': 3, 'deleted': 3, 'failed': 0 })
+        self.assertEqual(progress, [66, 99])
+        requests = FakeConnection.requests
+        self.assertEqual([ request[0] for request in requests ], ['POST', 'POST', 'POST', 'POST', 'POST', 'DELETE'])
+        # scroll is opened by the first search and used by the next ones
+        self.assertEqual(requests[0][1], '/' + settings.ELASTICSEARCH_LOGSTASH_ALERT_INDEX + '*/_search')
+        self.assertEqual(requests[0][2], { 'scroll': es_graphs.SCROLL_TIMEOUT, 'ignore_unavailable': 'true' })
+        self.assertEqual([ request[1] for request in requests[2::2] ], [ es_graphs.SCROLL_URL ] * 2)
+        self.assertEqual(requests[2][2], { 'scroll': es_graphs.SCROLL_TIMEOUT })
@@ -27,6 +27,7 @@ urlpatterns = patterns('',
     url(r'^about/$', views.about, name='scirius_about'),
     url(r'^search$', views.search, name='scirius_search'),
     url(r'^es$', views.elasticsearch, name='elasticsearch'),
+    url(r'^es/batch$', views.elasticsearch_batch, name='elasticsearch_batch'),
     url(r'^influxdb$', views.influxdb, name='influxdb'),
     url(r'^settings/$', views.system_settings, name='system_settings'),
     url(r'^source/$', views.sources, name='sources'),
@@ -73,6 +74,8 @@ urlpatterns = patterns('',
     url(r'^rule/(?P<rule_id>\d+)/$', views.rule, {'key': 'sid'}, name='rule_sid'),
     url(r'^rule/pk/(?P<rule_id>\d+)/test/(?P<ruleset_id>\d+)$', views.test_rule, {'key': 'pk'}, name='test_rule'),
     url(r'^info$', views.info, name='info'),
+    url(r'^job/$', views.jobs, name='jobs'),
+    url(r'^job/(?P<job_id>\d+)/$', views.job, name='job'),
     url(r'^threshold/(?P<threshold_id>\d+)/$', views.threshold, name='threshold'),
     url(r'^threshold/(?P<threshold_id>\d+)/delete$', views.delete_threshold, name='delete_threshold'),
     url(r'^threshold/(?P<threshold_id>\d+)/edit$', views.edit_threshold, name='edit_threshold'),
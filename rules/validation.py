@@ -0,0 +1,143 @@
+"""
+Copyright(C) 2016, Stamus Networks
+Written by Eric Leblond <eleblond@stamus-networks.com>
+
+This file is part of Scirius.
+
+Scirius is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Scirius is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Scirius.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from datetime import timedelta
+import hashlib
+
+from rules.models import Rule, RulesetValidation, transform_content, rule_line
+
+def rule_digest(line):
+    return hashlib.sha1(line.encode('utf-8')).hexdigest()[:12]
+
+def config_digest(config_buffer, related_files):
+    digest = hashlib.sha1(config_buffer or '')
+    for name in sorted(related_files):
+        digest.update(name)
+        digest.update(related_files[name])
+    return digest.hexdigest()
+
+def rules_digests(ruleset):
+    # sid -> digest of the rule as written in the generated file
+    return dict([ (sid, rule_digest(transform_content(content, action)))
+                  for (sid, content, action) in ruleset.generate_rules() ])
+
+def changed_rules(previous, current):
+    """
+    Return sids of rules added or modified since previous validation and
+    of removed rules, None if there are too many for an incremental test.
+    """
+    sids = [ sid for sid in current if previous.get(sid) != current[sid] ]
+    sids += [ sid for sid in previous if not current.has_key(sid) ]
+    if len(sids) > settings.RULESET_INCREMENTAL_MAX_RULES:
+        return None
+    return sids
+
+def incremental_selection(sids):
+    # changed rules and the rules linked to them by flowbits, also for
+    # removed rules as rules depending on them may now be broken
+    groups = Rule.objects.filter(sid__in = sids).exclude(flowbits_group = None)
+    groups = set(groups.values_list('flowbits_group', flat = True))
+    return Q(sid__in = sids) | Q(flowbits_group__in = list(groups))
+
+def shard_buffers(ruleset, header, shards):
+    """
+    Split the generated rules of the ruleset in at most shards buffers
+    starting with header. Rules linked by flowbits are kept in the same
+    buffer so each one can be tested alone. Return the buffers and, for
+    each buffer, the list of the line numbers of its lines in the full
+    rules file.
+    """
+    groups = dict(ruleset.generate().exclude(flowbits_group = None).values_list('sid', 'flowbits_group'))
+    header_lines = range(1, header.count("\n") + 1)
+    buffers = [ [ header ] for _ in xrange(shards) ]
+    line_maps = [ list(header_lines) for _ in xrange(shards) ]
+    shard_of = {}
+    line = len(header_lines)
+    for (sid, content, action) in ruleset.generate_rules():
+        key = groups.get(sid, sid)
+        if not shard_of.has_key(key):
+            shard_of[key] = len(shard_of) % shards
+        content = rule_line(content, action)
+        buffers[shard_of[key]].append(content)
+        for _ in xrange(content.count("\n")):
+            line += 1
+            line_maps[shard_of[key]].append(line)
+    shards = [ index for index in xrange(shards) if len(buffers[index]) > 1 ]
+    return ([ "".join(buffers[index]) for index in shards ], [ line_maps[index] for index in shards ])
+
+def full_test_due(state, config):
+    if not state.valid or state.config_hash != config or state.full_date == None:
+        return True
+    return state.full_date < timezone.now() - timedelta(hours = settings.RULESET_FULL_TEST_INTERVAL)
+
+def validate_ruleset(ruleset, full = False):
+    """
+    Test the ruleset with Suricata. When the last test succeeded with the
+    same configuration, only changed rules and their flowbits dependencies
+    are tested.
+    """
+    Probe = __import__(settings.RULESET_MIDDLEWARE)
+    testor = Probe.common.Test()
+    build = ruleset.get_build()
+    ruleset.rules_count = build.rules_count
+    related_files = build.related_files()
+    config_buffer = testor.get_system_config_buffer()
+    config = config_digest(config_buffer, related_files)
+    digests = rules_digests(ruleset)
+    (state, _) = RulesetValidation.objects.get_or_create(ruleset = ruleset)
+
+    sids = None
+    if not full and not full_test_due(state, config):
+        sids = changed_rules(state.get_rules(), digests)
+    if sids == None:
+        if settings.SURICATA_TEST_PROCESSES > 1 and hasattr(testor, 'rules_sharded'):
+            (rule_buffers, line_maps) = shard_buffers(ruleset, ruleset.rules_header(), settings.SURICATA_TEST_PROCESSES)
+            result = testor.rules_sharded(rule_buffers, config_buffer = config_buffer, related_files = related_files,
+                                          line_maps = line_maps)
+        else:
+            rule_buffer = build.to_buffer(ruleset.rules_header())
+            result = testor.rules(rule_buffer, config_buffer = config_buffer, related_files = related_files)
+        result['mode'] = 'full'
+        if result['status']:
+            state.full_date = timezone.now()
+    elif len(sids) == 0:
+        result = { 'status': True, 'mode': 'incremental', 'tested': 0 }
+    else:
+        lines = [ rule_line(content, action) for (sid, content, action) in
+                  ruleset.generate_rules(selection = incremental_selection(sids)) ]
+        rule_buffer = ruleset.rules_header() + "".join(lines)
+        result = testor.rules(rule_buffer, config_buffer = config_buffer, related_files = related_files)
+        result['mode'] = 'incremental'
+        result['tested'] = len(lines)
+
+    # a failed test forces a full test next time so all errors are reported
+    state.valid = result['status']
+    state.config_hash = config
+    if state.valid:
+        state.set_rules(digests)
+    else:
+        state.rules = ''
+    state.save()
+    return result
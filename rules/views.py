@@ -20,16 +20,19 @@ along with Scirius.  If not, see <http://www.gnu.org/licenses/>.
 
 from django.shortcuts import render, get_object_or_404, redirect
 from django.utils import timezone
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
+from django.middleware.gzip import GZipMiddleware
 from django.db import IntegrityError
 from django.conf import settings
-from elasticsearch.exceptions import ConnectionError
+from elasticsearch.exceptions import ConnectionError, TransportError
 from django.core.exceptions import SuspiciousOperation
 
 from scirius.utils import scirius_render, scirius_listing
 
 from rules.es_data import ESData
-from rules.models import Ruleset, Source, SourceUpdate, Category, Rule, dependencies_check, get_system_settings, Threshold
+from rules.es_cache import es_cache
+from rules.models import Ruleset, Source, SourceUpdate, Category, Rule, dependencies_check, get_system_settings, Threshold, get_flowbits_closure, Job
+from rules.jobs import submit_job
 from rules.tables import UpdateRuleTable, DeletedRuleTable, ThresholdTable
 
 from rules.es_graphs import *
@@ -189,6 +192,15 @@ class Reference:
         self.key = key
         self.url = None
 
+# field holding the values of timeline queries
+TIMELINE_FIELDS = {'timeline': 'count', 'logstash_eve': 'mean'}
+
+def es_response(request, data):
+    response = HttpResponse(json.dumps(data, separators = (',', ':')), content_type="application/json")
+    if settings.ELASTICSEARCH_GZIP:
+        response = GZipMiddleware().process_response(request, response)
+    return response
+
 def elasticsearch(request):
     data = None
     if request.GET.__contains__('query'):
@@ -247,6 +259,8 @@ def elasticsearch(request):
             data = es_get_health()
         elif query == 'stats':
             data = es_get_stats()
+        elif query == 'cache_stats':
+            data = es_cache.stats()
         elif query == 'indices':
             if request.is_ajax():
                 indices = ESIndexessTable(es_get_indices())
@@ -287,7 +301,9 @@ def elasticsearch(request):
             data = es_get_latest_stats(from_date = from_date, hosts = hosts, qfilter = qfilter)
         else:
             data = None
-        return HttpResponse(json.dumps(data), content_type="application/json")
+        if request.GET.get('format', None) != 'columns' and TIMELINE_FIELDS.has_key(query):
+            data = timeline_entries(data, TIMELINE_FIELDS[query])
+        return es_response(request, data)
     else:
         if request.is_ajax():
             data = es_get_dashboard(count=settings.KIBANA_DASHBOARDS_COUNT)
@@ -297,6 +313,61 @@ def elasticsearch(request):
             complete_context(request, context)
             return scirius_render(request, 'rules/elasticsearch.html', context)
 
+# query of the elasticsearch view -> dashboard panel
+ES_BATCH_PANELS = {
+    'rules': 'rules',
+    'timeline': 'timeline',
+    'logstash_eve': 'metrics_timeline',
+    'rules_per_category': 'rules_per_category',
+    'alerts_count': 'alerts_count',
+    'latest_stats': 'latest_stats',
+}
+
+def es_batch_args(query):
+    # convert query parameters, as used by the elasticsearch view, to the
+    # arguments of the panel
+    panel = ES_BATCH_PANELS[query['query']]
+    # a missing or invalid date raises an error answered as a bad request
+    kwargs = {'from_date': int(query['from_date'])}
+    cshosts = query.get('hosts', None)
+    if cshosts:
+        hosts = cshosts.split(',')
+    else:
+        hosts = None
+    if panel == 'rules':
+        kwargs['hostname'] = query.get('host', None)
+    elif panel == 'metrics_timeline':
+        kwargs['value'] = query.get('value', None)
+        kwargs['hosts'] = hosts
+        return (panel, kwargs)
+    else:
+        kwargs['hosts'] = hosts
+    kwargs['qfilter'] = query.get('filter', None)
+    if panel == 'alerts_count':
+        kwargs['prev'] = int(query.get('prev', 0))
+    return (panel, kwargs)
+
+def elasticsearch_batch(request):
+    try:
+        queries = json.loads(request.GET.get('panels', '[]'))
+        panels = [ es_batch_args(query) for query in queries ]
+    except (ValueError, KeyError, TypeError, AttributeError):
+        raise SuspiciousOperation("Invalid panels list")
+    try:
+        results = es_msearch(panels)
+    except (TransportError, ConnectionError):
+        results = [None] * len(panels)
+    for (index, (panel, kwargs)) in enumerate(panels):
+        query = queries[index]['query']
+        if panel == 'rules':
+            # rules panel is displayed as an HTML table
+            rules = rules_stats_table(request, results[index] or [])
+            context = {'table': rules}
+            results[index] = scirius_render(request, 'rules/table.html', context).content
+        elif queries[index].get('format', None) != 'columns' and TIMELINE_FIELDS.has_key(query):
+            results[index] = timeline_entries(results[index], TIMELINE_FIELDS[query])
+    return es_response(request, results)
+
 def influxdb(request):
     time_range = int(request.GET.get('time_range', 3600))
     request = request.GET.get('request', 'eve_rate')
@@ -427,7 +498,9 @@ def delete_alerts(request, rule_id):
         return scirius_render(request, 'rules/delete_alerts.html', context)
 
     if request.method == 'POST': # If the form has been submitted...
-        es_delete_alerts_by_sid(rule_id)
+        job = submit_job('delete_alerts', sid = rule_object.sid)
+        if request.is_ajax():
+            return job_response(job)
         return redirect(rule_object)
     else:
         context = {'object': rule_object }
@@ -617,6 +690,9 @@ def update_source(request, source_id):
     if not request.user.is_staff:
         return redirect(src)
 
+    if request.is_ajax():
+        return job_response(submit_job('update_source', source_id = src.pk))
+
     try:
         src.update()
     except (IOError, OSError), errors:
@@ -659,8 +735,9 @@ def activate_source(request, source_id, ruleset_id):
 
 def test_source(request, source_id):
     source = get_object_or_404(Source, pk=source_id)
-    sourceatversion = get_object_or_404(SourceAtVersion, source=source, version = 'HEAD')
-    return HttpResponse(json.dumps(sourceatversion.test()), content_type="application/json")
+    # answer not found before submitting a job that would fail
+    get_object_or_404(SourceAtVersion, source=source, version = 'HEAD')
+    return job_response(submit_job('test_source', source_id = source.pk))
 
 def build_source_diff(request, diff):
     for field in ["added", "deleted", "updated"]:
@@ -703,6 +780,7 @@ def add_source(request):
                         created_date = timezone.now(),
                         datatype = form.cleaned_data['datatype'],
                         cert_verif = form.cleaned_data['cert_verif'],
+                        check_md5 = form.cleaned_data['check_md5'],
                         )
                 if src.method == 'local' and request.FILES.has_key('file'):
                     try:
@@ -740,6 +818,9 @@ def edit_source(request, source_id):
                     firstimport = True
                 source.new_uploaded_file(request.FILES['file'], firstimport)
             form.save()
+            if 'uri' in form.changed_data:
+                # force a full download from the new location
+                Source.objects.filter(pk = source.pk).update(etag = '', last_modified = '', checksum = '')
             return redirect(source)
         except ValueError:
             pass
@@ -851,8 +932,8 @@ def ruleset(request, ruleset_id, mode = 'struct', error = None):
         if error:
             context['error'] = error
     elif mode == 'export':
-        file_content = ruleset.to_buffer()
-        response = HttpResponse(file_content, content_type="text/plain")
+        build = ruleset.get_build()
+        response = StreamingHttpResponse(build.iter_buffer(ruleset.rules_header()), content_type="text/plain")
         response['Content-Disposition'] = 'attachment; filename=scirius.rules'
         return response
     return scirius_render(request, 'rules/ruleset.html', context)
@@ -887,15 +968,14 @@ def update_ruleset(request, ruleset_id):
     if not request.user.is_staff:
         return redirect(rset)
 
+    if request.is_ajax():
+        return job_response(submit_job('update_ruleset', ruleset_id = rset.pk))
+
     try:
         rset.update()
     except IOError, errors:
         error="Can not fetch data: %s" % (errors)
-        if request.is_ajax():
-            return HttpResponse(json.dumps({'status': False, 'errors': error}), content_type="application/json")
         return ruleset(request, ruleset_id, error)
-    if request.is_ajax():
-        return HttpResponse(json.dumps({'status': True}), content_type="application/json")
     return redirect('changelog_ruleset', ruleset_id = ruleset_id)
 
 def changelog_ruleset(request, ruleset_id):
@@ -909,7 +989,21 @@ def changelog_ruleset(request, ruleset_id):
 
 def test_ruleset(request, ruleset_id):
     ruleset = get_object_or_404(Ruleset, pk=ruleset_id)
-    return HttpResponse(json.dumps(ruleset.test()), content_type="application/json")
+    return job_response(submit_job('test_ruleset', ruleset_id = ruleset.pk))
+
+def job_response(job):
+    return HttpResponse(json.dumps({'job': job.to_dict()}), content_type="application/json")
+
+def job(request, job_id):
+    job = get_object_or_404(Job, pk=job_id)
+    return job_response(job)
+
+def jobs(request):
+    # pending and running jobs then last finished ones
+    active = Job.objects.filter(status__in = ['pending', 'running']).order_by('created_date')
+    finished = Job.objects.filter(status__in = ['done', 'failed']).order_by('-finished_date')[:20]
+    data = {'active': [ job.to_dict() for job in active ], 'finished': [ job.to_dict() for job in finished ]}
+    return HttpResponse(json.dumps(data), content_type="application/json")
 
 def edit_ruleset(request, ruleset_id):
     ruleset = get_object_or_404(Ruleset, pk=ruleset_id)
@@ -929,10 +1023,8 @@ def edit_ruleset(request, ruleset_id):
                 ruleset.categories.add(category)
             ruleset.needs_test()
         elif request.POST.has_key('rules'):
-            for rule in request.POST.getlist('rule_selection'):
-                rule_object = get_object_or_404(Rule, pk=rule)
-                rule_object.enable(ruleset)
-            ruleset.needs_test()
+            rules = Rule.objects.filter(pk__in = request.POST.getlist('rule_selection'))
+            ruleset.enable_rules(get_flowbits_closure(rules))
         elif request.POST.has_key('sources'):
             # clean ruleset
             ruleset.sources.clear()
@@ -993,10 +1085,8 @@ def ruleset_add_supprule(request, ruleset_id):
             context = { 'ruleset': ruleset, 'rules': rules }
             return scirius_render(request, 'rules/search_rule.html', context)
         elif request.POST.has_key('rule_selection'):
-            for rule in request.POST.getlist('rule_selection'):
-                rule_object = get_object_or_404(Rule, pk=rule)
-                rule_object.disable(ruleset)
-            ruleset.save()
+            rules = Rule.objects.filter(pk__in = request.POST.getlist('rule_selection'))
+            ruleset.disable_rules(get_flowbits_closure(rules))
         return redirect(ruleset)
     context = { 'ruleset': ruleset }
     return scirius_render(request, 'rules/search_rule.html', context)
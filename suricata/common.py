@@ -26,6 +26,7 @@ import os
 import json
 import StringIO
 import re
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings
 if settings.SURICATA_UNIX_SOCKET:
@@ -287,6 +288,67 @@ logging:
         prov_result['errors'] = self.parse_suricata_error(prov_result['errors'], single = False)
         return prov_result
 
+    LINE_NUMBER = re.compile(r"\bline (\d+)")
+
+    def shard_error(self, error, shard, line_map):
+        # line numbers of a shard error are converted to the line numbers
+        # in the full rules file, or removed if they can't be
+        def full_line(match):
+            line = int(match.group(1))
+            if line_map != None and 0 < line <= len(line_map):
+                return "line %d" % (line_map[line - 1])
+            error['shard'] = shard
+            return "line"
+        if error.has_key('message'):
+            error['message'] = self.LINE_NUMBER.sub(full_line, error['message'])
+        if isinstance(error.get('line', None), int):
+            if line_map != None and 0 < error['line'] <= len(line_map):
+                error['line'] = line_map[error['line'] - 1]
+            else:
+                del(error['line'])
+                error['shard'] = shard
+        return error
+
+    def rules_sharded(self, rule_buffers, config_buffer = None, related_files = {}, line_maps = None):
+        """
+        Test rule buffers with one Suricata process per buffer, all running
+        at the same time, and merge errors as for a test of all the rules.
+        line_maps gives for each buffer the line numbers of its lines in
+        the full rules file, used to fix line numbers in errors.
+        """
+        if config_buffer == None:
+            config_buffer = self.get_system_config_buffer()
+        # threads only wait for the Suricata processes doing the work
+        pool = ThreadPool(max(len(rule_buffers), 1))
+        try:
+            results = pool.map(lambda rule_buffer: self.rule_buffer(rule_buffer, config_buffer = config_buffer,
+                                                                    related_files = related_files), rule_buffers)
+        finally:
+            pool.close()
+            pool.join()
+        errors = []
+        seen = set()
+        for (shard, result) in enumerate(results):
+            if result['status']:
+                continue
+            shard_errors = self.parse_suricata_error(result['errors'], single = False)
+            if isinstance(shard_errors, dict):
+                # raw output, can't be merged
+                return {'status': False, 'errors': shard_errors}
+            line_map = None
+            if line_maps != None:
+                line_map = line_maps[shard]
+            for error in shard_errors:
+                error = self.shard_error(error, shard, line_map)
+                # errors not related to a rule are reported by each process
+                key = json.dumps(error, sort_keys = True)
+                if key not in seen:
+                    seen.add(key)
+                    errors.append(error)
+        if not len(errors) and all([ result['status'] for result in results ]):
+            return {'status': True}
+        return {'status': False, 'errors': errors}
+
 #buf = """
 #alert modbus any any -> any any (msg:"SURICATA Modbus invalid Protocol version"; app-layer-event:modbus.invalid_protocol_id; sid:2250001; rev:1;)
 #alert modbus any any -> any any (msg:"SURICATA Modbus invalid Protocol version"; app-layer-event:modbus.invalid_protocol_id; sid:2250002; rev:1;)
@@ -0,0 +1,54 @@
+"""
+Copyright(C) 2014, Stamus Networks
+Written by Eric Leblond <eleblond@stamus-networks.com>
+
+This file is part of Scirius.
+
+Scirius is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Scirius is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Scirius.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from django.utils import timezone
+
+from rules.jobs import job_handler
+from suricata.models import Suricata
+
+@job_handler('suricata_update')
+def suricata_update(job, suricata_id, reload = False, build = False, push = False):
+    suri = Suricata.objects.get(pk = suricata_id)
+    message = []
+    if reload:
+        job.set_progress(0, "Updating ruleset")
+        try:
+            suri.ruleset.update()
+        except IOError, errors:
+            message.append("Can not fetch data: %s" % (errors))
+            return { 'status': False, 'message': message }
+        message.append("Rule downloaded at %s. " % (suri.ruleset.updated_date) + ".")
+    if build:
+        job.set_progress(50, "Building ruleset")
+        suri.generate()
+        suri.updated_date = timezone.now()
+        suri.save()
+        message.append("Successful ruleset build at " + str(suri.updated_date) + ".")
+    if push:
+        job.set_progress(90, "Pushing ruleset")
+        ret = suri.push()
+        suri.updated_date = timezone.now()
+        suri.save()
+        if ret:
+            message.append("Successful asked ruleset reload at " + str(suri.updated_date))
+        else:
+            message.append("Suricata restart already asked.")
+    return { 'status': True, 'message': message }
@@ -49,23 +49,11 @@ class Suricata(models.Model):
     def generate(self):
         # FIXME extract archive file for sources
         # generate rule file
-        rules = self.ruleset.generate()
-        # write to file
-        rfile = open(self.output_directory + "/" + "scirius.rules", 'w')
         header = "# Rules file for " + self.name + " using ruleset " + self.ruleset.name + " generated by Scirius at " + str(timezone.now()) + "\n"
-        rfile.write(header.encode('utf-8'))
-        for rule in rules:
-            try:
-                #TODO Update with the transmision class
-                # Would be: rfile.write(rule.content_updated(self.ruleset))
-                rfile.write(rule.content)
-            except:
-                #TODO Update with the transmision class
-                # Would be: rfile.write(rule.content_updated(self.ruleset).encode('utf-8'))
-                rfile.write(rule.content.encode('utf-8'))
-        rfile.close()
+        build = self.ruleset.get_build()
+        build.write_rules(os.path.join(self.output_directory, "scirius.rules"), header)
         # export files at version
-        self.ruleset.export_files(self.output_directory)
+        build.export_files(self.output_directory)
 
     def push(self):
         # For now we just create a file asking for reload
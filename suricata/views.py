@@ -32,6 +32,7 @@ from scirius.utils import scirius_render
 
 from suricata.models import Suricata
 from rules.models import dependencies_check
+from rules.jobs import submit_job
 
 from forms import *
 
@@ -129,27 +130,19 @@ def update(request):
         form = SuricataUpdateForm(request.POST)
         if not form.is_valid():
             return scirius_render(request, 'suricata/update.html', { 'suricata': suri, 'error': "Invalid form"})
-        message = []
-        if form.cleaned_data['reload']:
-            try:
-                suri.ruleset.update()
-            except IOError, errors:
-                return index(request, error="Can not fetch data: %s" % (errors))
-            message.append("Rule downloaded at %s. " % (suri.ruleset.updated_date) + ".")
-        if form.cleaned_data['build']:
-            suri.generate()
-            suri.updated_date = timezone.now()
-            suri.save()
-            message.append("Successful ruleset build at " + str(suri.updated_date) + ".")
-        if form.cleaned_data['push']:
-            ret = suri.push()
-            suri.updated_date = timezone.now()
-            suri.save()
-            if ret:
-                message.append("Successful asked ruleset reload at " + str(suri.updated_date))
-            else:
-                message.append("Suricata restart already asked.")
-        context =  { 'message': message, 'suricata': suri }
+        job = submit_job('suricata_update', suricata_id = suri.pk,
+                         reload = form.cleaned_data['reload'],
+                         build = form.cleaned_data['build'],
+                         push = form.cleaned_data['push'])
+        if job.status == 'done':
+            result = job.to_dict()['result']
+            if not result['status']:
+                return index(request, error=result['message'][-1])
+            context =  { 'message': result['message'], 'suricata': suri }
+        elif job.status == 'failed':
+            context =  { 'message': [ "Ruleset actions failed: %s" % (job.message) ], 'suricata': suri }
+        else:
+            context =  { 'job': job, 'suricata': suri }
         return scirius_render(request, 'suricata/update.html', context)
     else:
         return scirius_render(request, 'suricata/update.html', { 'suricata': suri })